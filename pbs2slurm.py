@@ -34,78 +34,407 @@ Contact staff@helix.nih.gov with questions and bug reports.
 """
 
 import sys
+import os
 import re
+import collections
+import contextlib
+import hashlib
+import inspect
+import pickle
+import stat
+import tempfile
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
 
 __version__ = 0.1
 __author__ = "Wolfgang Resch"
 
+Diagnostic = collections.namedtuple("Diagnostic", "level message line rule",
+        defaults = (None, None))
+_collectors = []
+
+def _report(level, s):
+    emit(Diagnostic(level, s))
+def emit(diagnostic):
+    if _collectors:
+        _collectors[-1].append(diagnostic)
+    else:
+        print(f"{diagnostic.level + ':':<9}{diagnostic.message}", file=sys.stderr)
 def info(s):
-    print(f"INFO:    {s}", file=sys.stderr)
+    _report("INFO", s)
 def warn(s):
-    print(f"WARNING: {s}", file=sys.stderr)
+    _report("WARNING", s)
 def error(s):
-    print(f"ERROR:   {s}", file=sys.stderr)
+    _report("ERROR", s)
+
+@contextlib.contextmanager
+def collect_diagnostics():
+    """collects diagnostics in a list instead of printing them to stderr"""
+    diagnostics = []
+    _collectors.append(diagnostics)
+    try:
+        yield diagnostics
+    finally:
+        _collectors.pop()
+
+_prologues = []
+
+def body_prologue(line):
+    """asks for line to be added to the start of the body of the script
+    that is being converted, e.g. for environment that a translated
+    directive implies. Ignored outside of a conversion"""
+    if _prologues:
+        _prologues[-1].append(line)
+
+@contextlib.contextmanager
+def collect_prologue():
+    """collects the lines requested with body_prologue in a list"""
+    lines = []
+    _prologues.append(lines)
+    try:
+        yield lines
+    finally:
+        _prologues.pop()
+
+_tails = []
+
+def header_tail(line):
+    """asks for line to be added after the last line of the header of the
+    script that is being converted, e.g. for the components of a
+    heterogeneous job, which must not take the options of later header
+    lines. Returns False outside of a conversion"""
+    if _tails:
+        _tails[-1].append(line)
+        return True
+    return False
+
+@contextlib.contextmanager
+def collect_tail():
+    """collects the lines requested with header_tail in a list"""
+    lines = []
+    _tails.append(lines)
+    try:
+        yield lines
+    finally:
+        _tails.pop()
+
+class Script:
+    """a batch script stored once as the original text plus the offsets of
+    its parts. Parts and lines are only sliced out of the text when they are
+    needed:
+        text[:shebang_end]              shebang line (None if missing)
+        text[header_start:header_end]   header with the #PBS directives
+        text[body_start:]               body of the script
+    If the header does not contain any #PBS directives it is part of the
+    body."""
+    __slots__ = ("text", "shebang_end", "header_start", "header_end",
+            "body_start")
+
+    def __init__(self, text):
+        self.text = text
+        n = len(text)
+        pos = 0
+        self.shebang_end = None
+        if text.startswith("#!"):
+            nl = text.find("\n")
+            self.shebang_end = n if nl < 0 else nl
+            pos = self.shebang_end + 1
+        start = pos
+        has_directives = False
+        while True:
+            if pos > n:
+                error("reached end of the file without finding any commands")
+                sys.exit(1)
+            end = text.find("\n", pos)
+            if end < 0:
+                end = n
+            if text.startswith("#", pos):
+                has_directives = has_directives or text.startswith("#PBS", pos)
+            elif end > pos and not text[pos:end].isspace():
+                break
+            pos = end + 1
+        self.header_start = start
+        if has_directives:
+            self.header_end = pos - 1
+            self.body_start = pos
+        else:
+            self.header_end = start
+            self.body_start = start
+
+    @property
+    def shebang(self):
+        if self.shebang_end is None:
+            return None
+        return self.text[:self.shebang_end]
+
+    @property
+    def has_directives(self):
+        return self.header_end > self.header_start
+
+    @property
+    def header(self):
+        return self.text[self.header_start:self.header_end]
+
+    @property
+    def body(self):
+        return self.text[self.body_start:]
+
+    def lines(self, start = 0, end = None):
+        """lazily yields the lines in text[start:end]"""
+        return iter_lines(self.text, start, end)
+
+    def header_lines(self):
+        if not self.has_directives:
+            return iter(())
+        return self.lines(self.header_start, self.header_end)
+
+def iter_lines(text, start = 0, end = None):
+    """yields the lines of text[start:end] without splitting the whole text"""
+    if end is None:
+        end = len(text)
+    while True:
+        nl = text.find("\n", start, end)
+        if nl < 0:
+            yield text[start:end]
+            return
+        yield text[start:nl]
+        start = nl + 1
 
 def split_script(input_str):
     """splits script into shebang, pbs directives, and rest"""
-    lines = input_str.split("\n")
-    nlines = len(lines)
-    i = 0
-    if lines[0].startswith("#!"):
-        shebang = lines[0]
-        i = 1
-    else:
-        shebang = None
-    header = []
-    while True:
-        if i == nlines:
-            error("reached end of the file without finding any commands")
-            sys.exit(1)
-        if lines[i].startswith("#") or lines[i].strip() == "":
-            header.append(lines[i])
-            i += 1
-        else:
-            break
-    if not header:
-        return shebang, "", "\n".join(lines[i:])
-    if len([x for x in header if x.startswith("#PBS")]) > 0:
-        return shebang, "\n".join(header), "\n".join(lines[i:])
-    return shebang, "", "\n".join(header + lines[i:])
-
-def fix_env_vars(input_str):
-    """replace PBS environment variables with their SLURM equivalent"""
-    repl = {
-        "PBS_O_WORKDIR": "SLURM_SUBMIT_DIR",
-        "PBS_JOBID"    : "SLURM_JOB_ID",
-        "PBS_ARRAY_INDEX"  : "SLURM_ARRAY_TASK_ID"}
-    output = input_str
-    for pbs, slurm in repl.items():
-        output = output.replace(pbs, slurm)
-    return output
-
-def fix_jobname(pbs_directives):
-    """translates #PBS -N"""
-    j_re = re.compile(r'^#PBS[ \t]*-N[ \t]*(\S*)[^\n]*', re.M)
-    def _repl(m):
-        if m.group(1) == "":
-            warn("#PBS -N without argument -> dropped")
-        else:
-            return f'#SBATCH --job-name="{m.group(1)}"'
-    return j_re.sub(_repl, pbs_directives)
+    script = Script(input_str)
+    return script.shebang, script.header, script.body
+
+################################################################################
+# shell structure of the body
+################################################################################
+
+# tokens of a line of shell code that matter for finding here-documents:
+# quoted strings (skipped), here-strings (skipped), here-document operators,
+# and comments
+_shell_token_re = re.compile(r"""'[^'\n]*'|"(?:\\.|[^"\\\n])*"|<<<"""
+        r"""|(?P<heredoc><<(?P<dash>-?)[ \t]*(?P<delim>'[^'\n]*'|"[^"\n]*"|\\?[A-Za-z_][\w.-]*))"""
+        r"""|(?P<comment>(?:^|(?<=[ \t;&|()]))#.*)""")
+_keyword_re = re.compile(r'(?:^|[;&|()]|\b(?:then|do|else|elif)\b)[ \t]*'
+        r'(if|case|for|while|until|select|fi|esac|done)\b')
+_openers = {"if", "case", "for", "while", "until", "select"}
+_exit_re = re.compile(r'[ \t]*exit(?:[ \t]+\S+)?[ \t]*(?:#.*)?$')
+# a quote that is not closed on its line, and the end of a double quoted
+# string that continues from an earlier line
+_open_quote_re = re.compile(r'''(?<!\\)["']''')
+_dquote_end_re = re.compile(r'(?:\\.|[^"\\])*"')
+
+def _heredoc_end(text, pos, delim, strip_tabs):
+    """returns (payload end, position after the terminator line) for a
+    here-document whose payload starts at pos"""
+    if strip_tabs:
+        m = re.compile(r'^\t*' + re.escape(delim) + r'$', re.M).search(text, pos)
+        if m is None:
+            return len(text), len(text)
+        return m.start(), m.end() + 1
+    # the payload is preceded by a newline, so the terminator is always
+    # found as "\n" + delim
+    needle = "\n" + delim
+    i = text.find(needle, pos - 1)
+    while i >= 0:
+        end = i + len(needle)
+        if end == len(text) or text[end] == "\n":
+            return i + 1, end + 1
+        i = text.find(needle, end)
+    return len(text), len(text)
+
+def _code_only(line):
+    """line with quoted strings and here-document operators blanked out and
+    comments removed, so that keywords and braces in them are not counted"""
+    if not any(c in line for c in "'\"#<"):
+        return line
+    out = []
+    pos = 0
+    for m in _shell_token_re.finditer(line):
+        out.append(line[pos:m.start()])
+        if m.group("comment") is not None:
+            return "".join(out)
+        out.append("_" * (m.end() - m.start()))
+        pos = m.end()
+    out.append(line[pos:])
+    return "".join(out)
+
+def shell_segments(text, cuts = None):
+    """splits the body of a script into segments (start, end, kind):
+        code     shell code
+        text     payload of an unquoted here-document; variables are expanded
+        literal  payload of a quoted here-document (<<'EOF', <<"EOF", <<\EOF)
+        data     everything after a top level exit
+    Here-document payloads and data are skipped with a delimiter search
+    rather than being scanned line by line. Adjacent segments of the same
+    kind are merged. If cuts is a list, the offsets of blank lines at the
+    top level (outside of compound commands and here-documents, and before
+    any top level exit) are appended to it. An exit is only taken to be at
+    the top level if it is a command of its own: not in a compound command,
+    subshell or multi-line string, and not continued from the line before
+    (||, &&, | or \\)"""
+    n = len(text)
+    if cuts is None and "<<" not in text and "exit" not in text:
+        if n:
+            yield 0, n, "code"
+        return
+    seg_start, seg_kind = 0, "code"
+    def switch(pos, kind):
+        nonlocal seg_start, seg_kind
+        if kind != seg_kind:
+            if pos > seg_start:
+                yield seg_start, pos, seg_kind
+            seg_start, seg_kind = pos, kind
+    # nesting depth is only needed to tell a top level exit from one in a
+    # function or conditional (or to find cuts); otherwise jump from one
+    # here-document operator to the next
+    track_exit = "exit" in text
+    track_depth = track_exit or cuts is not None
+    depth = 0
+    # open ( subshells, the quote of a string that continues on the next
+    # line, and whether the next line continues the command of this one
+    parens = 0
+    quote = None
+    continued = False
+    pos = 0
+    while pos < n:
+        if not track_depth:
+            hd = text.find("<<", pos)
+            if hd < 0:
+                break
+            pos = text.rfind("\n", pos, hd) + 1 or pos
+        nl = text.find("\n", pos)
+        end = n if nl < 0 else nl
+        line = text[pos:end]
+        pending = []
+        top = not continued and parens == 0 and quote is None
+        if quote is not None and track_depth:
+            # the line continues a quoted string
+            if quote == "'":
+                close = line.find("'") + 1
+            else:
+                m = _dquote_end_re.match(line)
+                close = m.end() if m is not None else 0
+            if close == 0:
+                pos = end + 1
+                continue
+            line = " " * close + line[close:]
+            quote = None
+        if not line.lstrip().startswith("#"):
+            if "<<" in line:
+                for m in _shell_token_re.finditer(line):
+                    if m.group("comment") is not None:
+                        break
+                    if m.group("heredoc") is not None:
+                        delim = m.group("delim")
+                        quoted = delim[0] in "'\"\\"
+                        delim = delim[1:-1] if delim[0] in "'\"" else delim.lstrip("\\")
+                        pending.append((delim, m.group("dash") == "-", quoted))
+            if track_depth:
+                # unbalanced closers are ignored so that the depth at a cut
+                # is always 0, the depth a region starts with on its own
+                code = _code_only(line)
+                m = _open_quote_re.search(code)
+                if m is not None:
+                    quote = m.group()
+                    code = code[:m.start()]
+                parens = max(parens + code.count("(") - code.count(")"), 0)
+                tail = code.rstrip()
+                continued = quote is None and tail.endswith(("&&", "||", "|", "\\"))
+                for m in _keyword_re.finditer(code):
+                    depth = depth + 1 if m.group(1) in _openers else max(depth - 1, 0)
+                stripped = code.strip()
+                if stripped.endswith("{"):
+                    depth += 1
+                if stripped.startswith("}"):
+                    depth = max(depth - 1, 0)
+                if (cuts is not None and depth == 0 and top and stripped == ""
+                        and not pending):
+                    cuts.append(pos)
+                if (track_exit and depth == 0 and top and parens == 0
+                        and quote is None and "exit" in line
+                        and _exit_re.match(line) and nl >= 0):
+                    yield from switch(nl + 1, "data")
+                    break
+        pos = end + 1
+        for delim, strip_tabs, quoted in pending:
+            if pos > n:
+                break
+            payload_end, after = _heredoc_end(text, pos, delim, strip_tabs)
+            yield from switch(pos, "literal" if quoted else "text")
+            yield from switch(payload_end, "code")
+            pos = after
+    if n > seg_start:
+        yield seg_start, n, seg_kind
+
+def body_regions(text):
+    """splits the body of a script at top level blank lines into regions
+    (start, end) that convert the same on their own as in the whole body.
+    Everything from a top level exit on stays in the last region"""
+    cuts = []
+    for _ in shell_segments(text, cuts):
+        pass
+    bounds = [0] + cuts + [len(text)]
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
 
+def fix_env_vars(input_str, variables = None):
+    """replace PBS environment variables with their SLURM equivalent. Quoted
+    here-documents and data after a top level exit are left unchanged"""
+    if variables is None:
+        variables = load_rules()["variables"]
+    out = []
+    for start, end, kind in shell_segments(input_str):
+        chunk = input_str[start:end]
+        if kind in ("code", "text"):
+            for pbs, slurm in variables.items():
+                chunk = chunk.replace(pbs, slurm)
+        out.append(chunk)
+    return "".join(out)
 
-def fix_email_address(pbs_directives):
+# longest #PBS line that is translated. Longer lines are left unchanged
+# and reported, so the time spent on a header is bounded no matter how long
+# its (generated or malformed) lines are
+DIRECTIVE_MAX_LINE = 16384
+
+def tokenize_directive(line):
+    """splits a #PBS line into (option, argument) with the blanks around
+    the argument removed, or returns None if line is not a directive. Only
+    plain string operations are used, so this takes linear time"""
+    if not line.startswith("#PBS"):
+        return None
+    rest = line[4:].lstrip(" \t")
+    if len(rest) < 2 or rest[0] != "-" or rest[1] == "\n":
+        return None
+    return rest[1], rest[2:].strip(" \t")
+
+def _translate_lines(pbs_directives, opt, translate):
+    """replaces every '#PBS -opt' line of pbs_directives with
+    translate(argument, line); other lines are kept"""
+    out = []
+    for line in pbs_directives.split("\n"):
+        tok = tokenize_directive(line)
+        if tok is not None and tok[0] == opt:
+            line = translate(tok[1], line)
+        out.append(line)
+    return "\n".join(out)
+
+_email_re = re.compile(r'[\w.%+-]+@[\w.-]+\.[A-Za-z]{2,4}')
+
+def fix_email_address(pbs_directives, ctx = None):
     """translates #PBS -M"""
-    pbsm_re = re.compile(r'^#PBS[ \t]*-M[ \t]*\b(.*)\b[^\n]*', re.M)
-    pbsm_match = pbsm_re.search(pbs_directives)
-    def _repl(m):
-        if m.group(1) == "":
-            warn(f"#PBS -M without argument -> dropped {pbsm_match.group()}")
+    def _repl(argument, line):
+        if argument == "":
+            warn(f"#PBS -M without argument -> dropped {line}")
             return ""
-        all_adr = [x.strip() for x in m.group(1).split(",")]
+        all_adr = [x.strip() for x in argument.split(",")]
         valid_adr = []
         for adr in all_adr:
-            if re.match(r'[\w.%+-]+@[\w.-]+\.[A-Za-z]{2,4}', adr) is not None:
+            if _email_re.match(adr) is not None:
                 valid_adr.append(adr)
         if len(valid_adr) == 0:
             warn(f"email address may be invalid: '{all_adr[0]}'")
@@ -113,14 +442,20 @@ def fix_email_address(pbs_directives):
         else:
             use_adr = valid_adr[0]
         return f'#SBATCH --mail-user="{use_adr}"'
-    return pbsm_re.sub(_repl, pbs_directives)
-
-def fix_email_mode(pbs_directives):
-    """translates #PBS -m"""
-    pbsm_re = re.compile(r'^#PBS[ \t]*-m[ \t]*([aben]{0,4})[^\n]*', re.M)
-    def _repl(m):
-        # n takes precedence if it's present
-        pbs_events = m.group(1)
+    return _translate_lines(pbs_directives, "M", _repl)
+
+def fix_email_mode(pbs_directives, ctx = None):
+    """translates #PBS -m. PBS sends mail for a job array as a whole; so
+    does slurm unless ARRAY_TASKS is added, which the site policy may allow
+    for arrays of up to array_task_mail_limit tasks"""
+    def _repl(argument, line):
+        # up to 4 events at the start of the argument; n takes precedence
+        # if it's present
+        pbs_events = argument[:4]
+        for i, c in enumerate(pbs_events):
+            if c not in "aben":
+                pbs_events = pbs_events[:i]
+                break
         if "n" in pbs_events or pbs_events == "":
             info("#PBS -m n is the default in slurm -> dropped")
             return ""
@@ -132,154 +467,1803 @@ def fix_email_mode(pbs_directives):
         if "e" in pbs_events:
             slurm_events.append("END")
         slurm_events.sort()
+        if ctx is not None and ctx["array"] is not None:
+            slurm_events.extend(_array_mail_events(ctx))
         return f"#SBATCH --mail-type={','.join(slurm_events)}"
-    return pbsm_re.sub(_repl, pbs_directives)
-
-
-def fix_stdout_stderr(pbs_directives):
-    """translates #PBS -o, #PBS -e, #PBS -j, and #PBS -k"""
-    out_re = re.compile(r'^#PBS[ \t]*-o[ \t]*(\S*)[^\n]*', re.M)
-    err_re = re.compile(r'^#PBS[ \t]*-e[ \t]*(\S*)[^\n]*', re.M)
-    join_re = re.compile(r'^#PBS[ \t]*-j[ \t]*(\S{0,4})[^\n]*', re.M)
-    keep_re = re.compile(r'^#PBS[ \t]*-k[ \t]*(\S{0,4})[^\n]*', re.M)
-    # remove the -k directive
-    def _repl(m):
-        info("#PBS -k is not needed in slurm -> dropped")
-        return ""
-    pbs_directives = keep_re.sub(_repl, pbs_directives)
-    # remove the -j directive
-    def _repl(m):
-        info("#PBS -j is the default in slurm -> dropped")
-        return ""
-    pbs_directives = join_re.sub(_repl, pbs_directives)
-    # change the -o directive
-    def _repl(m):
-        if m.group(1) == "":
-            warn("#PBS -o without argument -> dropped")
-            return ""
-        else:
-            return f"#SBATCH --output={m.group(1)}"
-    pbs_directives = out_re.sub(_repl, pbs_directives)
-    # change the -e directive
-    def _repl(m):
-        if m.group(1) == "":
-            warn("#PBS -e without argument -> dropped")
-            return ""
-        return f"#SBATCH --error={m.group(1)}"
-    pbs_directives = err_re.sub(_repl, pbs_directives)
-    return pbs_directives
-
-def fix_restartable(pbs_directives):
-    """translate #PBS -r; PBS default is 'y'"""
-    r_re = re.compile(r'^#PBS[ \t]*-r[ \t]*(\S*)[^\n]*', re.M)
-    def _repl(m):
-        if m.group(1) == "":
-            warn("#PBS -r without argument -> dropped")
-            return ""
-        elif "y" == m.group(1):
-            return "#SBATCH --requeue"
-        elif "n" == m.group(1):
-            return "#SBATCH --no-requeue"
-        else:
-            return ""
-    return r_re.sub(_repl, pbs_directives)
+    return _translate_lines(pbs_directives, "m", _repl)
 
-def fix_shell(pbs_directives):
-    """drop #PBS -S"""
-    s_re = re.compile(r'^#PBS[ \t]*-S[ \t]*(\S*)[^\n]*', re.M)
-    def _repl(m):
-        info("#PBS -S: slurm uses #! to determine shell -> dropped")
-        return ""
-    return s_re.sub(_repl, pbs_directives)
+def _array_mail_events(ctx):
+    """the mail events added for a job array; every decision is reported"""
+    policy = ctx["policy"]
+    size = ctx["array_size"]
+    if not policy["array_task_mail"]:
+        info("#PBS -m in a job array: mail is sent for the array as a whole, not per task")
+        return []
+    limit = policy["array_task_mail_limit"]
+    if size is None or size > limit:
+        what = "an unknown number of" if size is None else size
+        warn(f"#PBS -m in a job array of {what} tasks: over array_task_mail_limit "
+                f"({limit}) -> mail is sent for the array as a whole")
+        return []
+    info(f"#PBS -m in a job array of {size} tasks: mail is sent for every task")
+    return ["ARRAY_TASKS"]
 
-def fix_variable_export(pbs_directives):
+def fix_variable_export(pbs_directives, ctx = None):
     """translate #PBS -V and -v"""
-    V_re = re.compile(r'^#PBS[ \t]*-V[^\n]*', re.M)
-    pbs_directives = V_re.sub("#SBATCH --export=ALL", pbs_directives)
-    v_re = re.compile(r'^#PBS[ \t]*-v[ \t]*([ \t,=\S]*)[ \t]*', re.M)
-    def _repl(m):
-        if m.group(1) == "":
+    pbs_directives = _translate_lines(pbs_directives, "V",
+            lambda argument, line: "#SBATCH --export=ALL")
+    def _repl(argument, line):
+        if argument == "":
             warn("#PBS -v withouot arguments -> dropped")
             return ""
-        return f"#SBATCH --export={''.join(m.group(1).split())}"
-    return v_re.sub(_repl, pbs_directives)
-
-def fix_jobarray(pbs_directives):
-    """translate #PBS -J"""
-    j_re = re.compile(r'^#PBS[ \t]*-J[ \t]*([-0-9]*)[^\n]*', re.M)
-    def _repl(m):
-        if m.group(1) == "":
-            warn("#PBS -J without argument -> dropped")
+        return f"#SBATCH --export={''.join(argument.split())}"
+    return _translate_lines(pbs_directives, "v", _repl)
+
+def fix_checkpoint(pbs_directives, ctx = None):
+    """translates #PBS -c. Slurm doesn't checkpoint jobs, so a job that asks
+    for checkpoints is sent USR1 checkpoint_lead seconds before its time
+    limit and may be requeued (after preemption, or by the trap). If the site policy names the
+    checkpoint_command of the application, a trap that runs it when the
+    signal arrives is added to the start of the body"""
+    policy = POLICY if ctx is None else ctx["policy"]
+    def _repl(argument, line):
+        # PBS Pro: n, s, c, c=minutes, w, w=minutes, u; Torque: none,
+        # enabled, shutdown, periodic, interval=minutes, depth=n, dir=path
+        options = [a.strip() for a in argument.split(",") if a.strip()]
+        if all(o in ("n", "u", "none") for o in options):
+            info("#PBS -c n: no checkpoints -> dropped")
             return ""
-        return f"#SBATCH --array={m.group(1)}"
-    return j_re.sub(_repl, pbs_directives)
+        lead = policy["checkpoint_lead"]
+        walltime = None if ctx is None else ctx["walltime"]
+        if walltime is not None and lead >= walltime:
+            lead = walltime // 2
+            info(f"#PBS -c: checkpoint_lead is longer than the walltime -> "
+                    f"signal {lead}s before the end")
+        for o in options:
+            key, _, minutes = o.partition("=")
+            if key in ("c", "w", "interval") and minutes:
+                info(f"#PBS -c {o}: slurm doesn't checkpoint at intervals -> "
+                        f"the job is signaled {lead}s before it ends instead")
+        out = [f"#SBATCH --signal=B:USR1@{lead}"]
+        if ctx is not None and ctx["rerunnable"] is False:
+            warn("#PBS -c with #PBS -r n: the job is signaled but not requeued")
+        else:
+            out.append("#SBATCH --requeue")
+        command = policy["checkpoint_command"]
+        shell = None if ctx is None else ctx["shell"]
+        if command and shell is not None and shell not in PACKING_SHELLS:
+            warn(f"#PBS -c: can't add a checkpoint trap to a {shell} script")
+        elif command:
+            # the shell runs the trap only when the command in the
+            # foreground ends, which may be long after the signal
+            body_prologue("# the USR1 trap runs when the current command ends: "
+                    "start long running programs with 'app & wait'")
+            body_prologue(policy["checkpoint_trap"].replace("{}", command))
+            info(f"#PBS -c -> '{command}' runs when the job is signaled (USR1); "
+                    "the trap only runs after the foreground command ends, so "
+                    "long running programs need to run as 'app & wait'")
+        else:
+            warn(f"#PBS -c -> the job is sent USR1 {lead}s before its time limit; "
+                    "the script has to checkpoint when it arrives")
+        return "\n".join(out)
+    return _translate_lines(pbs_directives, "c", _repl)
+
+_walltime_item_re = re.compile(r'\bwalltime=(\d+:\d+:\d+)')
 
-def fix_resource_list(pbs_directives):
+def resource_items(argument):
+    """the (key, value) items of the argument of #PBS -l. Only the first
+    walltime is kept, and a walltime that is joined to another resource
+    with ':' (nodes=1:ppn=2:walltime=1:00:00) is an item of its own"""
+    items = []
+    walltime = False
+    for item in argument.split(","):
+        key, _, value = item.strip().partition("=")
+        if key == "walltime":
+            if walltime:
+                continue
+            walltime = True
+        items.append((key, value))
+    if not walltime:
+        m = _walltime_item_re.search(argument)
+        if m is not None:
+            items.append(("walltime", m.group(1)))
+    return items
+
+def fix_resource_list(pbs_directives, resources = None, ctx = None):
     """resource lists were very complicated in the qsub wrapper, which would
     have overridden the resource lists specified in pbs directives. This
-    function only looks for walltime and prints a warning"""
-    l_re = re.compile(r'^#PBS[ \t]*-l[ \t]*\b([\S:=, \t]*)\b[^\n]*', re.M)
-    l_m  = l_re.search(pbs_directives)
-    wt_re = re.compile(r'walltime=(\d+):(\d+):(\d+)')
-    if l_m is not None:
-        def _repl(m):
-            resources = m.group(1)
-            if not "walltime" in resources:
-                return ""
-            wt_m = wt_re.search(resources)
-            if wt_m is None:
-                return ""
-            h = wt_m.group(1)
-            m = wt_m.group(2)
-            if len(m) == 1:
-                m += "0"
-            elif len(m) > 2:
-                return ""
-            s = wt_m.group(3)
-            if len(s) == 1:
-                s += "0"
-            elif len(s) > 2:
-                return ""
-            return f"#SBATCH --time={h}:{m}:{s}"
-        pbs_directives = l_re.sub(_repl, pbs_directives)
-   
-    return pbs_directives
-
-
-def fix_queue(pbs_directives):
-    """drop all occurences of -q"""
-    q_re = re.compile(r'^#PBS[ \t]*-q[^\n]*', re.M)
-    if q_re.search(pbs_directives) is not None:
-        info("dropping #PBS -q directive(s)")
-        return q_re.sub("", pbs_directives)
-    return pbs_directives
+    function only translates the resources that have a translator in the
+    rule table and drops everything else"""
+    if resources is None:
+        resources = load_rules()["resources"]
+    def _repl(argument, line):
+        out = []
+        items = resource_items(argument)
+        # the number of nodes of select, from this line or the header
+        nodes = None if ctx is None else ctx["select_nodes"]
+        for key, value in items:
+            if key in resources and resources[key][0] == "select":
+                nodes = select_nodes(value)
+        for key, value in items:
+            if key not in resources:
+                continue
+            if key == "walltime" and ctx is not None and ctx["pack"] is not None:
+                # a packed array task runs several tasks one after the other
+                value = _hms(ctx["pack"].walltime)
+            handler, options = resources[key]
+            translated = RESOURCE_HANDLERS[handler](value, **options)
+            if translated is not None and handler == "place" and nodes is not None \
+                    and "#SBATCH --nodes=1" in translated.split("\n"):
+                # select already sets --nodes; of two the last one would win
+                if nodes > 1:
+                    warn(f"#PBS -l place={value} with select of {nodes} chunks: slurm "
+                            "places each chunk on its own node -> --nodes=1 dropped")
+                translated = "\n".join(t for t in translated.split("\n")
+                        if t != "#SBATCH --nodes=1") or None
+            if translated is not None:
+                # several keys may ask for the same thing (e.g. --exclusive)
+                out.extend(t for t in translated.split("\n") if t not in out)
+        return "\n".join(out)
+    return _translate_lines(pbs_directives, "l", _repl)
+
+def resource_walltime(value):
+    """translates walltime=h:mm:ss"""
+    wt_m = re.match(r'(\d+):(\d+):(\d+)', value)
+    if wt_m is None:
+        return None
+    h = wt_m.group(1)
+    m = wt_m.group(2)
+    if len(m) == 1:
+        m += "0"
+    elif len(m) > 2:
+        return None
+    s = wt_m.group(3)
+    if len(s) == 1:
+        s += "0"
+    elif len(s) > 2:
+        return None
+    return f"#SBATCH --time={h}:{m}:{s}"
+
+_size_re = re.compile(r'(\d+)(b|kb|mb|gb|tb)?$', re.I)
+
+def pbs_size(value):
+    """converts a PBS size (e.g. 100gb) to a slurm size (100G). Returns None
+    for sizes in words or that can't be parsed"""
+    m = _size_re.match(value)
+    if m is None:
+        return None
+    n, unit = int(m.group(1)), (m.group(2) or "b").lower()
+    if unit == "b":
+        # slurm sizes default to megabytes
+        return f"{-(-n // (1024 * 1024))}M"
+    return f"{n}{unit[0].upper()}"
+
+_select_chunk_re = re.compile(r'\d*(:\w+=[^:]*)*$')
+
+def _parse_chunk(spec):
+    """splits a chunk of a select statement into (count, resources)"""
+    parts = spec.split(":")
+    count = int(parts.pop(0)) if parts[0].isdigit() else 1
+    res = {}
+    for part in parts:
+        key, _, val = part.partition("=")
+        res[key] = val
+    return count, res
 
+def _chunk_cpus_per_task(res):
+    ncpus = int(res.get("ncpus", "1") or 1)
+    mpiprocs = int(res.get("mpiprocs", "1") or 1)
+    threads = res.get("ompthreads")
+    return int(threads) if threads else max(ncpus // mpiprocs, 1)
 
+def select_nodes(value):
+    """the number of nodes (chunks) of -l select=value, or None if it can't
+    be parsed"""
+    if not all(_select_chunk_re.match(spec) for spec in value.split("+")):
+        return None
+    return sum(_parse_chunk(spec)[0] for spec in value.split("+"))
+
+def select_cpus_per_task(value):
+    """the cpus per task that -l select=value is translated to, or None if
+    it can't be parsed or its chunks differ"""
+    cpus = set()
+    for spec in value.split("+"):
+        if not _select_chunk_re.match(spec):
+            return None
+        try:
+            cpus.add(_chunk_cpus_per_task(_parse_chunk(spec)[1]))
+        except ValueError:
+            return None
+    return cpus.pop() if len(cpus) == 1 else None
+
+def _select_chunk(spec):
+    """translates one chunk of a select statement into a tuple of sbatch
+    options. Returns (count, options, uses_openmp)"""
+    count, res = _parse_chunk(spec)
+    cpus_per_task = _chunk_cpus_per_task(res)
+    res.pop("ncpus", None)
+    mpiprocs = int(res.pop("mpiprocs", "1") or 1)
+    threads = res.pop("ompthreads", None)
+    options = [f"--ntasks-per-node={mpiprocs}", f"--cpus-per-task={cpus_per_task}"]
+    if "mem" in res:
+        mem = pbs_size(res.pop("mem"))
+        if mem is not None:
+            options.append(f"--mem={mem}")
+    if "ngpus" in res:
+        options.append(f"--gpus-per-node={res.pop('ngpus')}")
+    for key in res:
+        warn(f"#PBS -l select: chunk resource '{key}' has no slurm equivalent -> dropped")
+    return count, tuple(options), threads is not None
+
+def resource_select(value):
+    """translates PBS Pro select=N:ncpus=..:mpiprocs=..:ompthreads=..:mem=..
+    with one node per chunk. Identical chunks are merged; different chunks
+    ('+') become the components of a heterogeneous job; the first one takes
+    the job-wide options of the header and the others are added after the
+    header. If ompthreads is given, OMP_NUM_THREADS is set from the cpus per
+    task in the body"""
+    groups = collections.OrderedDict()
+    openmp = False
+    for spec in value.split("+"):
+        if not _select_chunk_re.match(spec):
+            warn(f"#PBS -l select={value} can't be parsed -> dropped")
+            return None
+        count, options, threads = _select_chunk(spec)
+        groups[options] = groups.get(options, 0) + count
+        openmp = openmp or threads
+    components = [[f"--nodes={count}", *options] for options, count in groups.items()]
+    info(f"#PBS -l select={value} -> "
+            + " : ".join(" ".join(c) for c in components))
+    if len(components) > 1:
+        info("#PBS -l select with different chunks -> heterogeneous job; "
+                "use srun --het-group to place tasks")
+    if openmp:
+        body_prologue("export OMP_NUM_THREADS=$SLURM_CPUS_PER_TASK")
+    lines = [f"#SBATCH {o}" for o in components[0]]
+    for c in components[1:]:
+        component = "\n".join(["#SBATCH hetjob", *(f"#SBATCH {o}" for o in c)])
+        if not header_tail(component):
+            lines.append(component)
+    return "\n".join(lines)
+
+def resource_scratch(value, gres = None, unit = "G"):
+    """translates a request for local disk (e.g. file=200gb) to --tmp or, if
+    the site allocates local scratch as a generic resource, to
+    --gres=<gres>:<amount in unit>"""
+    size = pbs_size(value)
+    if size is None:
+        warn(f"#PBS -l disk request '{value}' can't be parsed -> dropped")
+        return None
+    if gres is None:
+        return f"#SBATCH --tmp={size}"
+    # round up to whole units
+    kib = int(size[:-1]) * 1024 ** "KMGT".index(size[-1])
+    unit_kib = 1024 ** "KMGT".index(unit.upper())
+    return f"#SBATCH --gres={gres}:{-(-kib // unit_kib)}"
+
+# place=[arrangement][:sharing][:group=resource]
+_place_options = {
+    "free": (),
+    "pack": ("--nodes=1",),
+    "scatter": ("--spread-job",),
+    "vscatter": ("--spread-job",),
+    "excl": ("--exclusive",),
+    "exclhost": ("--exclusive",),
+    "shared": (),
+    "group=switch": ("--switches=1",),
+}
+
+def resource_place(value):
+    """translates PBS Pro place=arrangement:sharing:grouping. Every mapping
+    is reported so that the layout of the job can be checked"""
+    flags = []
+    known = True
+    for part in value.split(":"):
+        if part not in _place_options:
+            warn(f"#PBS -l place: '{part}' has no slurm equivalent -> dropped")
+            known = False
+            continue
+        flags.extend(f for f in _place_options[part] if f not in flags)
+    if not flags:
+        if known:
+            info(f"#PBS -l place={value} is the slurm default -> dropped")
+        return None
+    info(f"#PBS -l place={value} -> {' '.join(flags)}")
+    return "\n".join(f"#SBATCH {f}" for f in flags)
+
+_node_access_policies = {
+    "shared": None,
+    "singlejob": "--exclusive",
+    "singletask": "--exclusive",
+    "singleuser": "--exclusive=user",
+}
+
+def resource_node_access(value):
+    """translates the Torque/Moab naccesspolicy resource"""
+    if value not in _node_access_policies:
+        warn(f"#PBS -l naccesspolicy={value} has no slurm equivalent -> dropped")
+        return None
+    flag = _node_access_policies[value]
+    if flag is None:
+        info(f"#PBS -l naccesspolicy={value} is the slurm default -> dropped")
+        return None
+    info(f"#PBS -l naccesspolicy={value} -> {flag}")
+    return f"#SBATCH {flag}"
 
 
 ################################################################################
-# main conversion function
+# rule table
 ################################################################################
 
-def convert_batch_script(pbs, interpreter = "/bin/bash"):
-    shebang, pbs_directives, commands = split_script(pbs)
-    if shebang is None:
-        shebang = "#! {}".format(interpreter)
-    commands = fix_env_vars(commands)
-    if pbs_directives != "":
-        pbs_directives = fix_jobname(pbs_directives)
-        pbs_directives = fix_email_address(pbs_directives)
-        pbs_directives = fix_email_mode(pbs_directives)
-        pbs_directives = fix_stdout_stderr(pbs_directives)
-        pbs_directives = fix_restartable(pbs_directives)
-        pbs_directives = fix_shell(pbs_directives)
-        pbs_directives = fix_variable_export(pbs_directives)
-        pbs_directives = fix_jobarray(pbs_directives)
-        pbs_directives = fix_resource_list(pbs_directives)
-        pbs_directives = fix_queue(pbs_directives)
-        return "{}\n{}\n{}".format(shebang, pbs_directives, commands)
+# translators that can be referenced by name from rule files
+DIRECTIVE_HANDLERS = {
+    "email_address"  : fix_email_address,
+    "email_mode"     : fix_email_mode,
+    "variable_export": fix_variable_export,
+    "checkpoint"     : fix_checkpoint,
+    "resource_list"  : fix_resource_list,
+}
+RESOURCE_HANDLERS = {
+    "walltime": resource_walltime,
+    "select": resource_select,
+    "scratch": resource_scratch,
+    "place": resource_place,
+    "node_access": resource_node_access,
+}
+DIAGNOSTICS = {"info": info, "warn": warn, "error": error}
+
+DEFAULT_RULES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "pbs2slurm_rules.toml")
+# bump when the layout of the compiled rule table changes
+RULES_FORMAT = 11
+# site policy settings and their defaults. Rule files change them in
+# [policy] and pbs2slurm --policy overrides the rule file
+POLICY = {
+    # add ARRAY_TASKS to the mail events of job arrays
+    "array_task_mail": False,
+    # ... but only for arrays of up to this many tasks
+    "array_task_mail_limit": 100,
+    # run several tasks of job arrays with short tasks in each array task
+    "array_packing": False,
+    # ... if the walltime of a task is below this many seconds
+    "array_packing_below": 60,
+    # ... with as many tasks as fit into this many seconds
+    "array_packing_walltime": 1800,
+    # translate #PBS -V to an export of the variables the body uses
+    "minimal_export": False,
+    # ... and of these variables
+    "export_always": ["HOME", "LANG", "PATH", "USER"],
+    # ... and of these variables if the body uses the module command
+    "export_modules": ["MODULEPATH", "MODULESHOME", "LOADEDMODULES", "_LMFILES_",
+            "BASH_FUNC_module%%", "BASH_FUNC_ml%%", "LMOD_CMD", "LMOD_DIR",
+            "LMOD_PKG", "LMOD_ROOT", "LMOD_VERSION", "LMOD_sys"],
+    # rewrite qstat polling loops and qstat/qdel calls in the body
+    "job_control": False,
+    # ... with these options for the job that waits for another job
+    "wait_options": "--time=1 --output=/dev/null",
+    # #PBS -c: signal the job this many seconds before it ends
+    "checkpoint_lead": 300,
+    # ... and run this command when the signal arrives (none if empty)
+    "checkpoint_command": "",
+    # ... with this trap; {} is replaced by the command
+    "checkpoint_trap": "trap '{}; scontrol requeue $SLURM_JOB_ID' USR1",
+    # compare the thread counts of tools in the body with the cpus per task
+    "thread_check": False,
+    # ... and change the counts that don't match to $SLURM_CPUS_PER_TASK
+    "thread_rewrite": False,
+}
+
+# the rules of pbs2slurm_rules.toml (without [policy], which has the
+# defaults above) for installs without the rule file or without a toml
+# parser. test_builtin_rules keeps the two the same
+BUILTIN_RULES = {
+    "variables": {
+        "PBS_O_WORKDIR": "SLURM_SUBMIT_DIR",
+        "PBS_JOBID": "SLURM_JOB_ID",
+        "PBS_ARRAY_INDEX": "SLURM_ARRAY_TASK_ID",
+        "PBS_JOBDIR": "TMPDIR",
+    },
+    "directives": {
+        "N": {"template": '#SBATCH --job-name="{}"',
+                "missing": {"warn": "#PBS -N without argument -> dropped"}},
+        "M": {"handler": "email_address"},
+        "m": {"handler": "email_mode"},
+        "k": {"drop": {"info": "#PBS -k is not needed in slurm -> dropped"},
+                "equivalent": True},
+        "j": {"drop": {"info": "#PBS -j is the default in slurm -> dropped"},
+                "equivalent": True},
+        "o": {"template": "#SBATCH --output={}",
+                "missing": {"warn": "#PBS -o without argument -> dropped"}},
+        "e": {"template": "#SBATCH --error={}",
+                "missing": {"warn": "#PBS -e without argument -> dropped"}},
+        "r": {"values": {"y": "#SBATCH --requeue", "n": "#SBATCH --no-requeue"},
+                "missing": {"warn": "#PBS -r without argument -> dropped"}},
+        "S": {"drop": {"info": "#PBS -S: slurm uses #! to determine shell -> dropped"},
+                "equivalent": True},
+        "V": {"template": "#SBATCH --export=ALL"},
+        "v": {"handler": "variable_export"},
+        "J": {"template": "#SBATCH --array={}", "argument": "[-0-9]*",
+                "missing": {"warn": "#PBS -J without argument -> dropped"}},
+        "t": {"template": "#SBATCH --array={}", "argument": "[-0-9,:%]*",
+                "missing": {"warn": "#PBS -t without argument -> dropped"}},
+        "c": {"handler": "checkpoint"},
+        "l": {"handler": "resource_list"},
+        "q": {"drop": {"info": "dropping #PBS -q directive(s)"}, "once": True},
+    },
+    "resources": {
+        "walltime": "walltime",
+        "select": "select",
+        "file": "scratch",
+        "place": "place",
+        "naccesspolicy": "node_access",
+    },
+    "threads": {
+        "variables": ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"],
+        "tools": {
+            "bwa": ["-t"],
+            "bowtie2": ["-p", "--threads"],
+            "hisat2": ["-p", "--threads"],
+            "STAR": ["--runThreadN"],
+            "samtools": ["-@", "--threads"],
+            "bcftools": ["--threads"],
+            "blastn": ["-num_threads"],
+            "blastp": ["-num_threads"],
+            "blastx": ["-num_threads"],
+            "tblastn": ["-num_threads"],
+            "diamond": ["-p", "--threads"],
+            "salmon": ["-p", "--threads"],
+            "kallisto": ["-t", "--threads"],
+            "featureCounts": ["-T"],
+            "minimap2": ["-t"],
+            "spades.py": ["-t", "--threads"],
+            "pigz": ["-p", "--processes"],
+        },
+    },
+}
+
+_loaded_rules = {}
+_default_rules = None
+
+def rules_cache_dir():
+    """directory for compiled rule tables"""
+    if "PBS2SLURM_CACHE" in os.environ:
+        return os.environ["PBS2SLURM_CACHE"]
+    base = os.environ.get("XDG_CACHE_HOME",
+            os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "pbs2slurm")
+
+def _rule_diagnostic(where, spec):
+    """validates a {level = message} table"""
+    if len(spec) != 1:
+        error(f"{where}: expected exactly one of {', '.join(DIAGNOSTICS)}")
+        sys.exit(1)
+    level, msg = next(iter(spec.items()))
+    if level not in DIAGNOSTICS:
+        error(f"{where}: unknown diagnostic level '{level}'")
+        sys.exit(1)
+    return level, msg
+
+def compile_rules(raw, digest = ""):
+    """compiles a parsed rule file into the dispatch table used by
+    convert_batch_script. The table only contains plain data and compiled
+    regular expressions so that it can be pickled"""
+    variables = dict(raw.get("variables", {}))
+    directives = {}
+    for opt, spec in raw.get("directives", {}).items():
+        where = f"directives.{opt}"
+        if len(opt) != 1:
+            error(f"{where}: directives are single letters")
+            sys.exit(1)
+        rule = {"once": bool(spec.get("once", False)), "missing": None,
+                "equivalent": bool(spec.get("equivalent", False))}
+        if "missing" in spec:
+            rule["missing"] = _rule_diagnostic(where + ".missing", spec["missing"])
+        kinds = [k for k in ("template", "values", "drop", "handler") if k in spec]
+        if len(kinds) != 1:
+            error(f"{where}: expected exactly one of template, values, drop, handler")
+            sys.exit(1)
+        kind = rule["kind"] = kinds[0]
+        if kind in ("template", "values"):
+            # matched against the start of the argument of the directive
+            rule["argument"] = re.compile(spec.get("argument", r"\S*"))
+            if kind == "template":
+                rule["template"] = spec["template"]
+            else:
+                rule["values"] = dict(spec["values"])
+                rule["other"] = spec.get("other", "")
+        elif kind == "drop":
+            rule["drop"] = _rule_diagnostic(where + ".drop", spec["drop"])
+        else:
+            if spec["handler"] not in DIRECTIVE_HANDLERS:
+                error(f"{where}: unknown handler '{spec['handler']}'")
+                sys.exit(1)
+            rule["handler"] = spec["handler"]
+        directives[opt] = rule
+    resources = {}
+    for key, spec in raw.get("resources", {}).items():
+        # either the name of a handler or a table with the handler and its
+        # options
+        options = {}
+        if isinstance(spec, dict):
+            options = dict(spec)
+            spec = options.pop("handler", None)
+        if spec not in RESOURCE_HANDLERS:
+            error(f"resources.{key}: unknown handler '{spec}'")
+            sys.exit(1)
+        try:
+            inspect.signature(RESOURCE_HANDLERS[spec]).bind("", **options)
+        except TypeError:
+            error(f"resources.{key}: unexpected options for handler '{spec}'")
+            sys.exit(1)
+        unit = str(options.get("unit", "G"))
+        if spec == "scratch" and unit.upper() not in ("K", "M", "G", "T"):
+            error(f"resources.{key}: unknown unit '{unit}'")
+            sys.exit(1)
+        resources[key] = (spec, options)
+    policy = dict(POLICY)
+    for key, value in raw.get("policy", {}).items():
+        policy[key] = _policy_setting(f"policy.{key}", key, value)
+    return {"format": RULES_FORMAT, "digest": digest, "variables": variables,
+            "directives": directives, "resources": resources, "policy": policy,
+            "threads": _compile_threads(raw.get("threads", {}))}
+
+def _policy_setting(where, key, value):
+    """validates a policy setting. Strings (from the command line) are
+    converted to the type of the default"""
+    if key not in POLICY:
+        error(f"{where}: unknown policy setting")
+        sys.exit(1)
+    default = POLICY[key]
+    if isinstance(value, str) and not isinstance(default, str):
+        if isinstance(default, list):
+            value = [v for v in value.split(",") if v]
+        elif isinstance(default, bool):
+            value = {"true": True, "false": False}.get(value.lower(), value)
+        elif value.isdigit():
+            value = int(value)
+    if type(value) is not type(default) or (isinstance(value, list)
+            and not all(isinstance(v, str) for v in value)):
+        error(f"{where}: expected {type(default).__name__}")
+        sys.exit(1)
+    return value
+
+def with_policy(rules, settings):
+    """returns a copy of a rule table with the policy changed by settings
+    ('key=value' strings). The copy gets its own digest so that memoized
+    translations made under the old policy are not used"""
+    if not settings:
+        return rules
+    policy = dict(rules["policy"])
+    for setting in settings:
+        key, _, value = setting.partition("=")
+        policy[key] = _policy_setting(f"--policy {setting}", key, value)
+    digest = rules["digest"]
+    if digest:
+        digest = hashlib.sha256(f"{digest}\0{sorted(policy.items())}".encode()).hexdigest()
+    return dict(rules, policy = policy, digest = digest)
+
+_array_spec_re = re.compile(r'[-0-9,:%]+')
+
+def array_size(spec):
+    """number of tasks of a job array given as a list of indices and
+    ranges with optional step (1-99:2,200) and concurrency limit (%10).
+    None if the spec can't be parsed"""
+    size = 0
+    for part in spec.partition("%")[0].split(","):
+        part, _, step = part.partition(":")
+        first, dash, last = part.partition("-")
+        if not (first.isdigit() and (last if dash else first).isdigit()
+                and (step or "1").isdigit() and int(step or 1) > 0):
+            return None
+        size += max(0, (int(last or first) - int(first)) // int(step or 1) + 1)
+    return size
+
+_walltime_value_re = re.compile(r'(\d+):(\d+):(\d+)')
+
+def header_context(header, rules, shell = None, body = None):
+    """what the translators of single directives need to know about the
+    rest of the script: the job array ('array' spec and 'array_size', None
+    for other jobs), the 'walltime' in seconds, the site 'policy', how the
+    array is packed ('pack', see array_packing) or why it isn't
+    ('pack_note'), the variables a minimal export of the environment needs
+    ('export', see body_variables), whether the job may be requeued
+    ('rerunnable', None if the header doesn't say), the 'cpus_per_task' of
+    -l select (None unless all chunks have the same) and its number of
+    chunks ('select_nodes'), and the name of the
+    'shell' of the script"""
+    spec = walltime = rerunnable = cpus = nodes = None
+    export_all = False
+    for line in header.split("\n"):
+        tok = tokenize_directive(line)
+        if tok is None or len(line) > DIRECTIVE_MAX_LINE:
+            continue
+        opt, argument = tok
+        if opt in "Jt" and spec is None:
+            m = _array_spec_re.match(argument)
+            spec = None if m is None else m.group()
+        elif opt == "l":
+            for key, value in resource_items(argument):
+                w_m = _walltime_value_re.match(value) if key == "walltime" else None
+                if w_m is not None and walltime is None:
+                    h, mi, sec = (int(x) for x in w_m.groups())
+                    walltime = h * 3600 + mi * 60 + sec
+                elif key == "select" and cpus is None:
+                    cpus = select_cpus_per_task(value)
+                    nodes = select_nodes(value)
+        elif opt == "V":
+            export_all = True
+        elif opt == "r" and argument[:1] in ("y", "n"):
+            rerunnable = argument[:1] == "y"
+    ctx = {"array": spec, "array_size": None if spec is None else array_size(spec),
+            "walltime": walltime, "policy": rules["policy"], "pack": None,
+            "pack_note": None, "export": None, "rerunnable": rerunnable,
+            "cpus_per_task": cpus, "select_nodes": nodes, "shell": shell}
+    if spec is not None and walltime is not None and shell is not None:
+        ctx["pack"], ctx["pack_note"] = array_packing(spec, walltime,
+                rules["policy"], shell)
+        if ctx["pack"] is not None:
+            ctx["array_size"] = ctx["pack"].tasks
+    if body is not None and rules["policy"]["minimal_export"] and export_all:
+        ctx["export"] = body_variables(body, rules["variables"])
+    return ctx
+
+def load_rules(path = None):
+    """returns the compiled rule table for a rule file (by default the
+    built-in rules). Compiled tables are cached on disk keyed by the hash of
+    the rule file, so the file is only parsed when it changes. The built-in
+    rules are loaded once per process, from pbs2slurm_rules.toml next to
+    this module or, if it is missing or can't be parsed without a toml
+    parser, from BUILTIN_RULES"""
+    global _default_rules
+    if path is None:
+        if _default_rules is None:
+            if tomllib is not None and os.path.isfile(DEFAULT_RULES):
+                _default_rules = _load_rules_file(DEFAULT_RULES)
+            else:
+                digest = hashlib.sha256(b"%d\0builtin\0%r" % (RULES_FORMAT,
+                        BUILTIN_RULES)).hexdigest()
+                _default_rules = compile_rules(BUILTIN_RULES, digest)
+        return _default_rules
+    return _load_rules_file(path)
+
+def _load_rules_file(path):
+    try:
+        with open(path, "rb") as fh:
+            data = fh.read()
+    except OSError as e:
+        error(f"could not read rule file {path}: {e.strerror}")
+        sys.exit(1)
+    digest = hashlib.sha256(b"%d\0" % RULES_FORMAT + data).hexdigest()
+    if digest in _loaded_rules:
+        return _loaded_rules[digest]
+    cache_file = os.path.join(rules_cache_dir(), f"rules-{digest}.pickle")
+    try:
+        with open(cache_file, "rb") as fh:
+            rules = pickle.load(fh)
+    except Exception:
+        rules = None
+    if rules is None or rules.get("digest") != digest:
+        if tomllib is None:
+            error("reading rule files requires python >= 3.11 or the tomli package")
+            sys.exit(1)
+        try:
+            raw = tomllib.loads(data.decode("utf-8"))
+        except (UnicodeDecodeError, tomllib.TOMLDecodeError) as e:
+            error(f"could not parse rule file {path}: {e}")
+            sys.exit(1)
+        rules = compile_rules(raw, digest)
+        _save_rules(cache_file, rules)
+    _loaded_rules[digest] = rules
+    return rules
+
+def _save_rules(cache_file, rules):
+    """writes a compiled rule table atomically; a cache that can't be
+    written is not an error"""
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok = True)
+        fd, tmp = tempfile.mkstemp(dir = os.path.dirname(cache_file))
+        with os.fdopen(fd, "wb") as fh:
+            pickle.dump(rules, fh, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+    except OSError:
+        pass
+
+def translate_directive(line, rules, reported, ctx = None):
+    """translates a single #PBS line with the rule table. Lines without a
+    matching rule are returned unchanged. 'reported' collects the options
+    of 'once' rules that have already been reported for this script. ctx is
+    the header_context of the script, if known"""
+    tok = tokenize_directive(line)
+    if tok is None:
+        return line
+    opt, argument = tok
+    if len(line) > DIRECTIVE_MAX_LINE:
+        warn(f"#PBS -{opt} line of {len(line)} characters is too long to translate "
+                "-> left unchanged")
+        return line
+    if opt == "V" and ctx is not None and ctx["export"] is not None:
+        return minimal_export(ctx["export"], ctx["policy"])
+    if opt in "Jt" and ctx is not None and ctx["array"] is not None:
+        if ctx["pack"] is not None:
+            return packed_array(ctx["pack"])
+        if ctx["pack_note"] is not None:
+            info(ctx["pack_note"])
+    rule = rules["directives"].get(opt)
+    if rule is None:
+        return line
+    kind = rule["kind"]
+    if kind == "drop":
+        if not (rule["once"] and opt in reported):
+            level, msg = rule["drop"]
+            DIAGNOSTICS[level](msg)
+            reported.add(opt)
+        return ""
+    if kind == "handler":
+        if rule["handler"] == "resource_list":
+            return fix_resource_list(line, rules["resources"], ctx)
+        return DIRECTIVE_HANDLERS[rule["handler"]](line, ctx)
+    a_m = rule["argument"].match(argument)
+    if a_m is None:
+        return line
+    arg = a_m.group()
+    if arg == "" and rule["missing"] is not None:
+        level, msg = rule["missing"]
+        DIAGNOSTICS[level](msg)
+        return ""
+    if kind == "template":
+        return rule["template"].replace("{}", arg)
+    return rule["values"].get(arg, rule["other"])
+
+################################################################################
+# job array packing
+################################################################################
+
+# shells that run the loop of a packed array task
+PACKING_SHELLS = ("sh", "bash", "dash", "ksh", "zsh")
+
+Packing = collections.namedtuple("Packing",
+        "first last step limit factor tasks walltime")
+Packing.__doc__ = """original array indices first-last:step (and %limit),
+packed 'factor' indices per task into 'tasks' tasks of 'walltime' seconds"""
+
+_array_range_re = re.compile(r'(\d+)(?:-(\d+)(?::(\d+))?)?(?:%(\d+))?$')
+
+def _hms(seconds):
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+def shell_name(shebang):
+    """the name of the shell of a shebang line or interpreter path"""
+    words = shebang[2:].split() if shebang.startswith("#!") else shebang.split()
+    if not words:
+        return ""
+    name = os.path.basename(words[0])
+    if name == "env" and len(words) > 1:
+        name = os.path.basename(words[1])
+    return name
+
+def array_packing(spec, walltime, policy, shell):
+    """decides whether a job array (spec) of tasks with walltime seconds is
+    packed. Returns (Packing, None), or (None, note) with the reason why an
+    array of short tasks is not packed, or (None, None)"""
+    if not policy["array_packing"] or walltime >= policy["array_packing_below"]:
+        return None, None
+    m = _array_range_re.match(spec)
+    if m is None:
+        return None, f"job array {spec} is not a single range -> not packed"
+    if shell not in PACKING_SHELLS:
+        return None, f"job array of a {shell} script -> not packed"
+    first = int(m.group(1))
+    last = int(m.group(2) or first)
+    step = int(m.group(3) or 1)
+    limit = None if m.group(4) is None else int(m.group(4))
+    size = array_size(spec)
+    if not size:
+        return None, None
+    factor = min(size, policy["array_packing_walltime"] // max(walltime, 1))
+    if factor < 2:
+        return None, None
+    tasks = -(-size // factor)
+    return Packing(first, last, step, limit, factor, tasks, factor * walltime), None
+
+def packed_array(pack):
+    """the #SBATCH --array directive of a packed job array"""
+    info(f"job array {pack.first}-{pack.last}:{pack.step} of {_hms(pack.walltime // pack.factor)} "
+            f"tasks packed {pack.factor} tasks per array task -> {pack.tasks} "
+            f"tasks of {_hms(pack.walltime)}")
+    limit = "" if pack.limit is None else f"%{pack.limit}"
+    return f"#SBATCH --array=0-{pack.tasks - 1}{limit}"
+
+def packing_loop(pack):
+    """the shell code around the body of a packed array task. Returns
+    (start, end); the body runs once per original index in a subshell with
+    SLURM_ARRAY_TASK_ID set to the index"""
+    span = (pack.factor - 1) * pack.step
+    start = "\n".join((
+        f"# job array {pack.first}-{pack.last}:{pack.step} packed {pack.factor} "
+        f"tasks per array task",
+        "pbs2slurm_status=0",
+        f"pbs2slurm_first=$(({pack.first} + SLURM_ARRAY_TASK_ID * {pack.factor * pack.step}))",
+        f"pbs2slurm_last=$((pbs2slurm_first + {span}))",
+        f"[ $pbs2slurm_last -le {pack.last} ] || pbs2slurm_last={pack.last}",
+        f"for SLURM_ARRAY_TASK_ID in $(seq $pbs2slurm_first {pack.step} $pbs2slurm_last); do",
+        "export SLURM_ARRAY_TASK_ID",
+        "("))
+    end = "\n".join((
+        ")",
+        "[ $? -eq 0 ] || pbs2slurm_status=1",
+        "done",
+        "exit $pbs2slurm_status",
+        ""))
+    return start, end
+
+################################################################################
+# minimal environment export
+################################################################################
+
+_var_ref_re = re.compile(r'\$\{?[#!]?([A-Za-z_][A-Za-z0-9_]*)')
+_var_set_re = re.compile(
+        r'(?:^|[;&|(]|\b(?:then|do|else|export|local|declare|readonly|typeset)\b)'
+        r'[ \t]*([A-Za-z_][A-Za-z0-9_]*)(?:\[[^]\n]*\])?\+?=', re.M)
+_var_loop_re = re.compile(r'\b(?:for|select)[ \t]+([A-Za-z_][A-Za-z0-9_]*)')
+_var_read_re = re.compile(r'\bread((?:[ \t]+-[a-zA-Z]+)*(?:[ \t]+[A-Za-z_][A-Za-z0-9_]*)+)')
+# the module command of environment modules (and its Lmod shorthand), and
+# the file arguments of source and . commands
+_module_re = re.compile(r'(?:^|[;&|(`{!]|\b(?:then|do|else|elif|if|while|until)\b)'
+        r'[ \t]*(?:module|ml)(?=[ \t;&|)`]|$)', re.M)
+_source_re = re.compile(
+        r'''(?:^|[;&|({]|\b(?:then|do|else)\b)[ \t]*(?:source|\.)[ \t]+'''
+        r'''((?:"[^"\n]*"|'[^'\n]*'|\$\([^)\n]*\)|`[^`\n]*`|[^\s;&|()'"`])+)''', re.M)
+
+# variables the shell sets itself
+SHELL_VARIABLES = frozenset("""BASH BASHOPTS BASHPID BASH_ARGC BASH_ARGV
+    BASH_COMMAND BASH_LINENO BASH_SOURCE BASH_SUBSHELL BASH_VERSINFO
+    BASH_VERSION COLUMNS DIRSTACK EUID FUNCNAME GROUPS HISTCMD HOSTNAME
+    HOSTTYPE IFS LINENO LINES MACHTYPE OLDPWD OPTARG OPTIND OSTYPE PIPESTATUS
+    PPID PS1 PS2 PS4 PWD RANDOM REPLY SECONDS SHELLOPTS SHLVL UID""".split())
+
+def find_includes(text):
+    """yields (start, end, argument) for the file argument of every source
+    and . command in the shell code of text"""
+    for start, end, kind in shell_segments(text):
+        if kind != "code":
+            continue
+        for m in _source_re.finditer(text, start, end):
+            line_start = text.rfind("\n", 0, m.start()) + 1
+            if "#" in text[line_start:m.start()]:
+                continue
+            yield m.start(1), m.end(1), m.group(1)
+
+def body_variables(body, variables):
+    """returns (names, sources, modules): the environment variables the body
+    of a script uses, the files it sources, which may use others, and
+    whether it uses environment modules (module or ml). Variables the script
+    sets, the shell sets, or that are translated to slurm variables are not
+    included"""
+    used = set()
+    assigned = set()
+    modules = False
+    for start, end, kind in shell_segments(body):
+        if kind not in ("code", "text"):
+            continue
+        used.update(m.group(1) for m in _var_ref_re.finditer(body, start, end))
+        if kind == "code":
+            modules = modules or _module_re.search(body, start, end) is not None
+            assigned.update(m.group(1) for m in _var_set_re.finditer(body, start, end))
+            assigned.update(m.group(1) for m in _var_loop_re.finditer(body, start, end))
+            for m in _var_read_re.finditer(body, start, end):
+                assigned.update(w for w in m.group(1).split() if not w.startswith("-"))
+    names = set()
+    for name in used - assigned - SHELL_VARIABLES:
+        name = variables.get(name, name)
+        if not name.startswith(("SLURM_", "PBS_")):
+            names.add(name)
+    sources = tuple(arg for _, _, arg in find_includes(body))
+    return tuple(sorted(names)), sources, modules
+
+def minimal_export(export, policy):
+    """the #SBATCH --export directive for #PBS -V that exports only the
+    variables in export (see body_variables), the site's export_always
+    variables, and the export_modules variables if the script uses
+    modules"""
+    names, sources, modules = export
+    for path in sources:
+        warn(f"#PBS -V: the script sources {path}, which may need variables "
+                "that are not exported")
+    always = list(policy["export_always"])
+    if modules:
+        always.extend(policy["export_modules"])
+    exported = sorted(set(names) | set(always))
+    used = f"the variables the script uses ({', '.join(names)})" if names else \
+            "no variables (the script doesn't use any)"
+    info(f"#PBS -V -> exporting {used}" + (f" and {', '.join(always)}" if always else ""))
+    return f"#SBATCH --export={','.join(exported) or 'NIL'}"
+
+################################################################################
+# job control commands in the body
+################################################################################
+
+# qstat and qdel at the start of a command
+_job_command_re = re.compile(r'(?:^|[;&|(`{!]|\b(?:then|do|else|elif|if|while|until)\b)'
+        r'[ \t]*(qstat|qdel)(?=[ \t;&|)`]|$)')
+# a word of a command; redirections and command terminators end the words
+_command_word_re = re.compile(r'''[ \t]+((?:"[^"\n]*"|'[^'\n]*'|\$\{[^}\n]*\}|[^\s;&|()<>`'"])+)''')
+# a job id: a literal id or a (quoted) variable
+_job_ref = r'''(?:"?\$\{?[A-Za-z_]\w*\}?"?|\d+)'''
+_redirect = r'''(?:[ \t]*(?:[0-9]?>>?|&>)[ \t]*(?:/dev/null|&[12]))*'''
+# the condition of a polling loop: 'qstat JOB' or 'qstat JOB | grep PATTERN'
+_poll_condition_re = re.compile(r'^(!?)[ \t]*qstat[ \t]+(' + _job_ref + r')' + _redirect +
+        r'''(?:[ \t]*\|[ \t]*grep((?:[ \t]+-[A-Za-z]+)*)[ \t]+("[^"\n]*"|'[^'\n]*'|[^\s;&|'"]+)'''
+        + _redirect + r')?[ \t]*$')
+_poll_loop_re = re.compile(r'^([ \t]*)(while|until)[ \t]+(.*?)[ \t]*(?:;[ \t]*do\b(.*))?$')
+_poll_idle_re = re.compile(r'^[ \t]*(?:(?:sleep[ \t]+[\w.${}]+|:|true)[ \t]*(?:;[ \t]*)?)*(?:#.*)?$')
+_done_re = re.compile(r'^[ \t]*done[ \t]*(?:#.*)?$')
+_submit_re = re.compile(r'^([ \t]*(?:export[ \t]+|local[ \t]+)?([A-Za-z_]\w*)=(?:"?\$\(|`)[ \t]*sbatch)\b(.*)$')
+# a job id from a qsub call that was not translated to sbatch
+_qsub_submit_re = re.compile(r'^[ \t]*(?:export[ \t]+|local[ \t]+)?([A-Za-z_]\w*)=(?:"?\$\(|`)[ \t]*qsub\b',
+        re.M)
+# job states in qstat output: queued, held, waiting, transit, running, exiting,
+# completed, finished
+_pending_states = frozenset("QHWT")
+_finished_states = frozenset("ECF")
+
+def _poll_wait(keyword, condition):
+    """returns (job, dependency type) for the condition of a polling loop
+    that waits for a job to start ('after') or to end ('afterany'), (job,
+    None) for a loop that waits while the job is running, or None"""
+    m = _poll_condition_re.match(condition)
+    if m is None:
+        return None
+    negated, job, flags, pattern = m.groups()
+    # what the condition tests: the job exists, is running, or is pending
+    if pattern is None:
+        tested = "exists"
+    else:
+        states = set(re.sub(r'''[\s^$\[\]|\\()'"]''', "", pattern))
+        flags = (flags or "").replace("-", "").replace(" ", "").replace("\t", "")
+        if not states or not set(flags) <= set("qsE") | {"v"}:
+            return None
+        if "v" in flags:
+            tested = "exists" if states <= _finished_states else None
+        elif states == {"R"}:
+            tested = "running"
+        elif states <= _pending_states:
+            tested = "pending"
+        elif "R" in states and states <= _pending_states | {"R"}:
+            tested = "exists"
+        else:
+            tested = None
+    # the loop goes on while the condition is true (while) or false (until).
+    # A loop that goes on while the job is running also ends while the job
+    # is still queued, which no dependency expresses
+    while_true = (keyword == "while") != bool(negated)
+    if while_true and tested == "exists":
+        return job, "afterany"
+    if while_true and tested == "running":
+        return job, None
+    if while_true and tested == "pending" or not while_true and tested == "running":
+        return job, "after"
+    return None
+
+def _job_command(name, words):
+    """translates the words of a qstat or qdel call. Returns (command,
+    message) or (None, reason)"""
+    options = []
+    args = []
+    i = 0
+    while i < len(words):
+        word = words[i]
+        if word.startswith("-") and len(word) > 1:
+            # -W force, -u user: options that take an argument
+            if word[1:] in ("W", "u", "m") and i + 1 < len(words):
+                options.append((word[1:], words[i + 1]))
+                i += 2
+                continue
+            options.extend((c, None) for c in word[1:])
+        else:
+            args.append(word)
+        i += 1
+    if name == "qdel":
+        if not args:
+            return None, "qdel without job id"
+        dropped = [f"-{opt}" for opt, arg in options if (opt, arg) != ("W", "force")]
+        note = f" ({' '.join(dropped)} dropped)" if dropped else ""
+        return "scancel " + " ".join(args), note
+    opts = {opt: arg for opt, arg in options}
+    # display options don't change which jobs are shown
+    unknown = set(opts) - set("ufria1nw")
+    if unknown:
+        return None, f"qstat -{''.join(sorted(unknown))} has no squeue equivalent"
+    if "f" in opts:
+        if len(args) > 1 or len(opts) > 1:
+            return None, "qstat -f with other options or several jobs"
+        return " ".join(["scontrol show job"] + args), ""
+    out = ["squeue"]
+    if "u" in opts:
+        out.append(f"-u {opts['u']}")
+    if "r" in opts:
+        out.append("-t R")
+    elif "i" in opts:
+        out.append("-t PD")
+    if args:
+        out.append("-j " + ",".join(args))
+    return " ".join(out), ""
+
+def _job_commands(line, lineno, wait_hint):
+    """translates the qstat and qdel calls in a line of shell code"""
+    out = []
+    pos = 0
+    comment = len(line)
+    for m in _shell_token_re.finditer(line):
+        if m.group("comment") is not None:
+            comment = m.start()
+            break
+    for m in _job_command_re.finditer(line, 0, comment):
+        if m.start(1) < pos:
+            continue
+        name = m.group(1)
+        words = []
+        end = m.end(1)
+        for w in _command_word_re.finditer(line, end, comment):
+            if w.start() != end:
+                break
+            words.append(w.group(1))
+            end = w.end()
+        # '2>/dev/null': the file descriptor isn't a word
+        if words and words[-1].isdigit() and line[end:end + 1] in "<>" and end < len(line):
+            end -= len(words.pop())
+        call = line[m.start(1):end]
+        command, note = _job_command(name, words)
+        if command is None:
+            emit(Diagnostic("WARNING", f"'{call}': {note} -> left unchanged", lineno, name))
+            continue
+        rest = line[end:].lstrip()
+        consumed = (rest.startswith("|") and not rest.startswith("||")) or \
+                line[:m.start(1)].rstrip().endswith(("$(", "`"))
+        if name == "qstat" and (consumed or command.startswith("scontrol")):
+            emit(Diagnostic("WARNING", f"'{call}' -> '{command}'; the output "
+                    f"of {command.split()[0]} differs from qstat and needs to be "
+                    "checked where it is parsed" + wait_hint, lineno, name))
+        else:
+            emit(Diagnostic("INFO", f"'{call}' -> '{command}'{note}" + wait_hint,
+                    lineno, name))
+        out.append(line[pos:m.start(1)])
+        out.append(command)
+        pos = end
+    out.append(line[pos:])
+    return "".join(out)
+
+def fix_job_control(text, policy = None):
+    """rewrites qstat and qdel in the shell code of the body of a script.
+    Loops that poll qstat until a job starts or ends
+        while qstat $JOB > /dev/null 2>&1; do sleep 30; done
+    become a single blocking sbatch call: the submission of the job gets
+    --wait if it directly precedes the loop, otherwise a placeholder job
+    that depends on the job is submitted with --wait. Other qstat and qdel
+    calls are translated to squeue, scontrol, or scancel. Loops that wait
+    for a job submitted with qsub, which sbatch can't depend on, and loops
+    that only wait while a job is running are left alone. Every change is
+    reported with the line (counted from 0) it was made in"""
+    if policy is None:
+        policy = POLICY
+    if "qstat" not in text and "qdel" not in text:
+        return text
+    qsub_jobs = set(_qsub_submit_re.findall(text))
+    out = []
+    for start, end, kind in shell_segments(text):
+        chunk = text[start:end]
+        if kind != "code" or ("qstat" not in chunk and "qdel" not in chunk):
+            out.append(chunk)
+            continue
+        first = text.count("\n", 0, start)
+        lines = chunk.split("\n")
+        new = []
+        i = 0
+        while i < len(lines):
+            line = lines[i]
+            lineno = first + i
+            m = _poll_loop_re.match(line) if "qstat" in line else None
+            wait = None
+            if m is not None:
+                indent, keyword, condition, inline = m.groups()
+                wait = _poll_wait(keyword, condition)
+                if wait is not None:
+                    # the body of the loop may only wait
+                    if inline is not None and inline.strip():
+                        body = re.match(r'^(.*?);?[ \t]*done[ \t]*(?:#.*)?$', inline.strip())
+                        last = i
+                        if body is None or not _poll_idle_re.match(body.group(1)):
+                            wait = None
+                    else:
+                        last = i + 1
+                        if inline is None:
+                            if last < len(lines) and re.match(r'^[ \t]*do[ \t]*$', lines[last]):
+                                last += 1
+                            else:
+                                last = len(lines)
+                        while last < len(lines) and not _done_re.match(lines[last]):
+                            if not _poll_idle_re.match(lines[last]):
+                                break
+                            last += 1
+                        if last >= len(lines) or not _done_re.match(lines[last]):
+                            wait = None
+            unchanged = None
+            if wait is not None and re.sub(r'[^\w]', "", wait[0]) in qsub_jobs:
+                unchanged = "the job is submitted with qsub, which was not translated"
+            elif wait is not None and wait[1] is None:
+                # grep R would also match the header of squeue
+                unchanged = ("it waits while the job is running and ends while it is "
+                        "queued, which no dependency expresses")
+            if unchanged is not None:
+                emit(Diagnostic("WARNING", f"polling loop '{line.strip()}': "
+                        f"{unchanged} -> left unchanged", lineno, "qstat"))
+                new.append(line)
+                i += 1
+                continue
+            if wait is None:
+                hint = ""
+                if m is not None and _job_command_re.search(condition):
+                    hint = ("; the loop still polls the scheduler, consider "
+                            "sbatch --wait or --dependency")
+                new.append(_job_commands(line, lineno, hint))
+                i += 1
+                continue
+            job, dependency = wait
+            loop = line.strip() + (" ..." if last > i else "")
+            # the submission of the job right before the loop waits instead
+            k = len(new) - 1
+            while k >= 0 and new[k].lstrip().startswith("#"):
+                k -= 1
+            submit = _submit_re.match(new[k]) if k >= 0 else None
+            var = re.sub(r'[^\w]', "", job)
+            if (dependency == "afterany" and submit is not None
+                    and submit.group(2) == var and "--wait" not in submit.group(3)):
+                new[k] = f"{submit.group(1)} --wait{submit.group(3)}"
+                emit(Diagnostic("INFO", f"polling loop '{loop}' -> sbatch --wait "
+                        f"for the job submitted on the line before", lineno, "qstat"))
+            else:
+                command = (f"sbatch --wait --quiet --dependency={dependency}:{job} "
+                        f"{policy['wait_options']} --wrap=true 2>/dev/null || true")
+                new.append(indent + re.sub(" +", " ", command))
+                what = "start" if dependency == "after" else "end"
+                emit(Diagnostic("INFO", f"polling loop '{loop}' -> waiting for the "
+                        f"{what} of {job} with a dependent job (sbatch --wait "
+                        f"--dependency={dependency}:{job})", lineno, "qstat"))
+            i = last + 1
+        out.append("\n".join(new))
+    return "".join(out)
+
+################################################################################
+# thread counts in the body
+################################################################################
+
+def _compile_threads(raw):
+    """compiles the [threads] table of a rule file: the thread flags of
+    tools and the environment variables that set thread counts"""
+    tools = raw.get("tools", {})
+    variables = raw.get("variables", [])
+    for name, flags in [("threads.variables", variables)] + \
+            [(f"threads.tools.{t}", f) for t, f in tools.items()]:
+        if not isinstance(flags, list) or not all(isinstance(f, str) and f for f in flags):
+            error(f"{name}: expected a list of strings")
+            sys.exit(1)
+    compiled = {"tools": None, "flags": {}, "variables": None}
+    if tools:
+        names = sorted(tools, key = len, reverse = True)
+        compiled["tools"] = re.compile(r'(?:^|(?<=[\s;&|(`/]))('
+                + "|".join(re.escape(t) for t in names) + r')(?=[ \t]|\\\n)', re.M)
+    for tool, flags in tools.items():
+        # -t 16, -t=16, --threads 16, --threads=16, and short flags with
+        # the count attached (-t16)
+        flags = sorted(flags, key = len, reverse = True)
+        forms = [re.escape(f) + r'(?:=|[ \t]+(?:\\\n[ \t]*)?)' for f in flags]
+        forms += [re.escape(f) for f in flags if len(f) == 2]
+        compiled["flags"][tool] = re.compile(r'(?<=[ \t])(?:' + "|".join(forms)
+                + r')(\d+)(?![\w.])')
+    if variables:
+        compiled["variables"] = re.compile(r'(?:^|(?<=[\s;&|(]))('
+                + "|".join(re.escape(v) for v in variables) + r')=(\d+)(?![\w.])', re.M)
+    return compiled
+
+_command_end_re = re.compile(r'[;&|`)]|(?<!\\)\n')
+
+def _comment_start(text, line_start):
+    """the offset of the comment on the line starting at line_start"""
+    line_end = text.find("\n", line_start)
+    line_end = len(text) if line_end < 0 else line_end
+    for m in _shell_token_re.finditer(text, line_start, line_end):
+        if m.group("comment") is not None:
+            return m.start()
+    return line_end
+
+def fix_thread_counts(text, threads, cpus, rewrite = False):
+    """compares the literal thread counts that tools with known thread flags
+    and thread variables (OMP_NUM_THREADS=24) are given in the shell code
+    of the body with cpus, the cpus per task of the job (None if the header
+    doesn't request a single number). Counts that don't match are changed
+    to $SLURM_CPUS_PER_TASK if rewrite is true and cpus is known, and are
+    reported otherwise"""
+    if threads["tools"] is None and threads["variables"] is None:
+        return text
+    counts = []
+    for start, end, kind in shell_segments(text):
+        if kind != "code":
+            continue
+        comments = {}
+        def in_comment(pos):
+            line_start = text.rfind("\n", 0, pos) + 1
+            if line_start not in comments:
+                comments[line_start] = _comment_start(text, line_start)
+            return pos >= comments[line_start]
+        if threads["tools"] is not None:
+            for m in threads["tools"].finditer(text, start, end):
+                if in_comment(m.start()):
+                    continue
+                tool = m.group(1)
+                e = _command_end_re.search(text, m.end(), end)
+                for f in threads["flags"][tool].finditer(text, m.end(),
+                        end if e is None else e.start()):
+                    if not in_comment(f.start()):
+                        counts.append((f.start(1), f.end(1), tool,
+                                text[f.start():f.end()].replace("\\\n", " ")))
+        if threads["variables"] is not None:
+            for m in threads["variables"].finditer(text, start, end):
+                if not in_comment(m.start()):
+                    counts.append((m.start(2), m.end(2), m.group(1), m.group()))
+    out = []
+    pos = 0
+    for a, b, what, found in sorted(counts):
+        n = int(text[a:b])
+        # without a request slurm allocates one cpu per task
+        if n == (cpus or 1):
+            continue
+        lineno = text.count("\n", 0, a)
+        if cpus is None:
+            emit(Diagnostic("WARNING", f"{what}: '{found}' uses {n} threads but the "
+                    "header doesn't request a single number of cpus per task "
+                    "-> left unchanged", lineno, what))
+        elif rewrite:
+            emit(Diagnostic("INFO", f"{what}: '{found}' uses {n} threads but the job "
+                    f"has {cpus} cpus per task -> $SLURM_CPUS_PER_TASK", lineno, what))
+            out.append(text[pos:a])
+            out.append("$SLURM_CPUS_PER_TASK")
+            pos = b
+        else:
+            emit(Diagnostic("WARNING", f"{what}: '{found}' uses {n} threads but the "
+                    f"job has {cpus} cpus per task", lineno, what))
+    out.append(text[pos:])
+    return "".join(out)
+
+################################################################################
+# pre-submission check
+################################################################################
+
+# exit status of --check; the worst finding wins
+CHECK_OK = 0
+CHECK_DROPPED = 3
+CHECK_UNKNOWN = 4
+CHECK_STATUS = {"translated": CHECK_OK, "dropped": CHECK_DROPPED,
+        "unknown": CHECK_UNKNOWN}
+# longest header line read by check_file; of longer lines only the start
+# is read, which is enough to classify them
+CHECK_MAX_LINE = 65536
+
+def write_atomic(path, text, mode = None):
+    """writes text to path through a temporary file in the same directory so
+    that readers never see a partially written script"""
+    fd, tmp = tempfile.mkstemp(dir = os.path.dirname(path) or ".",
+            prefix = ".pbs2slurm-")
+    try:
+        with os.fdopen(fd, "w", encoding = "utf-8", errors = "surrogateescape") as fh:
+            fh.write(text)
+        if mode is not None:
+            os.chmod(tmp, stat.S_IMODE(mode))
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+def walk_paths(paths):
+    """yields the files given in paths, descending into directories in a
+    stable order"""
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for fn in sorted(filenames):
+                    yield os.path.join(dirpath, fn)
+        else:
+            yield path
+
+def classify_directive(line, rules):
+    """classifies a #PBS line as 'translated', 'dropped' (the directive has a
+    rule but its effect is lost in Slurm), or 'unknown' (no rule). Returns
+    (status, reason). This only looks at the rule table and does not run the
+    translation"""
+    tok = tokenize_directive(line)
+    if tok is None:
+        return "unknown", "not a directive"
+    opt, argument = tok
+    if len(line) > DIRECTIVE_MAX_LINE:
+        return "dropped", f"longer than {DIRECTIVE_MAX_LINE} characters"
+    rule = rules["directives"].get(opt)
+    if rule is None:
+        return "unknown", f"no rule for -{opt}"
+    kind = rule["kind"]
+    if kind == "drop":
+        if rule["equivalent"]:
+            return "translated", "slurm default"
+        return "dropped", rule["drop"][1]
+    if kind == "handler":
+        if rule["handler"] != "resource_list":
+            return "translated", ""
+        if argument == "":
+            return "dropped", "empty resource list"
+        dropped = [item.strip().partition("=")[0] for item in argument.split(",")
+                if item.strip().partition("=")[0] not in rules["resources"]]
+        if dropped:
+            return "dropped", f"resources without translation: {','.join(dropped)}"
+        return "translated", ""
+    a_m = rule["argument"].match(argument)
+    if a_m is None:
+        return "unknown", f"unexpected argument for -{opt}"
+    arg = a_m.group()
+    if arg == "" and rule["missing"] is not None:
+        return "dropped", rule["missing"][1]
+    if kind == "values" and arg not in rule["values"] and rule["other"] == "":
+        return "dropped", f"unsupported value '{arg}'"
+    return "translated", ""
+
+def check_header(lines, rules, fail_fast = False):
+    """classifies the #PBS directives in the header of a script given as an
+    iterable of lines. Only the header is read. Yields (line number, line,
+    status, reason); with fail_fast it stops after the first directive that
+    is not translated"""
+    for lineno, line in enumerate(lines, 1):
+        line = line.rstrip("\n")
+        if lineno == 1 and line.startswith("#!"):
+            continue
+        if not line.startswith("#"):
+            if line.strip() == "":
+                continue
+            return
+        if not line.startswith("#PBS"):
+            continue
+        status, reason = classify_directive(line, rules)
+        yield lineno, line, status, reason
+        if fail_fast and status != "translated":
+            return
+
+def check_file(path, rules, fail_fast = False):
+    """check_header for a file. Reads the file line by line only up to the
+    end of the header, so it is cheap for large and for binary files. Lines
+    longer than CHECK_MAX_LINE are cut off; a directive that long is longer
+    than DIRECTIVE_MAX_LINE and reported as dropped"""
+    with open(path, encoding = "utf-8", errors = "replace") as fh:
+        def lines():
+            while True:
+                line = fh.readline(CHECK_MAX_LINE)
+                if line == "":
+                    return
+                yield line
+                # the rest of a long line is only read if the header goes on
+                while not line.endswith("\n") and line != "":
+                    line = fh.readline(CHECK_MAX_LINE)
+        yield from check_header(lines(), rules, fail_fast)
+
+def check_paths(paths, rules, fail_fast = False, out = sys.stdout):
+    """checks files and directory trees (stdin if paths is empty), reports
+    every directive that is not translated and returns the exit status"""
+    status = CHECK_OK
+    if not paths:
+        findings = [("<stdin>", check_header(sys.stdin, rules, fail_fast))]
     else:
-        return "{}\n{}".format(shebang, commands)
+        findings = ((path, check_file(path, rules, fail_fast))
+                for path in walk_paths(paths))
+    for path, results in findings:
+        try:
+            for lineno, line, st, reason in results:
+                if st == "translated":
+                    continue
+                out.write(f"{path}:{lineno}: {st}: {line.strip()}"
+                        + (f" ({reason})" if reason else "") + "\n")
+                status = max(status, CHECK_STATUS[st])
+                if fail_fast:
+                    return status
+        except OSError as e:
+            error(f"{path}: {e.strerror}")
+            status = max(status, 1)
+    return status
+
+
+################################################################################
+# main conversion function
+################################################################################
+
+Unit = collections.namedtuple("Unit", "kind source output diagnostics prologue tail",
+        defaults = ((), ()))
+
+class LRUMemo:
+    """a mapping of at most maxsize entries that evicts the least recently
+    used entry and counts hits and misses"""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last = False)
+
+    def clear(self):
+        self._data.clear()
+        self.hits = self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+# translated headers keyed by rule table and header text. Headers are
+# often copied from a handful of lab templates, so most conversions of a
+# corpus find their header here. Larger headers are not memoized
+HEADER_MEMO_SIZE = 4096
+HEADER_MEMO_MAX = 16384
+header_memo = LRUMemo(HEADER_MEMO_SIZE)
+
+def _line_count(text):
+    return text.count("\n") + (not text.endswith("\n"))
+
+class Conversion:
+    """the result of convert(): the converted script, its diagnostics, and
+    the units it was assembled from. A unit is the shebang, one header line,
+    the lines translated directives add after the header or to the start of
+    the body, a region of the body (see body_regions), or the start and end
+    of the loop around the body of a packed job array. source_map has one
+    entry
+        (input line, input lines, output line, output lines)
+    per unit; line numbers start at 1 and units with the same number of
+    input and output lines map line by line. Diagnostics carry the input
+    line and the directive they were reported for"""
+    __slots__ = ("output", "diagnostics", "source_map", "units", "reused",
+            "_key", "_context")
+
+    def output_line(self, line):
+        """the output line that input line 'line' was translated to"""
+        for in_line, in_count, out_line, out_count in self.source_map:
+            if in_line <= line < in_line + in_count:
+                if in_count == out_count:
+                    return out_line + line - in_line
+                return out_line
+        return None
+
+    def input_line(self, line):
+        """the input line that output line 'line' was translated from"""
+        for in_line, in_count, out_line, out_count in self.source_map:
+            if out_line <= line < out_line + out_count:
+                if in_count == out_count:
+                    return in_line + line - out_line
+                return in_line if in_count else None
+        return None
+
+def convert(pbs, interpreter = "/bin/bash", rules = None, previous = None,
+        incremental = False, memo = header_memo):
+    """converts a batch script (text or Script) and returns a Conversion.
+    Given the Conversion of a previous version of the script, only header
+    lines and body regions that changed are translated again; everything
+    else is spliced in from the previous result. With incremental = True
+    the body is split into regions so that the result can be used as
+    'previous' later. Translated headers are looked up in and added to
+    memo (an LRUMemo or None). Diagnostics are reported as they would be
+    for a full conversion"""
+    if rules is None:
+        rules = load_rules()
+    script = pbs if isinstance(pbs, Script) else Script(pbs)
+    # tables compiled without a digest are only known by their identity
+    key = (rules["digest"] or id(rules), interpreter)
+    context = None
+    if script.has_directives:
+        context = header_context(script.header, rules,
+                shell_name(script.shebang or interpreter),
+                script.body if rules["policy"]["minimal_export"] else None)
+    cache = {}
+    if previous is not None:
+        incremental = True
+        if previous._key == key:
+            # directives are translated in the context of the whole header,
+            # and so are thread counts in the body if they are checked
+            same_context = previous._context == context
+            in_context = ("directive", "body") if rules["policy"]["thread_check"] \
+                    else ("directive",)
+            cache = {(u.kind, u.source): u for u in previous.units
+                    if same_context or u.kind not in in_context}
+    units = []
+    reused = 0
+    with collect_diagnostics() as diags, collect_prologue() as prologue, \
+            collect_tail() as tail:
+        def add(kind, source):
+            # diagnostics of new units are collected with line numbers
+            # relative to the unit
+            nonlocal reused
+            unit = cache.get((kind, source)) if cache else None
+            if unit is not None:
+                reused += 1
+            elif kind == "directive":
+                n = len(diags)
+                n_prologue = len(prologue)
+                n_tail = len(tail)
+                output = translate_directive(source, rules, set(), context)
+                unit_diags = diags[n:]
+                tok = tokenize_directive(source)
+                if unit_diags and tok is not None:
+                    unit_diags = [d._replace(rule = "-" + tok[0])
+                            for d in unit_diags]
+                unit = Unit(kind, source, output, unit_diags,
+                        tuple(prologue[n_prologue:]), tuple(tail[n_tail:]))
+            elif kind == "body":
+                n = len(diags)
+                output = fix_env_vars(source, rules["variables"])
+                # thread counts first: rewriting job control can remove
+                # lines, which would shift the lines diagnostics refer to
+                if rules["policy"]["thread_check"]:
+                    output = fix_thread_counts(output, rules["threads"],
+                            context and context["cpus_per_task"],
+                            rules["policy"]["thread_rewrite"])
+                if rules["policy"]["job_control"]:
+                    try:
+                        import pbs2slurm_driver
+                    except ImportError:
+                        # installed on its own; loops that wait for jobs
+                        # submitted with qsub are left alone
+                        pass
+                    else:
+                        output = pbs2slurm_driver.translate_body_qsub_calls(
+                                output, rules)
+                    output = fix_job_control(output, rules["policy"])
+                unit = Unit(kind, source, output, diags[n:])
+            else:
+                unit = Unit(kind, source, source, ())
+            units.append(unit)
+        shebang = script.shebang
+        if shebang is None:
+            units.append(Unit("shebang", None, "#! {}".format(interpreter), ()))
+        else:
+            add("shebang", shebang)
+        header_units = memo_key = None
+        if (memo is not None and rules["digest"] and script.has_directives
+                and script.header_end - script.header_start <= HEADER_MEMO_MAX):
+            # everything the directive handlers may read; the policy is
+            # part of the digest
+            memo_key = (rules["digest"], script.header) + tuple(sorted(
+                    (k, v) for k, v in context.items() if k != "policy"))
+            header_units = memo.get(memo_key)
+        if header_units is not None:
+            units.extend(header_units)
+        else:
+            n = len(units)
+            for line in script.header_lines():
+                add("directive" if line.startswith("#PBS") else "header", line)
+            if memo_key is not None:
+                memo.put(memo_key, tuple(units[n:]))
+        lines = [line for unit in units for line in unit.tail]
+        if lines:
+            units.append(Unit("tail", None, "\n".join(lines), ()))
+        lines = []
+        for unit in units:
+            lines.extend(line for line in unit.prologue if line not in lines)
+        if lines:
+            units.append(Unit("prologue", None, "\n".join(lines), ()))
+        pack = None if context is None else context["pack"]
+        if pack is not None:
+            loop_start, loop_end = packing_loop(pack)
+            units.append(Unit("loop", None, loop_start, ()))
+        body = script.body
+        if incremental:
+            for start, end in body_regions(body):
+                add("body", body[start:end])
+        else:
+            add("body", body)
+        if pack is not None:
+            if not body.endswith("\n"):
+                loop_end = "\n" + loop_end
+            units.append(Unit("epilogue", None, loop_end, ()))
+
+    # assemble the output, the source map, and the diagnostics. Messages of
+    # 'once' rules are only kept for the first directive that reports them
+    result = Conversion()
+    source_map = []
+    diagnostics = []
+    reported = set()
+    in_line = out_line = 1
+    for unit in units:
+        if unit.kind == "body":
+            in_count = _line_count(unit.source)
+            out_count = _line_count(unit.output)
+        elif unit.kind == "epilogue":
+            in_count = 0
+            out_count = unit.output.count("\n") - unit.output.startswith("\n")
+        else:
+            in_count = 0 if unit.source is None else 1
+            out_count = unit.output.count("\n") + 1
+        source_map.append((in_line, in_count, out_line, out_count))
+        for d in unit.diagnostics:
+            # rules of directives are '-X'; body rewrites name the command
+            if d.rule is not None and d.rule.startswith("-"):
+                if rules["directives"][d.rule[1:]]["once"]:
+                    if d.rule in reported:
+                        continue
+                    reported.add(d.rule)
+            diagnostics.append(d._replace(line = in_line + (d.line or 0)))
+        in_line += in_count
+        out_line += out_count
+    head = [u.output for u in units if u.kind not in ("body", "epilogue")]
+    head.append("".join(u.output for u in units if u.kind in ("body", "epilogue")))
+    result.output = "\n".join(head)
+    result.diagnostics = diagnostics
+    result.source_map = source_map
+    result.units = units
+    result.reused = reused
+    result._key = key
+    result._context = context
+    for d in diagnostics:
+        emit(d)
+    return result
+
+def convert_batch_script(pbs, interpreter = "/bin/bash", rules = None,
+        describe = False):
+    """converts a batch script. With describe = True a (script, job
+    description) tuple is returned (see job_description)"""
+    conversion = convert(pbs, interpreter, rules)
+    if describe:
+        return conversion.output, job_description(conversion)
+    return conversion.output
+
+
+################################################################################
+# structured job description
+################################################################################
+
+def _minutes(value):
+    """[days-]hours:minutes:seconds -> minutes, rounded up"""
+    days, _, hms = value.rpartition("-")
+    parts = [int(x) for x in hms.split(":")]
+    while len(parts) < 3:
+        parts.insert(0, 0)
+    h, m, sec = parts
+    return (int(days or 0) * 24 + h) * 60 + m + (sec > 0)
+
+def _megabytes(value):
+    """slurm size -> megabytes, rounded up"""
+    n, unit = int(value[:-1]), value[-1].upper()
+    kib = n * 1024 ** "KMGT".index(unit)
+    return -(-kib // 1024)
+
+def _signal(value):
+    """--signal=[{R|B}:]sig[@time] -> kill warning fields"""
+    flags, _, value = value.rpartition(":")
+    sig, _, delay = value.partition("@")
+    fields = {"kill_warning_signal": re.sub(r"^SIG", "", sig.upper()),
+            "kill_warning_delay": int(delay or 60)}
+    if "B" in flags:
+        fields["kill_warning_flags"] = ["BATCH_JOB"]
+    return fields
+
+# sbatch options and the fields of a slurmrestd job description they set.
+# Fields that are set more than once are joined (lists are extended,
+# strings joined with ','). A field of None takes a dict of fields
+JOB_FIELDS = {
+    "job-name": ("name", str),
+    "output": ("standard_output", str),
+    "error": ("standard_error", str),
+    "time": ("time_limit", _minutes),
+    "partition": ("partition", str),
+    "mail-user": ("mail_user", str),
+    "mail-type": ("mail_type", lambda v: v.split(",")),
+    "requeue": ("requeue", lambda v: True),
+    "no-requeue": ("requeue", lambda v: False),
+    "array": ("array", str),
+    "nodes": ("nodes", str),
+    "ntasks-per-node": ("tasks_per_node", int),
+    "cpus-per-task": ("cpus_per_task", int),
+    "mem": ("memory_per_node", _megabytes),
+    "tmp": ("temporary_disk_per_node", _megabytes),
+    "gres": ("tres_per_node", lambda v: "gres/" + v),
+    "gpus-per-node": ("tres_per_node", lambda v: "gres/gpu:" + v),
+    "exclusive": ("exclusive", lambda v: [v or "true"]),
+    "spread-job": ("flags", lambda v: ["SPREAD_JOB"]),
+    "switches": ("required_switches", int),
+    "signal": (None, _signal),
+}
+
+def job_description(conversion, environment = None, cwd = None):
+    """returns the job description of a Conversion in the JSON shape that
+    slurmrestd accepts for job submission: {"script": ..., "job": {...}},
+    or {"script": ..., "jobs": [...]} for a heterogeneous job. The #SBATCH
+    options of the header become typed fields. environment (a dict,
+    default os.environ) is filtered by --export; cwd defaults to the
+    current directory. slurmrestd doesn't read the #SBATCH lines of the
+    script, so options without a field are reported as dropped"""
+    if environment is None:
+        environment = os.environ
+    components = [{}]
+    export = None
+    dropped = []
+    for unit in conversion.units:
+        if unit.kind not in ("directive", "tail"):
+            continue
+        for line in unit.output.split("\n"):
+            if not line.startswith("#SBATCH"):
+                continue
+            option = line[len("#SBATCH"):].strip()
+            if option == "hetjob":
+                components.append({})
+                continue
+            name, _, value = option.lstrip("-").partition("=")
+            if len(value) > 1 and value[0] == value[-1] == '"':
+                value = value[1:-1]
+            if name == "export":
+                export = value
+                continue
+            if name not in JOB_FIELDS:
+                dropped.append(option)
+                continue
+            field, convert_value = JOB_FIELDS[name]
+            value = convert_value(value)
+            job = components[-1]
+            if field is None:
+                job.update(value)
+            elif field not in job:
+                job[field] = value
+            elif isinstance(value, list):
+                job[field] = job[field] + value
+            elif isinstance(value, str):
+                job[field] = job[field] + "," + value
+            else:
+                job[field] = value
+    if dropped:
+        warn("options without a field in the job description are dropped by "
+                f"slurmrestd: {' '.join(dropped)}")
+    # --export=ALL|NONE|NIL|[ALL,]NAME[=value],...
+    items = ["ALL"] if export is None else export.split(",")
+    env = {}
+    for item in items:
+        name, eq, value = item.partition("=")
+        if item == "ALL":
+            env.update(environment)
+        elif item in ("NONE", "NIL"):
+            # only the SLURM_* variables, as with sbatch; srun in the job
+            # reads SLURM_EXPORT_ENV
+            env.update((n, v) for n, v in environment.items() if n.startswith("SLURM_"))
+            env["SLURM_EXPORT_ENV"] = item
+        elif eq:
+            env[name] = value
+        elif name in environment:
+            env[name] = environment[name]
+    env = [f"{n}={v}" for n, v in env.items()]
+    for job in components:
+        job["current_working_directory"] = cwd or os.getcwd()
+        job["environment"] = env
+    if len(components) > 1:
+        return {"script": conversion.output, "jobs": components}
+    return {"script": conversion.output, "job": components[0]}
 
 
 ################################################################################
@@ -293,6 +2277,33 @@ if __name__ == "__main__":
     cmdline.add_argument("--shell", "-s", default = "/bin/bash",
             help = """Shell to insert if shebang line (#! ...) is missing.
                       Defaults to '/bin/bash'""")
+    cmdline.add_argument("--rules", "-r", default = None,
+            help = """Rule file with site specific translation rules.
+                      Defaults to the built-in pbs2slurm_rules.toml""")
+    cmdline.add_argument("--policy", "-p", action = "append", default = [],
+            metavar = "KEY=VALUE",
+            help = """Change a site policy setting of the rule file (see
+                      [policy] in pbs2slurm_rules.toml). May be repeated""")
+    cmdline.add_argument("--driver", "-d", action = "store_true",
+            default = False,
+            help = """Translate a driver script that submits jobs with qsub.
+                      Loops of qsub calls are collapsed into job arrays""")
+    cmdline.add_argument("--check", "-c", nargs = "*", metavar = "PATH",
+            default = None,
+            help = """Only check the headers of scripts (files or directory
+                      trees; stdin if none are given) for directives that are
+                      dropped or unknown. Exits with 3 if any directive is
+                      dropped and 4 if any is unknown""")
+    cmdline.add_argument("--follow-includes", action = "store_true",
+            default = False,
+            help = """Also convert files included with source or . (written
+                      next to the originals with the suffix .slurm) and
+                      change the script to read the converted files""")
+    cmdline.add_argument("--json", action = "store_true", default = False,
+            help = """Write a job description for slurmrestd (JSON) instead
+                      of the script""")
+    cmdline.add_argument("--fail-fast", action = "store_true", default = False,
+            help = "With --check, stop at the first directive that is not translated")
     cmdline.add_argument("--version", "-v", action = "store_true",
             default = False)
     cmdline.add_argument("pbs_script", type=argparse.FileType('r'), nargs = "?",
@@ -301,9 +2312,39 @@ if __name__ == "__main__":
     if args.version:
         print("pbs2slurm V{}".format(__version__))
         sys.exit(0)
+    if args.check is not None:
+        paths = args.check
+        if args.pbs_script is not sys.stdin:
+            paths.append(args.pbs_script.name)
+            args.pbs_script.close()
+        sys.exit(check_paths(paths, load_rules(args.rules), args.fail_fast))
     if args.pbs_script.isatty():
         print("Please provide a pbs batch script either on stdin or as an argument",
                 file = sys.stderr)
         sys.exit(1)
-    slurm_script = convert_batch_script(args.pbs_script.read(), args.shell)
+    rules = with_policy(load_rules(args.rules), args.policy)
+    if args.driver:
+        import pbs2slurm_driver
+        script_dir = None
+        if args.pbs_script is not sys.stdin:
+            script_dir = os.path.dirname(os.path.abspath(args.pbs_script.name))
+        slurm_script = pbs2slurm_driver.convert_driver_script(
+                args.pbs_script.read(), rules, args.shell, script_dir)
+    elif args.json:
+        import json
+        slurm_script, description = convert_batch_script(args.pbs_script.read(),
+                args.shell, rules, describe = True)
+        slurm_script = json.dumps(description, indent = 2)
+    else:
+        slurm_script = convert_batch_script(args.pbs_script.read(), args.shell, rules)
+        if args.follow_includes:
+            import pbs2slurm_includes
+            script_dir = os.getcwd()
+            if args.pbs_script is not sys.stdin:
+                script_dir = os.path.dirname(os.path.abspath(args.pbs_script.name))
+            slurm_script, includes = pbs2slurm_includes.rewrite_includes(
+                    slurm_script, script_dir)
+            graph = pbs2slurm_includes.IncludeGraph(rules)
+            graph.add(args.pbs_script.name, includes)
+            graph.report(sys.stderr)
     print(slurm_script)
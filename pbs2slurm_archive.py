@@ -0,0 +1,196 @@
+#! /usr/local/bin/python
+# vim: set ft=python :
+"""
+Converts the PBS batch scripts inside a tar or zip archive to Slurm.
+
+The archive is read as a stream member by member and written to an output
+archive of the same type and compression. Members that are PBS batch
+scripts are converted; all other members (and scripts that can't be
+converted) are copied unchanged. Names, modes, owners, and times of the
+members are kept. Nothing is extracted to disk, and only members up to
+--max-script-size are held in memory; larger members are copied as a
+stream.
+
+Tar archives may be uncompressed or compressed with gzip, bzip2, xz, or
+zstd (zstd requires the 'zstandard' package). Zip archives can't be read
+without seeking, so a zip archive read from stdin is spooled to a
+temporary file first.
+
+Examples:
+    pbs2slurm_archive bundle.tar.gz bundle-slurm.tar.gz
+    ssh host cat bundle.tar.xz | pbs2slurm_archive - - > bundle-slurm.tar.xz
+"""
+
+import sys
+import io
+import copy
+import shutil
+import tarfile
+import zipfile
+import tempfile
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import pbs2slurm as p2s
+
+# the largest member that is checked for being a batch script
+MAX_SCRIPT_SIZE = 1 << 20
+
+_compression_magic = (
+    (b"\x1f\x8b", "gz"),
+    (b"BZh", "bz2"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zst"),
+)
+
+def archive_format(head):
+    """returns (container, compression) given the first bytes of an
+    archive"""
+    if head.startswith(b"PK\x03\x04") or head.startswith(b"PK\x05\x06"):
+        return "zip", None
+    for magic, compression in _compression_magic:
+        if head.startswith(magic):
+            return "tar", compression
+    return "tar", None
+
+def convert_member(name, data, rules, interpreter = "/bin/bash"):
+    """returns the converted script for the content of an archive member or
+    None if it is not a PBS batch script. Diagnostics are reported with the
+    name of the member"""
+    if b"#PBS" not in data:
+        return None
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+    output = None
+    with p2s.collect_diagnostics() as diags:
+        try:
+            script = p2s.Script(text)
+            if script.has_directives:
+                output = (p2s.convert_batch_script(script, interpreter, rules)
+                        + "\n").encode("utf-8")
+        except SystemExit:
+            p2s.warn("copied unchanged")
+    for d in diags:
+        p2s.emit(d._replace(message = f"{name}: {d.message}"))
+    return output
+
+def _zstd_required():
+    if zstandard is None:
+        p2s.error("zstd compressed archives require the zstandard package")
+        sys.exit(1)
+
+def convert_tar(fin, fout, compression, rules, interpreter = "/bin/bash",
+        max_script_size = MAX_SCRIPT_SIZE):
+    """converts a tar stream and returns (members, converted)"""
+    closers = []
+    if compression == "zst":
+        _zstd_required()
+        fin = zstandard.ZstdDecompressor().stream_reader(fin, closefd = False)
+        fout = zstandard.ZstdCompressor().stream_writer(fout, closefd = False)
+        closers.append(fout)
+        compression = None
+    suffix = "|" + (compression or "")
+    members = converted = 0
+    with tarfile.open(fileobj = fin, mode = "r" + suffix) as tin, \
+            tarfile.open(fileobj = fout, mode = "w" + suffix,
+                    format = tarfile.PAX_FORMAT) as tout:
+        for member in tin:
+            members += 1
+            if not member.isfile():
+                tout.addfile(member)
+                continue
+            src = tin.extractfile(member)
+            if member.size > max_script_size:
+                tout.addfile(member, src)
+                continue
+            data = src.read()
+            output = convert_member(member.name, data, rules, interpreter)
+            if output is not None:
+                converted += 1
+                member = copy.copy(member)
+                member.size = len(output)
+                data = output
+            tout.addfile(member, io.BytesIO(data))
+    for closer in closers:
+        closer.close()
+    return members, converted
+
+def convert_zip(fin, fout, rules, interpreter = "/bin/bash",
+        max_script_size = MAX_SCRIPT_SIZE):
+    """converts a zip archive and returns (members, converted). The output
+    doesn't need to be seekable"""
+    if not fin.seekable():
+        spool = tempfile.SpooledTemporaryFile(max_size = 64 << 20)
+        shutil.copyfileobj(fin, spool)
+        spool.seek(0)
+        fin = spool
+    members = converted = 0
+    with zipfile.ZipFile(fin) as zin, zipfile.ZipFile(fout, "w") as zout:
+        zout.comment = zin.comment
+        for info in zin.infolist():
+            members += 1
+            new = zipfile.ZipInfo(info.filename, info.date_time)
+            for attr in ("compress_type", "comment", "extra", "create_system",
+                    "external_attr", "internal_attr"):
+                setattr(new, attr, getattr(info, attr))
+            if info.is_dir():
+                zout.writestr(new, b"")
+                continue
+            if info.file_size > max_script_size:
+                with zin.open(info) as src, zout.open(new, "w",
+                        force_zip64 = info.file_size >= zipfile.ZIP64_LIMIT) as dst:
+                    shutil.copyfileobj(src, dst)
+                continue
+            data = zin.read(info)
+            output = convert_member(info.filename, data, rules, interpreter)
+            if output is not None:
+                converted += 1
+                data = output
+            zout.writestr(new, data)
+    return members, converted
+
+def convert_archive(fin, fout, rules = None, interpreter = "/bin/bash",
+        max_script_size = MAX_SCRIPT_SIZE):
+    """converts the archive read from the binary stream fin to fout and
+    returns (members, converted)"""
+    if rules is None:
+        rules = p2s.load_rules()
+    if not hasattr(fin, "peek"):
+        fin = io.BufferedReader(fin)
+    container, compression = archive_format(fin.peek(8)[:8])
+    if container == "zip":
+        return convert_zip(fin, fout, rules, interpreter, max_script_size)
+    return convert_tar(fin, fout, compression, rules, interpreter,
+            max_script_size)
+
+################################################################################
+# command line interface
+################################################################################
+
+if __name__ == "__main__":
+    import argparse
+    cmdline = argparse.ArgumentParser(description = __doc__,
+            formatter_class = argparse.RawDescriptionHelpFormatter)
+    cmdline.add_argument("--shell", "-s", default = "/bin/bash",
+            help = """Shell to insert if shebang line (#! ...) is missing.
+                      Defaults to '/bin/bash'""")
+    cmdline.add_argument("--rules", "-r", default = None,
+            help = """Rule file with site specific translation rules.
+                      Defaults to the built-in pbs2slurm_rules.toml""")
+    cmdline.add_argument("--max-script-size", type = int,
+            default = MAX_SCRIPT_SIZE,
+            help = f"""Larger members are copied without checking whether they
+                      are batch scripts. Defaults to {MAX_SCRIPT_SIZE}""")
+    cmdline.add_argument("archive", help = "Input archive or - for stdin")
+    cmdline.add_argument("output", help = "Output archive or - for stdout")
+    args = cmdline.parse_args()
+    fin = sys.stdin.buffer if args.archive == "-" else open(args.archive, "rb")
+    fout = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+    with fin, fout:
+        members, converted = convert_archive(fin, fout,
+                p2s.load_rules(args.rules), args.shell, args.max_script_size)
+    p2s.info(f"converted {converted} of {members} members")
@@ -0,0 +1,750 @@
+#! /usr/local/bin/python
+# vim: set ft=python :
+"""
+Converts large numbers of PBS batch scripts to Slurm.
+
+Scripts on network file systems spend more time waiting for opens and reads
+than being converted, so the conversion runs as a pipeline of three stages
+connected by bounded queues:
+- reader threads that prefetch the content of the scripts
+- a pool of worker processes that convert batches of scripts
+- a writer that writes every converted script to a temporary file next to
+  its destination and renames it into place
+Memory use only depends on the queue and batch sizes, not on the number of
+scripts. At the end the work done by each stage is reported so that the
+number of readers and workers can be tuned separately: a stage that is busy
+most of the time is the bottleneck.
+
+Converted scripts are written next to the originals with the suffix .slurm
+or, with --output-dir, to the same relative path below the output directory.
+
+Reads and writes that fail with errors that may go away (stale NFS file
+handles, quota, I/O errors) are retried with exponential backoff. With
+--journal every script that was converted, failed, or skipped is recorded
+together with the hash of its content, and an interrupted run can be
+continued with --resume: scripts that were converted before and haven't
+changed since are skipped, everything else (including failed scripts) is
+converted again.
+
+A corpus that is too large for one node can be split into N shards with
+--shard K/N (K = 0..N-1). Scripts are assigned to shards by a hash of their
+path below the directory given on the command line, so the shards don't
+overlap and together cover the corpus no matter where and in which order
+they run. Each shard writes its own journal (the journal path with .K
+appended) and, with --summary, its statistics. --make-shards N prints an
+sbatch job array script that runs all N shards; --merge combines the
+summaries of the shards afterwards.
+
+With --report, a browsable report of the run (PBS and Slurm script side by
+side with their diagnostics, in pages, plus summary pages) is written to a
+directory (see pbs2slurm_report).
+
+Examples:
+    pbs2slurm_bulk /data/scripts
+    pbs2slurm_bulk -j 16 --readers 32 -o /data/slurm /data/scripts
+    pbs2slurm_bulk --journal sweep.journal --resume -o /data/slurm /data/scripts
+    pbs2slurm_bulk --make-shards 64 -o /data/slurm /data/scripts > shards.sh
+    pbs2slurm_bulk --merge pbs2slurm-shards/*.json
+    pbs2slurm_bulk --report /data/report -o /data/slurm /data/scripts
+"""
+
+import sys
+import os
+import time
+import json
+import shlex
+import errno
+import array
+import bisect
+import hashlib
+import heapq
+import queue
+import threading
+import collections
+import functools
+import concurrent.futures
+
+import pbs2slurm as p2s
+import pbs2slurm_includes
+import pbs2slurm_report
+
+# end of input marker passed through the queues
+DONE = None
+# output of scripts that were skipped because an earlier run converted them
+SKIPPED = object()
+
+# errors of reads and writes that are retried
+TRANSIENT_ERRORS = frozenset((errno.ESTALE, errno.EDQUOT, errno.ENOSPC,
+        errno.EIO, errno.EAGAIN, errno.ETIMEDOUT, errno.EINTR))
+
+def with_retries(func, retries = 3, backoff = 1.0):
+    """returns func(), calling it again up to retries times after transient
+    OSErrors, waiting backoff seconds before the first retry and twice as
+    long before each further one"""
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except OSError as e:
+            if e.errno not in TRANSIENT_ERRORS or attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+def content_hash(text):
+    """the hash of the content of a script recorded in the journal"""
+    return hashlib.blake2b(text.encode("utf-8", "surrogateescape"),
+            digest_size = 8).hexdigest()
+
+# keys of a journal sorted at a time; longer journals are sorted in runs of
+# this many keys that are then merged
+SORT_RUN = 1 << 16
+
+def sort_keys(keys, run = SORT_RUN):
+    """returns the keys of an array of 64 bit keys in a sorted array. Runs
+    of keys are sorted in place one at a time and then merged, so that there
+    is never a list of all keys as python ints"""
+    if len(keys) <= run:
+        return array.array("Q", sorted(keys))
+    for i in range(0, len(keys), run):
+        keys[i:i + run] = array.array("Q", sorted(keys[i:i + run]))
+    view = memoryview(keys)
+    merged = array.array("Q")
+    merged.extend(heapq.merge(*(view[i:i + run] for i in range(0, len(keys), run))))
+    view.release()
+    return merged
+
+class Journal:
+    """an append-only record of the scripts of a bulk run, one line
+        <status> <content hash> <path>
+    per script, where status is c (converted), f (failed), or s (skipped
+    because an earlier run converted it). Entries are written in batches
+    with flush(); after a crash at most the last batch is lost, and those
+    scripts are simply converted again. When resuming, only a sorted array
+    of 64 bit keys of the converted (path, hash) pairs is kept in memory, so
+    journals with tens of millions of entries are cheap to load"""
+    def __init__(self, path, resume = False):
+        self.path = path
+        self.counts = collections.Counter()
+        self._done = array.array("Q")
+        self._pending = []
+        newline = ""
+        if resume and os.path.exists(path):
+            newline = self._load()
+        self._fh = open(path, "a" if resume else "w", encoding = "utf-8",
+                errors = "surrogateescape")
+        # a line cut off by a crash is ended so that it doesn't swallow the
+        # next entry
+        self._fh.write(newline)
+
+    @staticmethod
+    def _key(path, digest):
+        return int.from_bytes(hashlib.blake2b(
+                f"{path}\0{digest}".encode("utf-8", "surrogateescape"),
+                digest_size = 8).digest(), "little")
+
+    def _load(self):
+        keys = array.array("Q")
+        line = "\n"
+        with open(self.path, encoding = "utf-8", errors = "surrogateescape") as fh:
+            for line in fh:
+                status, _, rest = line.partition(" ")
+                digest, _, path = rest.rstrip("\n").partition(" ")
+                if status in ("c", "s") and path and line.endswith("\n"):
+                    keys.append(self._key(path, digest))
+        self._done = sort_keys(keys)
+        return "" if line.endswith("\n") else "\n"
+
+    def done(self, path, digest):
+        """whether an earlier run converted path with content hash digest"""
+        key = self._key(path, digest)
+        i = bisect.bisect_left(self._done, key)
+        return i < len(self._done) and self._done[i] == key
+
+    def add(self, status, path, digest):
+        self.counts[status] += 1
+        self._pending.append(f"{status} {digest or '-'} {path}\n")
+
+    def flush(self):
+        self._fh.write("".join(self._pending))
+        self._fh.flush()
+        self._pending.clear()
+
+    def close(self):
+        self.flush()
+        os.fsync(self._fh.fileno())
+        self._fh.close()
+
+class StageStats:
+    """counters of one pipeline stage. busy is the time spent working and
+    idle the time spent waiting for input, both summed over all threads or
+    processes of the stage"""
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.files = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.idle = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, files, nbytes, busy, idle = 0.0):
+        with self._lock:
+            self.files += files
+            self.bytes += nbytes
+            self.busy += busy
+            self.idle += idle
+
+def report_stats(stats, wall, memo, out):
+    """writes a table with the throughput and utilization of each stage and
+    the header memo (hits, misses) of the workers"""
+    out.write(f"{'stage':<8} {'workers':>7} {'files':>9} {'MB':>9} "
+            f"{'busy s':>9} {'files/s':>9} {'util':>5}\n")
+    for st in stats:
+        rate = st.files / st.busy * st.workers if st.busy > 0 else 0.0
+        util = st.busy / (st.workers * wall) if wall > 0 else 0.0
+        out.write(f"{st.name:<8} {st.workers:>7} {st.files:>9} "
+                f"{st.bytes / 1e6:>9.1f} {st.busy:>9.2f} {rate:>9.1f} "
+                f"{util:>5.0%}\n")
+    files = stats[-1].files
+    out.write(f"wall: {wall:.2f}s, {files / wall if wall > 0 else 0:.1f} files/s\n")
+    hits, misses = memo
+    if hits + misses:
+        out.write(f"header memo: {hits} hits, {misses} misses "
+                f"({hits / (hits + misses):.0%})\n")
+
+def in_shard(path, root, shard):
+    """whether a script found below root (or given as root) belongs to
+    shard (K, N)"""
+    k, n = shard
+    rel = os.path.relpath(path, root) if os.path.isdir(root) else os.path.basename(path)
+    digest = hashlib.blake2b(rel.encode("utf-8", "surrogateescape"), digest_size = 8)
+    return int.from_bytes(digest.digest(), "little") % n == k
+
+def parse_shard(spec):
+    """'K/N' -> (K, N)"""
+    k, _, n = spec.partition("/")
+    if not (k.isdigit() and n.isdigit() and int(k) < int(n)):
+        raise ValueError(f"expected K/N with 0 <= K < N, got '{spec}'")
+    return int(k), int(n)
+
+def destination(path, root, output_dir = None, suffix = ".slurm"):
+    """output file for a script found below root (or given as root)"""
+    if output_dir is None:
+        return path + suffix
+    if os.path.isdir(root):
+        rel = os.path.relpath(path, root)
+    else:
+        rel = os.path.basename(path)
+    return os.path.join(output_dir, rel + suffix)
+
+def include_destination(path, roots, output_dir = None, suffix = ".slurm"):
+    """output file for an include: the destination of a script for includes
+    below one of the input directories roots, next to the original
+    otherwise"""
+    if output_dir is None:
+        return path + suffix
+    for root in roots:
+        root = os.path.abspath(root)
+        if os.path.isdir(root) and path.startswith(root + os.sep):
+            return destination(path, root, output_dir, suffix)
+    return path + pbs2slurm_includes.INCLUDE_SUFFIX
+
+def is_script(path, roots, output_dir = None, suffix = ".slurm"):
+    """whether an include (absolute path) is one of the scripts of a run
+    over roots, which converts it as a script"""
+    if is_output(path, output_dir, suffix):
+        return False
+    for root in roots:
+        root = os.path.abspath(root)
+        if path == root or (os.path.isdir(root) and path.startswith(root + os.sep)):
+            return True
+    return False
+
+def include_graph(roots, output_dir, suffix, rules_path, write):
+    """the IncludeGraph of a run over roots that writes the converted
+    includes with write(path, text, mode)"""
+    return pbs2slurm_includes.IncludeGraph(p2s.load_rules(rules_path), write = write,
+            destination = functools.partial(include_destination, roots = roots,
+                    output_dir = output_dir, suffix = suffix),
+            skip = functools.partial(is_script, roots = roots,
+                    output_dir = output_dir, suffix = suffix))
+
+def is_output(path, output_dir = None, suffix = ".slurm"):
+    """whether path was written by a run: a converted script (or include),
+    anything below output_dir, or a temporary file of write_atomic"""
+    if os.path.basename(path).startswith(".pbs2slurm-"):
+        return True
+    if suffix and path.endswith(suffix):
+        return True
+    if path.endswith(pbs2slurm_includes.INCLUDE_SUFFIX):
+        return True
+    if output_dir is not None:
+        output_dir = os.path.abspath(output_dir)
+        return os.path.abspath(path).startswith(output_dir + os.sep)
+    return False
+
+################################################################################
+# conversion workers
+################################################################################
+
+_rules = None
+
+def _init_worker(rules_path):
+    global _rules
+    _rules = p2s.load_rules(rules_path)
+
+def _convert_batch(batch, interpreter, include_destination = None,
+        keep_source = False):
+    """converts a batch of (path, dest, mode, text, problem, digest) items in
+    a worker process. Returns the results (path, dest, mode, output,
+    diagnostics, includes, digest, source), the time spent converting, and
+    the header memo hits and misses. output is None if the script could not
+    be converted. With include_destination (see IncludeGraph), source
+    commands are changed to read converted includes and the included paths
+    are returned. source is the
+    text of the script with keep_source and None otherwise"""
+    results = []
+    memo = p2s.header_memo
+    hits, misses = memo.hits, memo.misses
+    start = time.perf_counter()
+    for path, dest, mode, text, problem, digest in batch:
+        output = None
+        includes = ()
+        with p2s.collect_diagnostics() as diags:
+            if problem is not None:
+                p2s.error(problem)
+            else:
+                try:
+                    output = p2s.convert_batch_script(text, interpreter, _rules)
+                    if include_destination is not None:
+                        output, includes = pbs2slurm_includes.rewrite_includes(
+                                output, os.path.dirname(os.path.abspath(path)),
+                                destination = include_destination)
+                except SystemExit:
+                    pass
+                except Exception as e:
+                    p2s.error(f"{type(e).__name__}: {e}")
+        results.append((path, dest, mode, output, diags, includes, digest,
+                text if keep_source else None))
+    return (results, time.perf_counter() - start, memo.hits - hits,
+            memo.misses - misses)
+
+################################################################################
+# pipeline
+################################################################################
+
+def run(paths, output_dir = None, suffix = None, rules_path = None,
+        interpreter = "/bin/bash", readers = 8, jobs = None, queue_size = 256,
+        batch_size = 32, follow_includes = False, journal = None,
+        resume = False, retries = 3, backoff = 1.0, shard = None,
+        report = None, out = sys.stderr):
+    """converts all scripts in paths (files or directory trees) and returns
+    a summary dict with the stage statistics and the scripts that failed.
+    Diagnostics are reported with the path of the script they belong to.
+    With follow_includes, files included by the scripts are converted once
+    each (see pbs2slurm_includes) and written like the scripts; includes
+    that are scripts of the run as well are only converted as scripts. The
+    includes of a shard are converted by merge_summaries, once for all
+    shards. journal is the path of a Journal; with
+    resume, scripts it records as converted are skipped if they haven't
+    changed and their output still exists. Transient read and write errors
+    are retried (see with_retries). With shard = (K, N) only the scripts of
+    shard K of N are converted, the journal of the shard is journal.K and
+    its report is written to report/shard-K. report is the directory of a
+    pbs2slurm_report.Report of the run"""
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if suffix is None:
+        suffix = ".slurm" if output_dir is None else ""
+    path_q = queue.Queue(queue_size)
+    text_q = queue.Queue(queue_size)
+    result_q = queue.Queue(max(2, queue_size // batch_size))
+    read_stats = StageStats("read", readers)
+    convert_stats = StageStats("convert", jobs)
+    write_stats = StageStats("write", 1)
+    start = time.perf_counter()
+    if journal is not None:
+        if shard is not None:
+            journal = f"{journal}.{shard[0]}"
+        journal = Journal(journal, resume)
+    if report is not None:
+        if shard is not None:
+            report = os.path.join(report, f"shard-{shard[0]}")
+        report = pbs2slurm_report.Report(report, p2s.load_rules(rules_path))
+    # set when the conversion fails (e.g. a worker process died); the
+    # stages before it stop and the error is raised at the end
+    stop = threading.Event()
+    errors = []
+    roots = tuple(os.path.abspath(p) for p in paths)
+    include_dest = None
+    if follow_includes:
+        include_dest = functools.partial(include_destination, roots = roots,
+                output_dir = output_dir, suffix = suffix)
+
+    def discover():
+        try:
+            for root in paths:
+                for path in p2s.walk_paths([root]):
+                    if stop.is_set():
+                        return
+                    if is_output(path, output_dir, suffix):
+                        continue
+                    if shard is None or in_shard(path, root, shard):
+                        path_q.put((path, destination(path, root, output_dir, suffix)))
+        finally:
+            for _ in range(readers):
+                path_q.put(DONE)
+
+    def read():
+        while True:
+            t0 = time.perf_counter()
+            item = path_q.get()
+            t1 = time.perf_counter()
+            if item is DONE:
+                text_q.put(DONE)
+                return
+            if stop.is_set():
+                continue
+            path, dest = item
+            text = mode = problem = digest = None
+            def read_file():
+                with open(path, encoding = "utf-8", errors = "surrogateescape") as fh:
+                    return os.fstat(fh.fileno()).st_mode, fh.read()
+            try:
+                mode, text = with_retries(read_file, retries, backoff)
+            except OSError as e:
+                problem = f"{e.strerror}"
+            if journal is not None and text is not None:
+                digest = content_hash(text)
+            read_stats.add(1, len(text or ""), time.perf_counter() - t1, t1 - t0)
+            text_q.put((path, dest, mode, text, problem, digest))
+
+    def dispatch(pool):
+        # at most 2 batches per worker are in flight; results are passed on
+        # in submission order
+        pending = collections.deque()
+        batch = []
+        skipped = []
+        remaining = readers
+        try:
+            while remaining:
+                item = text_q.get()
+                if item is DONE:
+                    remaining -= 1
+                    continue
+                path, dest, mode, text, problem, digest = item
+                if (resume and digest is not None and journal.done(path, digest)
+                        and os.path.exists(dest)):
+                    skipped.append((path, dest, mode, SKIPPED, (), (), digest, None))
+                    if len(skipped) >= batch_size:
+                        result_q.put((skipped, 0.0, 0, 0))
+                        skipped = []
+                    continue
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    pending.append(pool.submit(_convert_batch, batch,
+                            interpreter, include_dest, report is not None))
+                    batch = []
+                    while len(pending) > 2 * jobs:
+                        result_q.put(pending.popleft().result())
+            if batch:
+                pending.append(pool.submit(_convert_batch, batch, interpreter,
+                        include_dest, report is not None))
+            if skipped:
+                result_q.put((skipped, 0.0, 0, 0))
+            while pending:
+                result_q.put(pending.popleft().result())
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+            # drain the queue so that the readers (and discover behind
+            # them) aren't blocked on full queues and can end
+            while remaining:
+                if text_q.get() is DONE:
+                    remaining -= 1
+        finally:
+            result_q.put(DONE)
+
+    def write_output(dest, text, mode):
+        def write_file():
+            dest_dir = os.path.dirname(dest)
+            if dest_dir and dest_dir not in made:
+                os.makedirs(dest_dir, exist_ok = True)
+                made.add(dest_dir)
+            p2s.write_atomic(dest, text, mode)
+        with_retries(write_file, retries, backoff)
+
+    failed = []
+    made = set()
+    memo = [0, 0]
+    # (script, includes) of the scripts that source files
+    sourced = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers = jobs,
+            initializer = _init_worker, initargs = (rules_path,)) as pool:
+        threads = [threading.Thread(target = discover, daemon = True)]
+        threads.extend(threading.Thread(target = read, daemon = True)
+                for _ in range(readers))
+        threads.append(threading.Thread(target = dispatch, args = (pool,),
+                daemon = True))
+        for t in threads:
+            t.start()
+        while True:
+            t0 = time.perf_counter()
+            item = result_q.get()
+            t1 = time.perf_counter()
+            if item is DONE:
+                break
+            results, busy, hits, misses = item
+            memo[0] += hits
+            memo[1] += misses
+            nbytes = 0
+            for path, dest, mode, output, diags, includes, digest, source in results:
+                for d in diags:
+                    p2s.emit(d._replace(message = f"{path}: {d.message}"))
+                if output is SKIPPED:
+                    journal.add("s", path, digest)
+                    if report is not None:
+                        report.add(path, "skipped")
+                    continue
+                if output is None:
+                    failed.append(path)
+                    if journal is not None:
+                        journal.add("f", path, digest)
+                    if report is not None:
+                        report.add(path, "failed", source, None, diags)
+                    continue
+                output += "\n"
+                try:
+                    write_output(dest, output, mode)
+                except OSError as e:
+                    p2s.error(f"{dest}: {e.strerror}")
+                    failed.append(path)
+                    if journal is not None:
+                        journal.add("f", path, digest)
+                    if report is not None:
+                        report.add(path, "failed", source, output, diags)
+                    continue
+                nbytes += len(output)
+                if journal is not None:
+                    journal.add("c", path, digest)
+                if report is not None:
+                    report.add(path, "converted", source, output, diags)
+                if includes:
+                    sourced.append((os.path.abspath(path), includes))
+            if journal is not None:
+                journal.flush()
+            convert_stats.add(len(results), 0, busy)
+            write_stats.add(len(results), nbytes, time.perf_counter() - t1, t1 - t0)
+        for t in threads:
+            t.join()
+    if errors:
+        if journal is not None:
+            # what was converted so far can be resumed
+            journal.close()
+        if report is not None:
+            report.close()
+        raise errors[0]
+    graph = None
+    includes = None
+    if follow_includes:
+        includes = {"roots": roots, "suffix": suffix,
+                "output_dir": output_dir and os.path.abspath(output_dir),
+                "rules": rules_path and os.path.abspath(rules_path),
+                "sourced": sourced}
+        if shard is None:
+            graph = include_graph(roots, output_dir, suffix, rules_path,
+                    write_output)
+            for includer, found in sourced:
+                graph.add(includer, found)
+    stats = (read_stats, convert_stats, write_stats)
+    wall = time.perf_counter() - start
+    report_stats(stats, wall, memo, out)
+    skipped = 0
+    if journal is not None:
+        journal.close()
+        skipped = journal.counts["s"]
+        out.write(f"journal: {journal.counts['c']} converted, "
+                f"{journal.counts['f']} failed, {skipped} skipped\n")
+    if graph is not None:
+        graph.report(out)
+    if report is not None:
+        report.close()
+        out.write(f"report: {os.path.join(report.out_dir, 'index.html')}\n")
+    return {"files": write_stats.files, "failed": failed, "stats": stats,
+            "memo": tuple(memo), "includes": graph, "skipped": skipped,
+            "wall": wall, "shard": shard, "sourced": includes}
+
+################################################################################
+# sharded runs
+################################################################################
+
+def write_summary(summary, path):
+    """writes the summary of a run as JSON for merge_summaries"""
+    data = {"shard": summary["shard"], "files": summary["files"],
+            "failed": summary["failed"], "skipped": summary["skipped"],
+            "memo": summary["memo"], "wall": summary["wall"],
+            "stats": [{"name": st.name, "workers": st.workers, "files": st.files,
+                    "bytes": st.bytes, "busy": st.busy, "idle": st.idle}
+                    for st in summary["stats"]],
+            "sourced": summary["sourced"]}
+    p2s.write_atomic(path, json.dumps(data, indent = 1) + "\n")
+
+def merge_summaries(paths, out = sys.stderr):
+    """combines the summaries of the shards of a run, reports the stage
+    statistics of all shards together (wall time is that of the slowest
+    shard), and returns a summary dict like run(). Missing shards are
+    listed in 'missing'. The includes found by shards run with
+    follow_includes are converted here"""
+    merged = {"files": 0, "failed": [], "skipped": 0, "memo": (0, 0),
+            "wall": 0.0, "missing": [], "includes": None}
+    stats = {}
+    includes = None
+    sourced = []
+    shards = set()
+    n = None
+    for path in paths:
+        with open(path) as fh:
+            data = json.load(fh)
+        if data["shard"] is not None:
+            shards.add(data["shard"][0])
+            n = data["shard"][1]
+        merged["files"] += data["files"]
+        merged["failed"].extend(data["failed"])
+        merged["skipped"] += data["skipped"]
+        merged["memo"] = tuple(a + b for a, b in zip(merged["memo"], data["memo"]))
+        merged["wall"] = max(merged["wall"], data["wall"])
+        if data.get("sourced") is not None:
+            includes = data["sourced"]
+            sourced.extend(includes["sourced"])
+        for st in data["stats"]:
+            if st["name"] not in stats:
+                stats[st["name"]] = StageStats(st["name"], st["workers"])
+            stats[st["name"]].add(st["files"], st["bytes"], st["busy"], st["idle"])
+    if n is not None:
+        merged["missing"] = sorted(set(range(n)) - shards)
+    merged["failed"].sort()
+    merged["stats"] = tuple(stats.values())
+    if merged["stats"]:
+        report_stats(merged["stats"], merged["wall"], merged["memo"], out)
+    out.write(f"shards: {len(paths)}, files: {merged['files']}, "
+            f"failed: {len(merged['failed'])}, skipped: {merged['skipped']}\n")
+    if merged["missing"]:
+        out.write(f"missing shards: {' '.join(map(str, merged['missing']))}\n")
+    if includes is not None:
+        graph = include_graph(includes["roots"], includes["output_dir"],
+                includes["suffix"], includes["rules"], p2s.write_atomic)
+        for includer, found in sourced:
+            graph.add(includer, found)
+        graph.report(out)
+        merged["includes"] = graph
+    return merged
+
+def shard_script(n, argv, summary_dir = "pbs2slurm-shards",
+        python = sys.executable):
+    """returns an sbatch script for a job array that runs pbs2slurm_bulk
+    with the arguments argv as N shards, one per array task. The summary of
+    each shard is written to summary_dir for --merge"""
+    bulk = shlex.join([python, os.path.abspath(__file__)] + list(argv))
+    summary = shlex.quote(summary_dir)
+    return f"""#! /bin/bash
+#SBATCH --array=0-{n - 1}
+#SBATCH --job-name=pbs2slurm-shards
+#SBATCH --output=pbs2slurm-shard-%a.log
+# converts a corpus as {n} shards. When all tasks have finished, combine
+# their summaries with
+#   {shlex.join([python, os.path.abspath(__file__), "--merge"])} {summary}/shard-*.json
+mkdir -p {summary}
+{bulk} --shard "$SLURM_ARRAY_TASK_ID/{n}" \\
+    --summary {summary}/"shard-$SLURM_ARRAY_TASK_ID.json"
+"""
+
+################################################################################
+# command line interface
+################################################################################
+
+if __name__ == "__main__":
+    import argparse
+    cmdline = argparse.ArgumentParser(description = __doc__,
+            formatter_class = argparse.RawDescriptionHelpFormatter)
+    cmdline.add_argument("--output-dir", "-o", default = None,
+            help = """Write converted scripts below this directory instead of
+                      next to the originals""")
+    cmdline.add_argument("--suffix", default = None,
+            help = """Suffix of converted scripts. Defaults to '.slurm', or
+                      to no suffix with --output-dir""")
+    cmdline.add_argument("--shell", "-s", default = "/bin/bash",
+            help = """Shell to insert if shebang line (#! ...) is missing.
+                      Defaults to '/bin/bash'""")
+    cmdline.add_argument("--rules", "-r", default = None,
+            help = """Rule file with site specific translation rules.
+                      Defaults to the built-in pbs2slurm_rules.toml""")
+    cmdline.add_argument("--jobs", "-j", type = int, default = None,
+            help = "Number of worker processes. Defaults to the number of CPUs")
+    cmdline.add_argument("--readers", type = int, default = 8,
+            help = "Number of reader threads. Defaults to 8")
+    cmdline.add_argument("--queue-size", type = int, default = 256,
+            help = "Scripts buffered between stages. Defaults to 256")
+    cmdline.add_argument("--batch-size", type = int, default = 32,
+            help = "Scripts sent to a worker at a time. Defaults to 32")
+    cmdline.add_argument("--follow-includes", action = "store_true",
+            default = False,
+            help = """Also convert files included with source or ., once
+                      each, next to the originals with the suffix .slurm""")
+    cmdline.add_argument("--journal", default = None, metavar = "FILE",
+            help = "Record the converted, failed, and skipped scripts in FILE")
+    cmdline.add_argument("--resume", action = "store_true", default = False,
+            help = """Continue the run recorded in the journal, skipping
+                      scripts that were converted and haven't changed""")
+    cmdline.add_argument("--retries", type = int, default = 3,
+            help = "Retries of reads and writes after transient errors. Defaults to 3")
+    cmdline.add_argument("--backoff", type = float, default = 1.0,
+            help = """Seconds before the first retry; doubled for each
+                      further retry. Defaults to 1""")
+    cmdline.add_argument("--shard", default = None, metavar = "K/N",
+            help = "Only convert shard K (0..N-1) of N of the scripts")
+    cmdline.add_argument("--summary", default = None, metavar = "FILE",
+            help = "Write the summary of the run as JSON to FILE")
+    cmdline.add_argument("--report", default = None, metavar = "DIR",
+            help = "Write a paginated HTML and JSON report of the run to DIR")
+    cmdline.add_argument("--make-shards", type = int, default = None,
+            metavar = "N",
+            help = """Print an sbatch job array script that runs the
+                      conversion as N shards instead of converting""")
+    cmdline.add_argument("--merge", action = "store_true", default = False,
+            help = """Combine the summaries (paths) of the shards of a run,
+                      print the scripts that failed, and exit with 1 if any
+                      failed or shards are missing""")
+    cmdline.add_argument("paths", nargs = "+",
+            help = "Batch scripts or directories of batch scripts")
+    args = cmdline.parse_args()
+    if args.resume and args.journal is None:
+        cmdline.error("--resume requires --journal")
+    if args.merge:
+        merged = merge_summaries(args.paths)
+        for path in merged["failed"]:
+            print(path)
+        sys.exit(1 if merged["failed"] or merged["missing"] else 0)
+    if args.make_shards is not None:
+        argv = []
+        skip = False
+        for arg in sys.argv[1:]:
+            if skip or arg.startswith("--make-shards="):
+                skip = False
+            elif arg == "--make-shards":
+                skip = True
+            else:
+                argv.append(arg)
+        sys.stdout.write(shard_script(args.make_shards, argv))
+        sys.exit(0)
+    shard = None
+    if args.shard is not None:
+        try:
+            shard = parse_shard(args.shard)
+        except ValueError as e:
+            cmdline.error(str(e))
+    summary = run(args.paths, args.output_dir, args.suffix, args.rules,
+            args.shell, args.readers, args.jobs, args.queue_size,
+            args.batch_size, args.follow_includes, args.journal, args.resume,
+            args.retries, args.backoff, shard, args.report)
+    if args.summary is not None:
+        write_summary(summary, args.summary)
+    sys.exit(1 if summary["failed"] else 0)
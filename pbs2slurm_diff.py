@@ -0,0 +1,174 @@
+#! /usr/local/bin/python
+# vim: set ft=python :
+"""
+Differential corpus runner for pbs2slurm engines.
+
+Every file below the corpus directory is converted by two implementations of
+convert_batch_script - the baseline (by default the current pbs2slurm) and a
+candidate - in a pool of worker processes. Engines are given as
+module:function and are called with the text of a script. Any difference in
+the converted script or in the diagnostics (INFO/WARNING/ERROR messages and
+anything else written to stderr) is reported as a unified diff.
+
+The run fails (exit status 1) if any script diverges or if the candidate is
+slower than the baseline by more than the allowed factor.
+
+Examples:
+    pbs2slurm_diff --candidate fast_pbs2slurm:convert_batch_script corpus/
+    pbs2slurm_diff -j 16 --max-slowdown 1.05 --candidate new:convert corpus/
+"""
+
+import sys
+import os
+import io
+import time
+import difflib
+import importlib
+import itertools
+import contextlib
+import concurrent.futures
+
+import pbs2slurm as p2s
+
+DEFAULT_ENGINE = "pbs2slurm:convert_batch_script"
+
+_engines = {}
+
+def load_engine(spec):
+    """imports a module:function engine (cached per process)"""
+    if spec not in _engines:
+        modname, _, funcname = spec.partition(":")
+        if funcname == "":
+            raise ValueError(f"engine '{spec}' is not of the form module:function")
+        _engines[spec] = getattr(importlib.import_module(modname), funcname)
+    return _engines[spec]
+
+def run_engine(engine, text):
+    """converts text with an engine and returns (output, diagnostics, status,
+    seconds). Diagnostics are the pbs2slurm messages followed by any other
+    lines written to stderr"""
+    stderr = io.StringIO()
+    output = None
+    status = 0
+    # engines that share the header memo of pbs2slurm would find the
+    # headers the other engine translated, so every run starts without it
+    for module in {p2s, sys.modules.get(getattr(engine, "__module__", None))}:
+        memo = getattr(module, "header_memo", None)
+        if isinstance(memo, p2s.LRUMemo):
+            memo.clear()
+    start = time.perf_counter()
+    with p2s.collect_diagnostics() as diags, contextlib.redirect_stderr(stderr):
+        try:
+            output = engine(text)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            status = f"{type(e).__name__}: {e}"
+    elapsed = time.perf_counter() - start
+    messages = [f"{d.level}: {d.message}" for d in diags]
+    messages.extend(stderr.getvalue().splitlines())
+    return output, messages, status, elapsed
+
+# converted once by every engine when a worker starts so that imports and
+# rule loading are not counted against the first file
+WARMUP_SCRIPT = """#! /bin/bash
+#PBS -N warmup
+#PBS -l walltime=1:00:00
+cd $PBS_O_WORKDIR
+"""
+
+def _init_worker(*engines):
+    for spec in engines:
+        run_engine(load_engine(spec), WARMUP_SCRIPT)
+
+def compare_file(path, baseline, candidate):
+    """converts one file with both engines"""
+    with open(path, encoding = "utf-8", errors = "surrogateescape") as fh:
+        text = fh.read()
+    base = run_engine(load_engine(baseline), text)
+    cand = run_engine(load_engine(candidate), text)
+    return path, base, cand
+
+def corpus_files(corpus):
+    """all regular files below corpus in a stable order"""
+    for dirpath, dirnames, filenames in os.walk(corpus):
+        dirnames.sort()
+        for fn in sorted(filenames):
+            yield os.path.join(dirpath, fn)
+
+def report_difference(path, base, cand, out):
+    """writes the differences between two engine results for one file"""
+    out.write(f"DIVERGENCE: {path}\n")
+    if base[2] != cand[2]:
+        out.write(f"  exit status: baseline {base[2]!r}, candidate {cand[2]!r}\n")
+    if base[0] != cand[0]:
+        out.writelines(difflib.unified_diff(
+            (base[0] or "").splitlines(True), (cand[0] or "").splitlines(True),
+            "baseline", "candidate"))
+        out.write("\n")
+    if base[1] != cand[1]:
+        out.writelines(difflib.unified_diff(
+            [m + "\n" for m in base[1]], [m + "\n" for m in cand[1]],
+            "baseline diagnostics", "candidate diagnostics"))
+
+def run(corpus, candidate, baseline = DEFAULT_ENGINE, jobs = None,
+        max_slowdown = 1.1, out = sys.stdout):
+    """compares two engines over a corpus and returns a summary dict. 'ok' is
+    False if any script diverged or the candidate was more than max_slowdown
+    times slower than the baseline"""
+    nfiles = 0
+    divergent = []
+    base_time = cand_time = 0.0
+    paths = corpus_files(corpus)
+    with concurrent.futures.ProcessPoolExecutor(max_workers = jobs,
+            initializer = _init_worker, initargs = (baseline, candidate)) as pool:
+        results = pool.map(compare_file, paths,
+                itertools.repeat(baseline), itertools.repeat(candidate),
+                chunksize = 16)
+        for path, base, cand in results:
+            nfiles += 1
+            base_time += base[3]
+            cand_time += cand[3]
+            if base[:3] != cand[:3]:
+                divergent.append(path)
+                report_difference(path, base, cand, out)
+    # throughput ratio > 1 means the candidate is faster
+    ratio = base_time / cand_time if cand_time > 0 else float("inf")
+    slow = ratio < 1.0 / max_slowdown
+    out.write(f"files:      {nfiles}\n")
+    out.write(f"divergent:  {len(divergent)}\n")
+    if nfiles:
+        out.write(f"baseline:   {nfiles / base_time if base_time else 0:.1f} files/s\n")
+        out.write(f"candidate:  {nfiles / cand_time if cand_time else 0:.1f} files/s\n")
+    out.write(f"throughput: {ratio:.2f}x baseline"
+            f"{' (slower than allowed)' if slow else ''}\n")
+    return {"files": nfiles, "divergent": divergent, "baseline_time": base_time,
+            "candidate_time": cand_time, "ratio": ratio,
+            "ok": not divergent and not slow}
+
+################################################################################
+# command line interface
+################################################################################
+
+if __name__ == "__main__":
+    import argparse
+    cmdline = argparse.ArgumentParser(description = __doc__,
+            formatter_class = argparse.RawDescriptionHelpFormatter)
+    cmdline.add_argument("--baseline", "-b", default = DEFAULT_ENGINE,
+            help = f"""Reference engine as module:function.
+                      Defaults to '{DEFAULT_ENGINE}'""")
+    cmdline.add_argument("--candidate", "-c", required = True,
+            help = "Engine to check as module:function")
+    cmdline.add_argument("--jobs", "-j", type = int, default = None,
+            help = "Number of worker processes. Defaults to the number of CPUs")
+    cmdline.add_argument("--max-slowdown", type = float, default = 1.1,
+            help = """Fail if the candidate is slower than the baseline by
+                      more than this factor. Defaults to 1.1""")
+    cmdline.add_argument("corpus", help = "Directory of batch scripts")
+    args = cmdline.parse_args()
+    if not os.path.isdir(args.corpus):
+        print(f"{args.corpus} is not a directory", file = sys.stderr)
+        sys.exit(1)
+    summary = run(args.corpus, args.candidate, args.baseline, args.jobs,
+            args.max_slowdown)
+    sys.exit(0 if summary["ok"] else 1)
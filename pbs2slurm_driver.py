@@ -0,0 +1,498 @@
+# vim: set ft=python :
+"""
+Translates driver scripts that submit PBS jobs with qsub.
+
+A loop like
+
+    for s in a b c; do
+        qsub -N align -v SAMPLE=$s align.pbs
+    done
+
+submits one job per iteration. Ported line by line to sbatch this floods the
+Slurm controller, so loops whose body is a single qsub call that only varies
+-v variables, -F arguments, the job name, or the output files are collapsed
+into a single 'sbatch --array' submission. The loop values are written to a
+task lookup file (or, for numeric ranges, taken directly from the array
+index) and a small array script piped to sbatch sets the loop variable for
+each task before running the job script.
+
+qsub calls that can't be collapsed are translated to plain sbatch calls.
+With the job_control policy setting, loops that poll qstat until a
+submitted job ends are replaced with sbatch --wait (see
+pbs2slurm.fix_job_control), and the qsub calls in the body of batch
+scripts are translated as well.
+"""
+
+import os
+import re
+
+import pbs2slurm as p2s
+
+# qsub options that take an argument; all others are flags
+QSUB_ARG_OPTIONS = set("aAcCdDeFjJklmMNopPqrStuvwW")
+# options of a collapsed qsub call that may refer to the loop variable
+VARYING_OPTIONS = set("vFNoe")
+ARRAY_HEREDOC = "PBS2SLURM_ARRAY"
+
+_for_in_re = re.compile(r'^([ \t]*)for[ \t]+([A-Za-z_]\w*)[ \t]+in[ \t]+(.*?)[ \t]*(;[ \t]*do)?[ \t]*$')
+_for_c_re = re.compile(r'^([ \t]*)for[ \t]*\(\([ \t]*([A-Za-z_]\w*)[ \t]*=[ \t]*(\S+?)[ \t]*;'
+        r'[ \t]*\2[ \t]*(<=?)[ \t]*(\S+?)[ \t]*;[ \t]*(?:\2\+\+|\+\+\2|\2[ \t]*\+=[ \t]*1)[ \t]*\)\)'
+        r'[ \t]*(;[ \t]*do)?[ \t]*$')
+_one_line_loop_re = re.compile(r'^(.*?);[ \t]*do[ \t]+(.*?)[ \t]*;?[ \t]*done[ \t]*$')
+_do_re = re.compile(r'^[ \t]*do[ \t]*$')
+_done_re = re.compile(r'^[ \t]*done[ \t]*$')
+_nested_re = re.compile(r'^[ \t]*(for|while|until|select|do|done)\b')
+_qsub_re = re.compile(r'(?<![\w./-])qsub(?=[ \t]|$)')
+_bound_re = re.compile(r'^(\d+|\$[A-Za-z_]\w*|\$\{[A-Za-z_]\w*\})$')
+_brace_range_re = re.compile(r'^\{(-?\d+)\.\.(-?\d+)\}$')
+_seq_re = re.compile(r'^(?:\$\(|`)seq[ \t]+(\S+)(?:[ \t]+(\S+))?(?:[ \t]+(\S+))?[ \t]*(?:\)|`)$')
+
+def split_words(s, start = 0):
+    """splits a shell command into words without removing quotes. Stops at the
+    first unquoted command terminator and returns (words, end)"""
+    words = []
+    i = start
+    n = len(s)
+    word_start = None
+    quote = None
+    depth = 0
+    while i < n:
+        c = s[i]
+        if quote is not None:
+            if c == "\\" and quote == '"':
+                i += 1
+            elif c == quote:
+                quote = None
+        elif c == "\\":
+            if word_start is None:
+                word_start = i
+            i += 1
+        elif c in "'\"":
+            quote = c
+            if word_start is None:
+                word_start = i
+        elif c == "(" and i > 0 and s[i - 1] == "$":
+            depth += 1
+        elif c == ")" and depth > 0:
+            depth -= 1
+        elif depth == 0 and (c in ";&|)`#\n" and (c != "#" or word_start is None)):
+            break
+        elif depth == 0 and c in " \t":
+            if word_start is not None:
+                words.append(s[word_start:i])
+                word_start = None
+            i += 1
+            continue
+        elif word_start is None:
+            word_start = i
+        i += 1
+    if word_start is not None:
+        words.append(s[word_start:i])
+    return words, i
+
+def unquote(word):
+    """removes one level of surrounding quotes"""
+    if len(word) >= 2 and word[0] == word[-1] and word[0] in "'\"":
+        return word[1:-1]
+    return word
+
+def parse_qsub(words):
+    """parses the words of a qsub call into ([(option, argument)], script,
+    extra words). Returns None if the call can't be parsed"""
+    opts = []
+    i = 1
+    while i < len(words) and words[i].startswith("-") and words[i] != "-":
+        word = words[i]
+        if word == "--":
+            return None
+        opt = word[1]
+        if opt in QSUB_ARG_OPTIONS:
+            if len(word) > 2:
+                arg = word[2:]
+            elif i + 1 < len(words):
+                i += 1
+                arg = words[i]
+            else:
+                return None
+        else:
+            arg = None
+        opts.append((opt, arg))
+        i += 1
+    if i >= len(words):
+        return None
+    return opts, words[i], words[i + 1:]
+
+def uses_var(text, var):
+    return re.search(r'\$(' + var + r'\b|\{' + var + r'[}:#%/^,\[])', text) is not None
+
+def escape_var(text, var):
+    """escapes references to var so that they are expanded in the array job
+    instead of at submission"""
+    return re.sub(r'\$(?=' + var + r'\b|\{' + var + r'[}:#%/^,\[])', r'\\$', text)
+
+def drop_var(text, var):
+    return re.sub(r'\$(' + var + r'\b|\{' + var + r'\})', "", text)
+
+# PBS dependency types that slurm has as well
+DEPENDENCY_TYPES = {"after", "afterok", "afternotok", "afterany"}
+
+def translate_dependency(value):
+    """translates the value of qsub -W depend=... (type:id[:id...] joined
+    with ',') to --dependency, or returns None if slurm has no equivalent.
+    Server names are removed from the job ids"""
+    out = []
+    for item in value.split(","):
+        kind, _, ids = item.partition(":")
+        if kind not in DEPENDENCY_TYPES or not ids:
+            p2s.warn(f"qsub -W depend={value}: '{kind}' has no sbatch equivalent -> dropped")
+            return None
+        ids = [re.sub(r'^(\d+(?:\[\d*\])?)\.[\w.-]+$', r'\1', i) for i in ids.split(":")]
+        out.append(":".join([kind] + ids))
+    return "--dependency=" + ",".join(out)
+
+def script_arguments(arg):
+    """the words qsub -F passes to the job script. qsub splits the argument
+    at blanks; each word keeps the quotes of the argument"""
+    value = unquote(arg)
+    quote = arg[0] if value != arg else ""
+    return [f"{quote}{w}{quote}" for w in value.split()]
+
+def translate_qsub_options(opts, rules):
+    """translates qsub options to sbatch options with the directive rules"""
+    out = []
+    reported = set()
+    lines = [f"#PBS -{opt}" if arg is None else f"#PBS -{opt} {unquote(arg)}"
+            for opt, arg in opts]
+    ctx = p2s.header_context("\n".join(lines), rules)
+    # the components of a heterogeneous job are added after all other
+    # options; lines for the body of a script have no place on the command
+    # line
+    with p2s.collect_tail() as tail, p2s.collect_prologue():
+        for (opt, arg), line in zip(opts, lines):
+            if opt == "W":
+                key, _, value = unquote(arg).partition("=")
+                if key == "depend":
+                    dependency = translate_dependency(value)
+                    if dependency is not None:
+                        out.append(dependency)
+                else:
+                    p2s.warn(f"qsub -W {unquote(arg)}: attribute '{key}' has no sbatch "
+                            "equivalent -> dropped")
+                continue
+            translated = p2s.translate_directive(line, rules, reported, ctx)
+            if translated == line:
+                p2s.warn(f"qsub -{opt} has no sbatch equivalent -> dropped")
+                continue
+            for sbatch in translated.split("\n"):
+                if sbatch.startswith("#SBATCH "):
+                    out.append(sbatch[len("#SBATCH "):])
+    # sbatch separates the components with ':'
+    for sbatch in "\n".join(tail).split("\n") if tail else ():
+        out.append(":" if sbatch == "#SBATCH hetjob" else sbatch[len("#SBATCH "):])
+    return out
+
+def translate_qsub(cmd, rules):
+    """translates a single qsub call (the words up to the command terminator)
+    to sbatch. Returns None if it can't be parsed"""
+    words, end = split_words(cmd)
+    parsed = parse_qsub(words)
+    if parsed is None:
+        return None
+    opts, script, extra = parsed
+    args = [w for opt, arg in opts if opt == "F" for w in script_arguments(arg)]
+    opts = [(opt, arg) for opt, arg in opts if opt != "F"]
+    sbatch = ["sbatch"] + translate_qsub_options(opts, rules) + [script] + args + extra
+    return " ".join(sbatch) + cmd[end:]
+
+def translate_qsub_calls(line, rules):
+    """translates all qsub calls in a line to sbatch"""
+    out = []
+    pos = 0
+    for m in _qsub_re.finditer(line):
+        if m.start() < pos:
+            continue
+        words, end = split_words(line, m.start())
+        translated = translate_qsub(line[m.start():end], rules)
+        if translated is None:
+            p2s.warn(f"could not parse qsub call '{line[m.start():end]}' -> left unchanged")
+            continue
+        prefix = line[pos:m.start()]
+        # sbatch prints 'Submitted batch job N' unless asked for just the id
+        if prefix.rstrip().endswith(("$(", "`")):
+            translated = translated.replace("sbatch", "sbatch --parsable", 1)
+        out.append(prefix)
+        out.append(translated)
+        pos = end
+    out.append(line[pos:])
+    return "".join(out)
+
+def translate_body_qsub_calls(text, rules):
+    """translates the qsub calls in the shell code of the body of a batch
+    script to sbatch. Lines are translated one by one so that the body keeps
+    its lines; qsub calls continued over several lines are left unchanged.
+    Every change is reported with the line (counted from 0) it was made in"""
+    out = []
+    for start, end, kind in p2s.shell_segments(text):
+        chunk = text[start:end]
+        if kind != "code" or not _qsub_re.search(chunk):
+            out.append(chunk)
+            continue
+        first = text.count("\n", 0, start)
+        lines = chunk.split("\n")
+        for i, line in enumerate(lines):
+            if not _qsub_re.search(line) or line.lstrip().startswith("#"):
+                continue
+            if line.endswith("\\") or i > 0 and lines[i - 1].endswith("\\"):
+                p2s.emit(p2s.Diagnostic("WARNING", "qsub call continued over "
+                        "several lines -> left unchanged", first + i, "qsub"))
+                continue
+            with p2s.collect_diagnostics() as diags:
+                lines[i] = translate_qsub_calls(line, rules)
+            for d in diags:
+                p2s.emit(d._replace(line = first + i, rule = "qsub"))
+            if lines[i] != line:
+                p2s.emit(p2s.Diagnostic("INFO", f"'{line.strip()}' -> "
+                        f"'{lines[i].strip()}'", first + i, "qsub"))
+        out.append("\n".join(lines))
+    return "".join(out)
+
+def loop_range(kind, var, spec):
+    """returns (array spec, count or None) if the loop values are a numeric
+    range that can be used as array indices directly, otherwise None"""
+    if kind == "c":
+        # bare names are variables in arithmetic context
+        lo, op, hi = (f"${b}" if re.match(r'^[A-Za-z_]\w*$', b) else b for b in spec)
+        if not (_bound_re.match(lo) and _bound_re.match(hi)):
+            return None
+        if op == "<":
+            hi = str(int(hi) - 1) if hi.isdigit() else f"$(({hi} - 1))"
+        count = int(hi) - int(lo) + 1 if lo.isdigit() and hi.isdigit() else None
+        return f"{lo}-{hi}", count
+    words, _ = split_words(spec)
+    if len(words) != 1:
+        return None
+    m = _brace_range_re.match(words[0])
+    # zero padded ranges ({01..10}) are not the same as the array indices
+    if m is not None and not re.match(r'^-?0\d', m.group(1)):
+        lo, hi = int(m.group(1)), int(m.group(2))
+        if lo < 0 or hi < lo:
+            return None
+        return f"{lo}-{hi}", hi - lo + 1
+    m = _seq_re.match(words[0])
+    if m is None or m.group(1).startswith("-"):
+        return None
+    bounds = [b for b in m.groups() if b is not None]
+    if not all(_bound_re.match(b) for b in bounds):
+        return None
+    if len(bounds) == 1:
+        lo, step, hi = "1", "1", bounds[0]
+    elif len(bounds) == 2:
+        lo, step, hi = bounds[0], "1", bounds[1]
+    else:
+        lo, step, hi = bounds
+    if not step.isdigit():
+        return None
+    count = None
+    if lo.isdigit() and hi.isdigit():
+        count = (int(hi) - int(lo)) // int(step) + 1
+    return f"{lo}-{hi}" + ("" if step == "1" else f":{step}"), count
+
+def convert_job_script(script, script_dir, rules):
+    """the translated job script, or None if it can't be read"""
+    if script_dir is None or "$" in script or "`" in script:
+        return None
+    path = os.path.join(script_dir, unquote(script))
+    try:
+        with open(path) as fh:
+            text = fh.read()
+    except OSError:
+        return None
+    with p2s.collect_diagnostics():
+        try:
+            converted = p2s.convert_batch_script(text, rules = rules)
+        except SystemExit:
+            return None
+    return converted
+
+def collapse_loop(indent, kind, var, spec, body, rules, interpreter,
+        script_dir, nloop):
+    """returns the lines replacing a qsub loop, or None if the loop is not a
+    simple qsub loop"""
+    commands = [l for l in body if l.strip() != "" and not l.lstrip().startswith("#")]
+    if len(commands) != 1:
+        return None
+    cmd = commands[0].strip()
+    if not _qsub_re.match(cmd):
+        return None
+    words, end = split_words(cmd)
+    if cmd[end:].strip() not in ("", ";"):
+        return None
+    parsed = parse_qsub(words)
+    if parsed is None:
+        return None
+    opts, script, extra = parsed
+    if extra or uses_var(script, var):
+        return None
+    fixed = []
+    assignments = []
+    args = []
+    for opt, arg in opts:
+        if opt in "Jt":
+            return None
+        if opt == "v":
+            for item in unquote(arg).split(","):
+                name, eq, value = item.strip().partition("=")
+                if eq:
+                    assignments.append((name, value))
+            continue
+        if opt == "F":
+            args.extend(script_arguments(arg))
+            continue
+        if arg is not None and uses_var(arg, var):
+            if opt not in VARYING_OPTIONS:
+                return None
+            if opt == "N":
+                p2s.info(f"qsub -N {arg}: array tasks share the job name -> '{drop_var(arg, var)}'")
+                arg = drop_var(arg, var)
+            else:
+                arg = re.sub(r'\$(' + var + r'\b|\{' + var + r'\})', "%a", arg)
+                p2s.info(f"qsub -{opt}: one file per array task named by task index ('%a')")
+        fixed.append((opt, arg))
+    sbatch_opts = translate_qsub_options(fixed, rules)
+
+    rng = loop_range(kind, var, spec)
+    lines = [f"{indent}# pbs2slurm: qsub loop over '{var}' collapsed into a single job array"]
+    if rng is not None:
+        array, count = rng
+        task_value = "\\$SLURM_ARRAY_TASK_ID"
+        if count is not None and count > 1000:
+            p2s.warn(f"job array with {count} tasks: check MaxArraySize of the cluster")
+    else:
+        if kind == "c":
+            return None
+        tasks = f"pbs2slurm_array_{nloop}.tasks"
+        # an expansion may produce no words; printf then writes an empty line
+        empty = " | sed '/^$/d'" if re.search(r'[$`*?\[]', spec) else ""
+        lines.append(f"{indent}printf '%s\\n' {spec}{empty} > {tasks}")
+        array = f"1-$(wc -l < {tasks})"
+        task_value = f'\\$(sed -n "\\${{SLURM_ARRAY_TASK_ID}}p" {tasks})'
+    # the sbatch call is skipped if the loop would not run at all; sbatch
+    # rejects an empty array (--array=1-0)
+    guard = None
+    if rng is None:
+        if empty:
+            guard = f"[ -s {tasks} ]"
+    elif count is None:
+        lo, _, hi = array.partition("-")
+        guard = f"[ {hi.partition(':')[0]} -ge {lo} ]"
+    elif count < 1:
+        p2s.info(f"qsub loop over '{var}' has no iterations -> dropped")
+        return [f"{indent}# pbs2slurm: qsub loop over '{var}' has no iterations"]
+    sbatch_indent = indent
+    if guard is not None:
+        lines.append(f"{indent}if {guard}; then")
+        sbatch_indent = indent + "    "
+    lines.append(f"{sbatch_indent}sbatch --array={array} {' '.join(sbatch_opts)}".rstrip()
+            + f" <<{ARRAY_HEREDOC}")
+    # the job script runs with the interpreter of its own #! line
+    converted = convert_job_script(script, script_dir, rules)
+    if converted is None:
+        p2s.warn(f"#PBS directives of {script} are not read when it is run from a "
+                 "job array; add them to the sbatch command")
+    elif converted.startswith("#!"):
+        interpreter = converted.split("\n", 1)[0][2:].strip() or interpreter
+    lines.append(f"#! {interpreter}")
+    if converted is not None:
+        lines.extend(l for l in converted.split("\n") if l.startswith("#SBATCH"))
+    lines.append(f"{var}={task_value}")
+    for name, value in assignments:
+        lines.append(f"export {name}={escape_var(value, var)}")
+    cmd = " ".join([interpreter, script] + [escape_var(a, var) for a in args])
+    lines.append(f"exec {cmd}")
+    lines.append(ARRAY_HEREDOC)
+    if guard is not None:
+        lines.append(f"{indent}fi")
+    p2s.info(f"collapsed qsub loop over '{var}' into 'sbatch --array={array}'")
+    return lines
+
+def logical_lines(text):
+    """yields (joined line, raw lines) with backslash continuations joined"""
+    raw = []
+    for line in text.split("\n"):
+        raw.append(line)
+        if line.endswith("\\"):
+            continue
+        yield " ".join(l[:-1] if l.endswith("\\") else l for l in raw), raw
+        raw = []
+    if raw:
+        yield " ".join(raw), raw
+
+def parse_loop_header(line):
+    """returns (indent, kind, var, spec, has_do) for a for loop header"""
+    m = _for_in_re.match(line)
+    if m is not None:
+        return m.group(1), "in", m.group(2), m.group(3), m.group(4) is not None
+    m = _for_c_re.match(line)
+    if m is not None:
+        return (m.group(1), "c", m.group(2), (m.group(3), m.group(4), m.group(5)),
+                m.group(6) is not None)
+    return None
+
+def convert_driver_script(text, rules = None, interpreter = "/bin/bash",
+        script_dir = None):
+    """translates a driver script that submits jobs with qsub. Simple qsub
+    loops become a single job array, all other qsub calls become sbatch
+    calls. script_dir is used to find the job scripts submitted in loops"""
+    if rules is None:
+        rules = p2s.load_rules()
+    lines = list(logical_lines(text))
+    out = []
+    nloop = 0
+    i = 0
+    while i < len(lines):
+        line, raw = lines[i]
+        collapsed = None
+        consumed = 1
+        m = _one_line_loop_re.match(line)
+        header = parse_loop_header(m.group(1) + "; do" if m else line)
+        if header is not None:
+            indent, kind, var, spec, has_do = header
+            if m is not None:
+                body = [m.group(2)]
+            else:
+                body = None
+                j = i + 1
+                if not has_do and j < len(lines) and _do_re.match(lines[j][0]):
+                    has_do = True
+                    j += 1
+                if has_do:
+                    body = []
+                    while j < len(lines) and not _done_re.match(lines[j][0]):
+                        if _nested_re.match(lines[j][0]):
+                            body = None
+                            break
+                        body.append(lines[j][0])
+                        j += 1
+                    if j == len(lines):
+                        body = None
+                consumed = j - i + 1
+            if body is not None:
+                collapsed = collapse_loop(indent, kind, var, spec, body, rules,
+                        interpreter, script_dir, nloop + 1)
+            if collapsed is None and body is not None and \
+                    any(_qsub_re.search(l) for l in body):
+                p2s.info(f"qsub loop over '{var}' is not a simple submission loop "
+                         "-> translated call by call")
+        if collapsed is not None:
+            nloop += 1
+            out.extend(collapsed)
+            i += consumed
+            continue
+        if _qsub_re.search(line):
+            out.append(translate_qsub_calls(line, rules))
+        else:
+            out.extend(raw)
+        i += 1
+    if rules["policy"]["job_control"]:
+        return p2s.fix_job_control("\n".join(out), rules["policy"])
+    return "\n".join(out)
@@ -0,0 +1,163 @@
+#! /usr/local/bin/python
+# vim: set ft=python :
+"""
+Follows files included with 'source' or '.' by converted batch scripts.
+
+Lab pipelines often source shared helper files that use PBS environment
+variables. Includes are resolved relative to the directory of the file that
+sources them and then relative to the directory of the batch script, which
+is also taken to be $PBS_O_WORKDIR and $(dirname $0). Includes with other
+variables in their path can't be resolved and are left alone.
+
+Every reachable include is converted once, written next to the original
+with a suffix (.slurm) or wherever the caller's destination function puts
+it, and the source commands in the converted scripts and includes are
+changed to read the converted file. An IncludeGraph keeps the conversions
+keyed by path, script directory and content hash, so that a bulk run over a
+tree of scripts converts a shared include a single time no matter how many
+scripts source it.
+"""
+
+import os
+import re
+import hashlib
+import collections
+
+import pbs2slurm as p2s
+
+INCLUDE_SUFFIX = ".slurm"
+
+# spellings of the directory of the script in include paths
+_script_dir_re = re.compile(
+        r'\$\{?(?:PBS_O_WORKDIR|SLURM_SUBMIT_DIR)\}?'
+        r'|\$\(dirname "?\$\{?0\}?"?\)|`dirname "?\$0"?`')
+
+def resolve_include(argument, file_dir, workdir = None):
+    """returns the normalized path of an include sourced by a file in
+    file_dir for a batch script in workdir (default file_dir), or None if it
+    can't be resolved or doesn't exist"""
+    workdir = workdir or file_dir
+    path = _script_dir_re.sub(lambda m: workdir, argument.replace('"', "").replace("'", ""))
+    if "$" in path or "`" in path or path == "":
+        return None
+    for base in (file_dir, workdir):
+        candidate = os.path.normpath(os.path.join(base, path))
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+def rewrite_includes(text, file_dir, workdir = None, suffix = INCLUDE_SUFFIX,
+        destination = None):
+    """changes the source commands in text that refer to existing files to
+    read the converted file instead. destination(path) is the converted file
+    of an include (default path + suffix); it has the name of the include
+    plus a suffix, which is added to the source argument. Returns (text,
+    included paths)"""
+    out = []
+    includes = []
+    pos = 0
+    for start, end, argument in p2s.find_includes(text):
+        path = resolve_include(argument, file_dir, workdir)
+        if path is None:
+            continue
+        includes.append(path)
+        if destination is not None:
+            suffix = os.path.basename(destination(path))[len(os.path.basename(path)):]
+        if argument[0] in "'\"":
+            new = argument[:-1] + suffix + argument[-1]
+        else:
+            new = argument + suffix
+        out.append(text[pos:start])
+        out.append(new)
+        pos = end
+    out.append(text[pos:])
+    return "".join(out), includes
+
+Node = collections.namedtuple("Node", "path digest includes")
+
+class IncludeGraph:
+    """the includes reachable from converted scripts. Each include is
+    converted once per (path, script directory, content hash) and handed to
+    write(path, text, mode) with the path of the converted file and the mode
+    of the original. destination(path) is the converted file of an include
+    (default path + suffix). Includes for which skip(path) is true are
+    converted by the caller (e.g. because they are scripts of a bulk run)
+    and are not converted again. Files that have been seen before are only
+    read again if their size or mtime changed"""
+    def __init__(self, rules = None, suffix = INCLUDE_SUFFIX, write = None,
+            destination = None, skip = None):
+        if rules is None:
+            rules = p2s.load_rules()
+        self.variables = rules["variables"]
+        self.suffix = suffix
+        self.write = write or p2s.write_atomic
+        self.destination = destination or (lambda path: path + suffix)
+        self.skip = skip
+        self.nodes = {}
+        self.included_by = collections.defaultdict(set)
+        self.conversions = 0
+        self.reuses = 0
+        self._seen = {}
+        # converted file -> (script directory, text) it was written with
+        self._outputs = {}
+
+    def add(self, includer, includes):
+        """records that the batch script includer sources includes (paths)
+        and converts any include that hasn't been converted yet"""
+        workdir = os.path.dirname(os.path.abspath(includer))
+        for path in includes:
+            self.included_by[path].add(includer)
+            self._visit(path, workdir)
+
+    def _visit(self, path, workdir):
+        if self.skip is not None and self.skip(path):
+            self.reuses += 1
+            return
+        dest = self.destination(path)
+        try:
+            st = os.stat(path)
+            stamp = (st.st_mtime_ns, st.st_size)
+            seen = self._seen.get((path, workdir))
+            if seen is not None and seen[0] == stamp:
+                self.reuses += 1
+                return
+            with open(path, "rb") as fh:
+                data = fh.read()
+        except OSError as e:
+            p2s.error(f"{path}: {e.strerror}")
+            return
+        digest = hashlib.sha256(data).hexdigest()
+        self._seen[(path, workdir)] = (stamp, digest)
+        # $PBS_O_WORKDIR in the include is the directory of the script
+        key = (path, workdir, digest)
+        if key in self.nodes:
+            # touched but not changed
+            self.reuses += 1
+            return
+        text = data.decode("utf-8", errors = "surrogateescape")
+        converted = p2s.fix_env_vars(text, self.variables)
+        converted, includes = rewrite_includes(converted,
+                os.path.dirname(path), workdir, destination = self.destination)
+        # recorded before following the includes so that cycles end here
+        self.nodes[key] = Node(path, digest, includes)
+        self.conversions += 1
+        first, text = self._outputs.setdefault(dest, (workdir, converted))
+        if first == workdir:
+            self._outputs[dest] = (workdir, converted)
+            self.write(dest, converted, st.st_mode)
+        elif text != converted:
+            p2s.warn(f"{path}: sources different files for scripts in {first} "
+                    f"and {workdir}; {dest} is converted for {first}")
+        for inc in includes:
+            self.included_by[inc].add(path)
+            self._visit(inc, workdir)
+
+    def report(self, out):
+        """writes the graph: every converted include with its hash, the
+        number of files that source it, and the files it sources"""
+        out.write(f"includes: {self.conversions} converted, {self.reuses} reused\n")
+        for node in sorted(self.nodes.values()):
+            out.write(f"  {node.path} [{node.digest[:12]}] "
+                    f"sourced by {len(self.included_by[node.path])}\n")
+            for inc in node.includes:
+                out.write(f"    -> {inc}\n")
@@ -0,0 +1,207 @@
+#! /usr/local/bin/python
+# vim: set ft=python :
+"""
+Writes a browsable report of a bulk conversion run.
+
+For every script the report shows the PBS script next to the converted
+Slurm script together with the diagnostics, like the test case page of
+pbs2slurm_tests. Scripts are written out in pages of a fixed number of
+scripts as they are converted, each page as HTML for reviewers and as
+JSON for tools:
+    page-00001.html, page-00001.json, ...
+    index.html      the pages with the scripts they hold and their
+                    warnings and errors
+    summary.html    counts of the directives that are dropped or unknown
+    summary.json    (as pbs2slurm --check classifies them) and of the
+                    diagnostics by level and rule
+Only the last two pages and the summary counters are kept in memory, so
+the memory used doesn't depend on the number of scripts.
+
+Used by pbs2slurm_bulk --report.
+"""
+
+import os
+import json
+import html
+import tempfile
+import collections
+
+import pbs2slurm as p2s
+
+PAGE_SIZE = 500
+
+_style = """pre.term {background-color: #eee; padding: 3px 5px; border: 1px solid #999}
+      td {vertical-align: top}
+      .ERROR {color: #b00} .WARNING {color: #a60}"""
+
+def _html_header(title):
+    return (f"""<!DOCTYPE html>
+<html lang="en">
+  <head>
+      <meta charset="utf-8">
+      <title>{html.escape(title)}</title>
+      <style>{_style}</style>
+  </head>
+  <body>
+    <h1>{html.escape(title)}</h1>
+""")
+
+_html_footer = """  </body>
+</html>
+"""
+
+def _page_name(number, ext):
+    return f"page-{number:05d}.{ext}"
+
+def _navigation(number, last):
+    links = ['<a href="index.html">index</a>', '<a href="summary.html">summary</a>']
+    if number > 1:
+        links.insert(0, f'<a href="{_page_name(number - 1, "html")}">previous</a>')
+    if not last:
+        links.append(f'<a href="{_page_name(number + 1, "html")}">next</a>')
+    return f"    <p>{' | '.join(links)}</p>\n"
+
+class Report:
+    """a report written to directory out_dir. add() the scripts in any
+    order and close() the report at the end"""
+    def __init__(self, out_dir, rules = None, page_size = PAGE_SIZE,
+            title = "pbs2slurm report"):
+        if rules is None:
+            rules = p2s.load_rules()
+        os.makedirs(out_dir, exist_ok = True)
+        self.rules = rules
+        self.out_dir = out_dir
+        self.page_size = page_size
+        self.title = title
+        self.scripts = 0
+        self.status = collections.Counter()
+        self.levels = collections.Counter()
+        self.by_rule = collections.Counter()
+        self.dropped = collections.Counter()
+        self._page = []
+        # a full page is written when the next one is full or at close(),
+        # when it is known whether it is the last page
+        self._full = None
+        self._pages = 0
+        # rows of the index are spooled to disk until the index is written
+        self._index = tempfile.TemporaryFile("w+", encoding = "utf-8",
+                dir = out_dir)
+
+    def add(self, path, status, pbs = None, slurm = None, diagnostics = ()):
+        """adds a script. status is 'converted', 'failed', or 'skipped';
+        pbs and slurm are the texts of the script (if known)"""
+        self.scripts += 1
+        self.status[status] += 1
+        for d in diagnostics:
+            self.levels[d.level] += 1
+            self.by_rule[d.level, d.rule or ""] += 1
+        if pbs is not None:
+            self._count_dropped(pbs)
+        self._page.append({"path": path, "status": status, "pbs": pbs,
+                "slurm": slurm, "diagnostics": [d._asdict() for d in diagnostics]})
+        if len(self._page) >= self.page_size:
+            if self._full is not None:
+                self._write_page(self._full, last = False)
+            self._full = self._page
+            self._page = []
+
+    def _count_dropped(self, pbs):
+        # resources of -l are counted one by one
+        resources = self.rules["resources"]
+        for _, line, status, _ in p2s.check_header(pbs.split("\n"), self.rules):
+            if status == "translated":
+                continue
+            opt, argument = p2s.tokenize_directive(line) or ("", "")
+            if opt == "l" and argument:
+                for item in argument.split(","):
+                    key = item.strip().partition("=")[0]
+                    if key not in resources:
+                        self.dropped[status, f"-l {key}"] += 1
+            else:
+                self.dropped[status, f"-{opt}" if opt else line[:40]] += 1
+
+    def _write_page(self, entries, last):
+        self._pages += 1
+        number = self._pages
+        p2s.write_atomic(os.path.join(self.out_dir, _page_name(number, "json")),
+                json.dumps({"page": number, "scripts": entries}) + "\n")
+        levels = collections.Counter(d["level"] for e in entries
+                for d in e["diagnostics"])
+        out = [_html_header(f"{self.title}: page {number}"),
+                _navigation(number, last),
+                '    <table>\n        <tr><th>PBS script</th><th>SLURM script</th></tr>\n']
+        for e in entries:
+            out.append(f'    <tr id="{html.escape(e["path"], quote = True)}">'
+                    f'<td colspan=2><b>{html.escape(e["path"])}</b> ({e["status"]})')
+            for d in e["diagnostics"]:
+                line = "" if d["line"] is None else f'line {d["line"]}: '
+                out.append(f'<br><span class="{d["level"]}">{d["level"]}: '
+                        f'{line}{html.escape(d["message"])}</span>')
+            out.append("</td></tr>\n")
+            if e["pbs"] is not None or e["slurm"] is not None:
+                out.append('    <tr><td><pre class="term">'
+                        f'{html.escape(e["pbs"] or "")}</pre></td>\n'
+                        '        <td><pre class="term">'
+                        f'{html.escape(e["slurm"] or "")}</pre></td></tr>\n')
+        out.append("    </table>\n")
+        out.append(_navigation(number, last))
+        out.append(_html_footer)
+        p2s.write_atomic(os.path.join(self.out_dir, _page_name(number, "html")),
+                "".join(out))
+        self._index.write(f'    <tr><td><a href="{_page_name(number, "html")}">'
+                f'{number}</a></td><td>{len(entries)}</td>'
+                f'<td>{levels["ERROR"]}</td><td>{levels["WARNING"]}</td>'
+                f'<td>{html.escape(entries[0]["path"])}</td>'
+                f'<td>{html.escape(entries[-1]["path"])}</td></tr>\n')
+
+    def summary(self):
+        """the summary counters as a dict"""
+        return {"scripts": self.scripts, "pages": self._pages,
+                "status": dict(self.status), "levels": dict(self.levels),
+                "dropped": [{"status": status, "directive": what, "count": n}
+                        for (status, what), n in self.dropped.most_common()],
+                "by_rule": [{"level": level, "rule": rule, "count": n}
+                        for (level, rule), n in self.by_rule.most_common()]}
+
+    def close(self):
+        """writes the last page, the index, and the summary pages"""
+        if self._page:
+            if self._full is not None:
+                self._write_page(self._full, last = False)
+            self._full = self._page
+            self._page = []
+        if self._full is not None:
+            self._write_page(self._full, last = True)
+            self._full = None
+        summary = self.summary()
+        p2s.write_atomic(os.path.join(self.out_dir, "summary.json"),
+                json.dumps(summary, indent = 1) + "\n")
+        out = [_html_header(f"{self.title}: summary"),
+                '    <p><a href="index.html">index</a></p>\n',
+                "    <h2>Scripts</h2>\n    <table>\n"]
+        for status, n in sorted(self.status.items()):
+            out.append(f"    <tr><td>{status}</td><td>{n}</td></tr>\n")
+        out.append("    </table>\n    <h2>Dropped and unknown directives</h2>\n    <table>\n")
+        for (status, what), n in self.dropped.most_common():
+            out.append(f"    <tr><td>{status}</td><td>{html.escape(what)}</td>"
+                    f"<td>{n}</td></tr>\n")
+        out.append("    </table>\n    <h2>Diagnostics by rule</h2>\n    <table>\n")
+        for (level, rule), n in self.by_rule.most_common():
+            out.append(f'    <tr><td class="{level}">{level}</td>'
+                    f"<td>{html.escape(rule or '-')}</td><td>{n}</td></tr>\n")
+        out.append("    </table>\n" + _html_footer)
+        p2s.write_atomic(os.path.join(self.out_dir, "summary.html"), "".join(out))
+        # the index can have many rows; it is copied from the spool file
+        with open(os.path.join(self.out_dir, "index.html"), "w",
+                encoding = "utf-8", errors = "surrogateescape") as fh:
+            fh.write(_html_header(self.title))
+            fh.write(f'    <p>{self.scripts} scripts in {self._pages} pages. '
+                    '<a href="summary.html">summary</a></p>\n')
+            fh.write("    <table>\n        <tr><th>page</th><th>scripts</th>"
+                    "<th>errors</th><th>warnings</th><th>first</th><th>last</th></tr>\n")
+            self._index.seek(0)
+            for row in self._index:
+                fh.write(row)
+            fh.write("    </table>\n" + _html_footer)
+        self._index.close()
+        return summary
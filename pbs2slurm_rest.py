@@ -0,0 +1,104 @@
+#! /usr/local/bin/python
+# vim: set ft=python :
+"""
+Converts a PBS batch script and submits it through the Slurm REST API
+(slurmrestd) without writing a Slurm script.
+
+The job description posted to slurmrestd is built from the translated
+#SBATCH options (see pbs2slurm.job_description); the converted script is
+sent along as the job script. The environment of the job is the current
+environment filtered by --export, and the working directory is the
+current directory.
+
+Authentication uses the user name and JWT given with --user/--token or in
+$SLURM_USER_NAME/$SLURM_JWT.
+
+Examples:
+    pbs2slurm_rest --url http://slurmrestd:6820 job.pbs
+    pbs2slurm_rest --url http://slurmrestd:6820 --dry-run job.pbs
+"""
+
+import sys
+import os
+import json
+import urllib.request
+import urllib.error
+
+import pbs2slurm as p2s
+
+DEFAULT_API = "v0.0.40"
+
+def submit(description, url, user = None, token = None, api = DEFAULT_API,
+        timeout = 30):
+    """posts a job description to slurmrestd and returns (HTTP status,
+    decoded response). Errors reported by slurmrestd are returned as well;
+    connection problems raise urllib.error.URLError"""
+    headers = {"Content-Type": "application/json"}
+    if user is not None:
+        headers["X-SLURM-USER-NAME"] = user
+    if token is not None:
+        headers["X-SLURM-USER-TOKEN"] = token
+    request = urllib.request.Request(
+            f"{url.rstrip('/')}/slurm/{api}/job/submit",
+            data = json.dumps(description).encode("utf-8"),
+            headers = headers, method = "POST")
+    try:
+        with urllib.request.urlopen(request, timeout = timeout) as response:
+            status, body = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, body = e.code, e.read()
+    try:
+        return status, json.loads(body or b"{}")
+    except ValueError:
+        return status, {"errors": [{"description": body.decode("utf-8", "replace")}]}
+
+def report_errors(response):
+    """reports the errors and warnings of a slurmrestd response"""
+    for w in response.get("warnings", []):
+        p2s.warn(w.get("description", str(w)))
+    for e in response.get("errors", []):
+        p2s.error(e.get("description") or e.get("error", str(e)))
+
+################################################################################
+# command line interface
+################################################################################
+
+if __name__ == "__main__":
+    import argparse
+    cmdline = argparse.ArgumentParser(description = __doc__,
+            formatter_class = argparse.RawDescriptionHelpFormatter)
+    cmdline.add_argument("--url", required = True,
+            help = "Base URL of slurmrestd, e.g. http://slurmrestd:6820")
+    cmdline.add_argument("--api", default = DEFAULT_API,
+            help = f"Version of the REST API. Defaults to {DEFAULT_API}")
+    cmdline.add_argument("--user", default = os.environ.get("SLURM_USER_NAME"),
+            help = "User name. Defaults to $SLURM_USER_NAME")
+    cmdline.add_argument("--token", default = os.environ.get("SLURM_JWT"),
+            help = "JWT for slurmrestd. Defaults to $SLURM_JWT")
+    cmdline.add_argument("--shell", "-s", default = "/bin/bash",
+            help = """Shell to insert if shebang line (#! ...) is missing.
+                      Defaults to '/bin/bash'""")
+    cmdline.add_argument("--rules", "-r", default = None,
+            help = """Rule file with site specific translation rules.
+                      Defaults to the built-in pbs2slurm_rules.toml""")
+    cmdline.add_argument("--dry-run", "-n", action = "store_true",
+            default = False,
+            help = "Print the job description instead of submitting it")
+    cmdline.add_argument("pbs_script", type = argparse.FileType("r"),
+            nargs = "?", default = sys.stdin)
+    args = cmdline.parse_args()
+    script, description = p2s.convert_batch_script(args.pbs_script.read(),
+            args.shell, p2s.load_rules(args.rules), describe = True)
+    if args.dry_run:
+        print(json.dumps(description, indent = 2))
+        sys.exit(0)
+    try:
+        status, response = submit(description, args.url, args.user,
+                args.token, args.api)
+    except urllib.error.URLError as e:
+        p2s.error(f"{args.url}: {e.reason}")
+        sys.exit(1)
+    report_errors(response)
+    if status != 200 or "job_id" not in response:
+        sys.exit(1)
+    print(response["job_id"])
@@ -1,7 +1,26 @@
 import pbs2slurm as p2s
+import pbs2slurm_diff
+import pbs2slurm_bulk
+import pbs2slurm_archive
+import pbs2slurm_rest
+import pbs2slurm_includes
+import pbs2slurm_report
+import json
+import array
+import threading
+import http.server
+import tarfile
+import zipfile
+import pbs2slurm_driver
 import sys
+import os
+import io
 import atexit
 import difflib
+import errno
+import tempfile
+import time
+import concurrent.futures
 
 def html_out(fh, pbs, slurm, desc):
     pbss = pbs.replace(">", "&gt;").replace("<", "&lt;")
@@ -158,6 +177,49 @@ gunzip -c sample${SLURM_ARRAY_TASK_ID}.fastq.gz \\
 """
     check(input, expected, p2s.convert_batch_script(input), desc)
 
+def test_heredocs_and_data():
+    desc = "Quoted here-documents and data after a top level <tt>exit</tt> are not changed"
+    input = """#! /bin/bash
+cd $PBS_O_WORKDIR
+cat > next.pbs <<'EOF'
+#PBS -N next
+echo $PBS_JOBID
+EOF
+cat <<EOF
+job $PBS_JOBID
+EOF
+if [ ! -e data ]; then
+    echo "missing; fi" # done
+    exit 1
+fi
+tail -n +$(grep -n '^__DATA__' $0 | cut -d: -f1) $0 | tar -x -C $PBS_O_WORKDIR
+exit 0
+__DATA__ $PBS_JOBID
+"""
+    expected = """#! /bin/bash
+cd $SLURM_SUBMIT_DIR
+cat > next.pbs <<'EOF'
+#PBS -N next
+echo $PBS_JOBID
+EOF
+cat <<EOF
+job $SLURM_JOB_ID
+EOF
+if [ ! -e data ]; then
+    echo "missing; fi" # done
+    exit 1
+fi
+tail -n +$(grep -n '^__DATA__' $0 | cut -d: -f1) $0 | tar -x -C $SLURM_SUBMIT_DIR
+exit 0
+__DATA__ $PBS_JOBID
+"""
+    check(input, expected, p2s.convert_batch_script(input), desc)
+    # exits that are part of a longer command are not the end of the script
+    for code in ("[ -f x ] ||\n  exit 1", "foo && \\\n exit 1", "(\n  exit 1\n)",
+            'echo "usage:\nexit\n"', "echo 'usage:\nexit\n'"):
+        body = code + "\ncd $PBS_O_WORKDIR\n"
+        assert p2s.fix_env_vars(body) == code + "\ncd $SLURM_SUBMIT_DIR\n", code
+
 ################################################################################
 # misc
 def test_missing_shebang():
@@ -177,6 +239,24 @@ cd /data/$USER/test_data
 """
     check(input, expected, p2s.convert_batch_script(input), desc)
 
+def test_script_spans():
+    text = """#! /bin/bash
+#PBS -N job
+# comment
+
+echo $PBS_JOBID
+"""
+    script = p2s.Script(text)
+    assert script.shebang == "#! /bin/bash"
+    assert script.header == "#PBS -N job\n# comment\n"
+    assert script.body == "echo $PBS_JOBID\n"
+    assert list(script.header_lines()) == ["#PBS -N job", "# comment", ""]
+    assert p2s.split_script(text) == (script.shebang, script.header, script.body)
+    # without #PBS directives the header is part of the body
+    script = p2s.Script("# comment\necho hi")
+    assert script.shebang is None and not script.has_directives
+    assert script.body == "# comment\necho hi"
+
 def test_header_identification():
     desc = """PBS directives in the header are identified and transformed. PBS directives
     in the body are left unchanged"""
@@ -828,12 +908,155 @@ set -o pipefail
 module load fastqc
 """
     check(input, expected, p2s.convert_batch_script(input), desc)
+    desc = "A walltime joined with ':' is found; of repeated walltimes the first is used"
+    input = """#! /bin/bash
+#PBS -l nodes=1:ppn=2:walltime=1:00:00
+#PBS -l walltime=2:00:00,mem=1gb,walltime=3:00:00
+hostname
+"""
+    expected = """#! /bin/bash
+#SBATCH --time=1:00:00
+#SBATCH --time=2:00:00
+hostname
+"""
+    with p2s.collect_diagnostics():
+        check(input, expected, p2s.convert_batch_script(input), desc)
 
 ################################################################################
 # PBS -q
 # should not have worked with the qsub wrapper. the instances i found were not
 # actually valid queues. drop -q lines
 
+def test_select():
+    desc = """PBS Pro <tt>select</tt> chunks are translated to nodes, tasks per node,
+    cpus per task and memory. <tt>ompthreads</tt> sets <tt>OMP_NUM_THREADS</tt>;
+    different chunks become a heterogeneous job"""
+    input = """#! /bin/bash
+#PBS -l select=4:ncpus=32:mpiprocs=8:ompthreads=4:mem=100gb
+#PBS -N hybrid
+cd $PBS_O_WORKDIR
+mpirun ./hybrid
+"""
+    expected = """#! /bin/bash
+#SBATCH --nodes=4
+#SBATCH --ntasks-per-node=8
+#SBATCH --cpus-per-task=4
+#SBATCH --mem=100G
+#SBATCH --job-name="hybrid"
+export OMP_NUM_THREADS=$SLURM_CPUS_PER_TASK
+cd $SLURM_SUBMIT_DIR
+mpirun ./hybrid
+"""
+    with p2s.collect_diagnostics():
+        conv = p2s.convert(input)
+    check(input, expected, conv.output, desc)
+    assert conv.output_line(3) == 6 and conv.output_line(4) == 8
+    input = """#! /bin/bash
+#PBS -l select=1:ncpus=2:mem=512mb+1:ncpus=2:mem=512mb+8:ncpus=16:mpiprocs=16
+#PBS -l walltime=2:00:00
+srun ./coupled
+"""
+    expected = """#! /bin/bash
+#SBATCH --nodes=2
+#SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task=2
+#SBATCH --mem=512M
+#SBATCH --time=2:00:00
+#SBATCH hetjob
+#SBATCH --nodes=8
+#SBATCH --ntasks-per-node=16
+#SBATCH --cpus-per-task=1
+srun ./coupled
+"""
+    with p2s.collect_diagnostics():
+        check(input, expected, p2s.convert_batch_script(input), desc)
+    assert p2s.pbs_size("2tb") == "2T"
+    assert p2s.pbs_size("1048577") == "2M"
+    assert p2s.pbs_size("4mw") is None
+
+def test_scratch():
+    desc = """Local disk requests (<tt>file=</tt>) are translated to <tt>--tmp</tt>
+    and the job scratch directory to <tt>$TMPDIR</tt>. Sites can allocate local
+    scratch as a generic resource instead"""
+    input = """#! /bin/bash
+#PBS -l file=200gb,walltime=1:00:00
+cd $PBS_JOBDIR
+"""
+    expected = """#! /bin/bash
+#SBATCH --tmp=200G
+#SBATCH --time=1:00:00
+cd $TMPDIR
+"""
+    check(input, expected, p2s.convert_batch_script(input), desc)
+    rules_file = write_rules("""
+[variables]
+PBS_JOBDIR = "LSCRATCH"
+
+[directives.l]
+handler = "resource_list"
+
+[resources]
+file = { handler = "scratch", gres = "lscratch" }
+""")
+    expected = """#! /bin/bash
+#SBATCH --gres=lscratch:200
+cd $LSCRATCH
+"""
+    try:
+        rules = p2s.load_rules(rules_file)
+        check(input, expected, p2s.convert_batch_script(input, rules = rules), desc)
+    finally:
+        os.unlink(rules_file)
+    assert p2s.resource_scratch("1500mb", "lscratch") == "#SBATCH --gres=lscratch:2"
+    assert p2s.resource_scratch("1tb", "lscratch", "m") == "#SBATCH --gres=lscratch:1048576"
+    # a bad unit is an error of the rule file, even if no script uses it
+    with p2s.collect_diagnostics() as diags:
+        try:
+            p2s.compile_rules({"resources": {"file": {"handler": "scratch",
+                    "gres": "lscratch", "unit": "gb"}}})
+            assert False
+        except SystemExit:
+            pass
+    assert [d.message for d in diags] == ["resources.file: unknown unit 'gb'"]
+
+def test_placement():
+    desc = """Placement (<tt>place=</tt>) and node access policies are translated
+    to <tt>--exclusive</tt>, <tt>--spread-job</tt>, <tt>--nodes=1</tt> and
+    <tt>--switches</tt>"""
+    input = """#! /bin/bash
+#PBS -l place=scatter:excl:group=switch,naccesspolicy=singlejob
+#PBS -l place=pack:shared,walltime=1:00:00
+#PBS -l place=free
+#PBS -l naccesspolicy=singleuser
+
+mpirun ./bandwidth
+"""
+    expected = """#! /bin/bash
+#SBATCH --spread-job
+#SBATCH --exclusive
+#SBATCH --switches=1
+#SBATCH --nodes=1
+#SBATCH --time=1:00:00
+
+#SBATCH --exclusive=user
+
+mpirun ./bandwidth
+"""
+    with p2s.collect_diagnostics() as diags:
+        conv = p2s.convert(input)
+    check(input, expected, conv.output, desc)
+    assert [d.line for d in diags] == [2, 2, 3, 4, 5]
+    # the first directive expands to three lines
+    assert conv.output_line(3) == 5
+    # select sets --nodes; place=pack never adds a second one
+    for header in ("#PBS -l select=2:ncpus=4,place=pack",
+            "#PBS -l place=pack\n#PBS -l select=2:ncpus=4",
+            "#PBS -l select=1:ncpus=4\n#PBS -l place=pack:excl"):
+        with p2s.collect_diagnostics() as diags:
+            out = p2s.convert_batch_script(header + "\nrun\n")
+        assert len([l for l in out.split("\n") if l.startswith("#SBATCH --nodes=")]) == 1
+        assert ("WARNING" in [d.level for d in diags]) == ("select=2" in header)
+
 def test_drop_queue():
     desc = "Drop <tt>#PBS -q</tt> since there is not reliable, straight forward translation. Please provide partition on the command line" 
     input = """#! /bin/bash
@@ -993,6 +1216,1040 @@ mpirun -np 24 program_name < inputfile > outputfile
     """
     check(input, expected, p2s.convert_batch_script(input), desc)
 
+################################################################################
+# rule files
+
+def write_rules(text):
+    fd, path = tempfile.mkstemp(suffix = ".toml")
+    with os.fdopen(fd, "w") as fh:
+        fh.write(text)
+    return path
+
+def test_site_rules():
+    desc = "Site rule files can translate additional directives and variables"
+    rules_file = write_rules("""
+[variables]
+PBS_O_WORKDIR = "SLURM_SUBMIT_DIR"
+PBS_NODEFILE  = "SLURM_JOB_NODELIST"
+
+[directives.q]
+template = "#SBATCH --partition={}"
+
+[directives.l]
+handler = "resource_list"
+
+[resources]
+walltime = "walltime"
+""")
+    input = """#! /bin/bash
+#PBS -q norm
+#PBS -N ignored
+#PBS -l walltime=1:00:00,nodes=2
+
+cd $PBS_O_WORKDIR
+cat $PBS_NODEFILE
+"""
+    expected = """#! /bin/bash
+#SBATCH --partition=norm
+#PBS -N ignored
+#SBATCH --time=1:00:00
+
+cd $SLURM_SUBMIT_DIR
+cat $SLURM_JOB_NODELIST
+"""
+    try:
+        rules = p2s.load_rules(rules_file)
+        check(input, expected, p2s.convert_batch_script(input, rules = rules), desc)
+    finally:
+        os.unlink(rules_file)
+
+def test_rules_cache():
+    desc = "Compiled rule tables are cached keyed by the hash of the rule file"
+    rules_file = write_rules("""
+[directives.N]
+template = '#SBATCH --job-name="{}"'
+""")
+    old_cache = os.environ.get("PBS2SLURM_CACHE")
+    try:
+        with tempfile.TemporaryDirectory() as cache:
+            os.environ["PBS2SLURM_CACHE"] = cache
+            rules = p2s.load_rules(rules_file)
+            cached = os.listdir(cache)
+            assert cached == [f"rules-{rules['digest']}.pickle"]
+            # a modified rule file gets its own table
+            with open(rules_file, "a") as fh:
+                fh.write("[directives.q]\ndrop = { info = 'dropped' }\n")
+            assert "q" in p2s.load_rules(rules_file)["directives"]
+            assert len(os.listdir(cache)) == 2
+    finally:
+        if old_cache is None:
+            del os.environ["PBS2SLURM_CACHE"]
+        else:
+            os.environ["PBS2SLURM_CACHE"] = old_cache
+        os.unlink(rules_file)
+
+def test_builtin_rules():
+    # the rules used when pbs2slurm.py is installed without its rule file
+    builtin = p2s.compile_rules(p2s.BUILTIN_RULES)
+    if p2s.tomllib is not None:
+        rules = dict(p2s._load_rules_file(p2s.DEFAULT_RULES), digest = "")
+        assert builtin == rules, "BUILTIN_RULES differ from pbs2slurm_rules.toml"
+    # the default table is only loaded once
+    assert p2s.load_rules() is p2s.load_rules()
+    # a missing rule file is an error, not a traceback
+    with p2s.collect_diagnostics() as diagnostics:
+        try:
+            p2s.load_rules(os.path.join(tempfile.gettempdir(), "missing-rules.toml"))
+        except SystemExit as e:
+            assert e.code == 1
+        else:
+            assert False, "missing rule file was loaded"
+    assert "could not read rule file" in diagnostics[0].message
+
+################################################################################
+# differential runner
+
+def divergent_engine(pbs):
+    """an engine that disagrees with pbs2slurm about PBS_O_WORKDIR"""
+    return p2s.convert_batch_script(pbs).replace("SLURM_SUBMIT_DIR", "PWD")
+
+def test_differential_runner():
+    scripts = {
+        "job1.sh": "#! /bin/bash\n#PBS -N one\ncd $PBS_O_WORKDIR\n",
+        "job2.sh": "#! /bin/bash\n#PBS -k oe\necho $PBS_JOBID\n",
+        "empty.sh": "#PBS -N nothing\n",
+    }
+    with tempfile.TemporaryDirectory() as corpus:
+        for fn, text in scripts.items():
+            with open(os.path.join(corpus, fn), "w") as fh:
+                fh.write(text)
+        out = io.StringIO()
+        same = pbs2slurm_diff.run(corpus, "pbs2slurm:convert_batch_script",
+                jobs = 2, max_slowdown = 1000, out = out)
+        assert same["ok"] and same["files"] == 3 and same["divergent"] == []
+        out = io.StringIO()
+        diff = pbs2slurm_diff.run(corpus, "pbs2slurm_tests:divergent_engine",
+                jobs = 2, max_slowdown = 1000, out = out)
+        assert not diff["ok"]
+        assert diff["divergent"] == [os.path.join(corpus, "job1.sh")]
+        assert "+cd $PWD" in out.getvalue()
+    # the engines don't share translated headers
+    pbs2slurm_diff.run_engine(p2s.convert_batch_script, scripts["job1.sh"])
+    pbs2slurm_diff.run_engine(divergent_engine, scripts["job1.sh"])
+    assert p2s.header_memo.hits == 0 and len(p2s.header_memo) == 1
+
+################################################################################
+# driver scripts
+
+def test_driver_loop_to_array():
+    desc = "Loops of qsub calls in driver scripts are collapsed into a single job array"
+    input = """#! /bin/bash
+for s in a b c; do
+    qsub -N align_$s -l walltime=1:00:00 -v SAMPLE=$s align.pbs
+done
+for i in $(seq 1 100); do qsub -F "$i" sim.pbs; done
+"""
+    expected = """#! /bin/bash
+# pbs2slurm: qsub loop over 's' collapsed into a single job array
+printf '%s\\n' a b c > pbs2slurm_array_1.tasks
+sbatch --array=1-$(wc -l < pbs2slurm_array_1.tasks) --job-name="align_" --time=1:00:00 <<PBS2SLURM_ARRAY
+#! /bin/bash
+s=\\$(sed -n "\\${SLURM_ARRAY_TASK_ID}p" pbs2slurm_array_1.tasks)
+export SAMPLE=\\$s
+exec /bin/bash align.pbs
+PBS2SLURM_ARRAY
+# pbs2slurm: qsub loop over 'i' collapsed into a single job array
+sbatch --array=1-100 <<PBS2SLURM_ARRAY
+#! /bin/bash
+i=\\$SLURM_ARRAY_TASK_ID
+exec /bin/bash sim.pbs "\\$i"
+PBS2SLURM_ARRAY
+"""
+    check(input, expected, pbs2slurm_driver.convert_driver_script(input), desc)
+
+    desc = "Job arrays are not submitted for loops without iterations"
+    input = """#! /bin/bash
+for f in data/*.fq; do qsub -F "$f x" map.pbs; done
+for i in $(seq 1 $N); do qsub sim.pbs; done
+for i in $(seq 5 1); do qsub sim.pbs; done
+"""
+    expected = """#! /bin/bash
+# pbs2slurm: qsub loop over 'f' collapsed into a single job array
+printf '%s\\n' data/*.fq | sed '/^$/d' > pbs2slurm_array_1.tasks
+if [ -s pbs2slurm_array_1.tasks ]; then
+    sbatch --array=1-$(wc -l < pbs2slurm_array_1.tasks) <<PBS2SLURM_ARRAY
+#! /bin/bash
+f=\\$(sed -n "\\${SLURM_ARRAY_TASK_ID}p" pbs2slurm_array_1.tasks)
+exec /bin/bash map.pbs "\\$f" "x"
+PBS2SLURM_ARRAY
+fi
+# pbs2slurm: qsub loop over 'i' collapsed into a single job array
+if [ $N -ge 1 ]; then
+    sbatch --array=1-$N <<PBS2SLURM_ARRAY
+#! /bin/bash
+i=\\$SLURM_ARRAY_TASK_ID
+exec /bin/bash sim.pbs
+PBS2SLURM_ARRAY
+fi
+# pbs2slurm: qsub loop over 'i' has no iterations
+"""
+    check(input, expected, pbs2slurm_driver.convert_driver_script(input), desc)
+
+    desc = "Array tasks run the job script with the interpreter of its #! line"
+    with tempfile.TemporaryDirectory() as d:
+        with open(os.path.join(d, "fit.pbs"), "w") as f:
+            f.write("#! /usr/bin/env python3\n#PBS -l walltime=2:00:00\nprint(1)\n")
+        input = "for i in {1..4}; do qsub fit.pbs; done\n"
+        expected = """# pbs2slurm: qsub loop over 'i' collapsed into a single job array
+sbatch --array=1-4 <<PBS2SLURM_ARRAY
+#! /usr/bin/env python3
+#SBATCH --time=2:00:00
+i=\\$SLURM_ARRAY_TASK_ID
+exec /usr/bin/env python3 fit.pbs
+PBS2SLURM_ARRAY
+"""
+        check(input, expected, pbs2slurm_driver.convert_driver_script(input,
+                script_dir = d), desc)
+
+def test_driver_dependencies():
+    desc = "qsub -W depend=... is translated to --dependency"
+    input = """#! /bin/bash
+A=$(qsub step1.pbs)
+B=$(qsub -W depend=afterok:$A step2.pbs)
+qsub -W depend=afterany:$A:$B,afternotok:1234.pbs-server final.pbs
+qsub -W group_list=lab -W depend=beforeok:$B other.pbs
+"""
+    expected = """#! /bin/bash
+A=$(sbatch --parsable step1.pbs)
+B=$(sbatch --parsable --dependency=afterok:$A step2.pbs)
+sbatch --dependency=afterany:$A:$B,afternotok:1234 final.pbs
+sbatch other.pbs
+"""
+    check(input, expected, pbs2slurm_driver.convert_driver_script(input), desc)
+
+def test_driver_fallback():
+    desc = "qsub calls that can't be collapsed are translated to sbatch calls"
+    input = """#! /bin/bash
+for f in data/*.fq; do
+    echo $f
+    qsub -v F=$f -q norm job.pbs
+done
+JOB=$(qsub -N final -m e final.pbs)
+"""
+    expected = """#! /bin/bash
+for f in data/*.fq; do
+    echo $f
+    sbatch --export=F=$f job.pbs
+done
+JOB=$(sbatch --parsable --job-name="final" --mail-type=END final.pbs)
+"""
+    check(input, expected, pbs2slurm_driver.convert_driver_script(input), desc)
+
+def test_job_control():
+    desc = """qstat polling loops wait with sbatch --wait; qsub, qstat and qdel calls
+    are translated. A loop that only waits while the job is running is left alone"""
+    input = """#! /bin/bash
+#PBS -N poll
+OTHER=$(qsub step2.pbs)
+while qstat "$OTHER" | grep -q R
+do
+    sleep 5
+done
+until qstat $OTHER | grep -q " R "; do sleep 10; done
+state=$(qstat -f $OTHER | grep job_state)
+qdel -W force $OTHER  # qstat
+qstat -x $OTHER
+while qstat $OTHER; do echo waiting; sleep 5; done
+LAST=$(qsub -N last step3.pbs)
+while qstat $LAST >/dev/null 2>&1; do sleep 60; done
+"""
+    expected = """#! /bin/bash
+#SBATCH --job-name="poll"
+OTHER=$(sbatch --parsable step2.pbs)
+while qstat "$OTHER" | grep -q R
+do
+    sleep 5
+done
+sbatch --wait --quiet --dependency=after:$OTHER --time=1 --output=/dev/null --wrap=true 2>/dev/null || true
+state=$(scontrol show job $OTHER | grep job_state)
+scancel $OTHER  # qstat
+qstat -x $OTHER
+while squeue -j $OTHER; do echo waiting; sleep 5; done
+LAST=$(sbatch --wait --parsable --job-name="last" step3.pbs)
+"""
+    rules = p2s.with_policy(p2s.load_rules(), ["job_control=true"])
+    with p2s.collect_diagnostics() as diags:
+        conv = p2s.convert(input, rules = rules)
+    check(input, expected, conv.output, desc)
+    assert sorted((d.line, d.level, d.rule) for d in diags) == [(3, "INFO", "qsub"),
+            (4, "WARNING", "qstat"), (8, "INFO", "qstat"), (9, "WARNING", "qstat"),
+            (10, "INFO", "qdel"), (11, "WARNING", "qstat"), (12, "INFO", "qstat"),
+            (13, "INFO", "qsub"), (14, "INFO", "qstat")]
+    # sbatch can't wait for a job submitted with qsub
+    input = "J=$(qsub a.pbs)\nwhile qstat $J; do sleep 1; done\n"
+    with p2s.collect_diagnostics() as diags:
+        assert p2s.fix_job_control(input) == input
+    assert diags[0].message.endswith("not translated -> left unchanged")
+    # off by default
+    with p2s.collect_diagnostics() as diags:
+        assert p2s.convert(input).output.endswith(input.split("\n", 2)[2])
+    assert diags == []
+    # in a driver script the submission itself waits
+    input = """JOB=$(qsub -N a step1.pbs)
+while qstat $JOB >/dev/null 2>&1; do
+  sleep 60
+done
+qsub step2.pbs
+"""
+    expected = """JOB=$(sbatch --wait --parsable --job-name="a" step1.pbs)
+sbatch step2.pbs
+"""
+    with p2s.collect_diagnostics():
+        check(input, expected, pbs2slurm_driver.convert_driver_script(input, rules),
+                "a qstat polling loop after a submission becomes sbatch --wait")
+
+################################################################################
+# pre-submission check
+
+def test_check_header():
+    input = """#! /bin/bash
+#PBS -N job
+#PBS -k oe
+#PBS -l walltime=1:00:00,nodes=2:ppn=4
+#PBS -W depend=afterok:1
+#PBS -q batch
+cd $PBS_O_WORKDIR
+#PBS -W not-in-header
+"""
+    rules = p2s.load_rules()
+    findings = [(lineno, status) for lineno, line, status, reason
+            in p2s.check_header(io.StringIO(input), rules)]
+    assert findings == [(2, "translated"), (3, "translated"), (4, "dropped"),
+            (5, "unknown"), (6, "dropped")]
+    # fail fast stops at the first directive that is not translated
+    findings = list(p2s.check_header(io.StringIO(input), rules, fail_fast = True))
+    assert [f[0] for f in findings] == [2, 3, 4]
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, "w") as fh:
+        fh.write(input)
+    try:
+        out = io.StringIO()
+        assert p2s.check_paths([path], rules, out = out) == p2s.CHECK_UNKNOWN
+        assert out.getvalue().count("\n") == 3
+        out = io.StringIO()
+        assert p2s.check_paths([path], rules, True, out) == p2s.CHECK_DROPPED
+        # a header line longer than check_file reads doesn't end the header
+        with open(path, "w") as fh:
+            fh.write("#! /bin/bash\n#PBS -N " + "x" * p2s.CHECK_MAX_LINE
+                    + "\n# " + "y" * p2s.CHECK_MAX_LINE + "\n#PBS -W x=y\nhostname\n")
+        findings = [(lineno, status) for lineno, line, status, reason
+                in p2s.check_file(path, rules)]
+        assert findings == [(2, "dropped"), (4, "unknown")]
+    finally:
+        os.unlink(path)
+
+def test_incremental_conversion():
+    input = """#! /bin/bash
+#PBS -N job
+#PBS -q batch
+#PBS -q long
+#PBS -l walltime=1:00:00,nodes=2:ppn=4
+cd $PBS_O_WORKDIR
+
+for i in 1 2; do
+
+    echo $PBS_JOBID $i
+done
+
+cat <<EOF
+$PBS_ARRAY_INDEX
+EOF
+"""
+    rules = p2s.load_rules()
+    with p2s.collect_diagnostics():
+        full = p2s.convert(input, rules = rules)
+        first = p2s.convert(input, rules = rules, incremental = True)
+    assert first.output == full.output
+    # -q is a 'once' rule: one message, pointing at the first -q line
+    assert [(d.line, d.rule) for d in first.diagnostics] == [(3, "-q")]
+    assert first.output_line(5) == 5 and first.input_line(6) == 6
+    assert first.output.splitlines()[first.output_line(14) - 1] == "$SLURM_ARRAY_TASK_ID"
+    assert first.source_map[0] == (1, 1, 1, 1)
+    # the blank line inside the loop does not split the loop into regions
+    assert [u.source.split("\n")[1] for u in first.units if u.kind == "body"] == \
+            ["", "for i in 1 2; do", "cat <<EOF"]
+    edited = input.replace("#PBS -N job", "#PBS -N other").replace("echo $PBS_JOBID", "date")
+    with p2s.collect_diagnostics() as diags:
+        second = p2s.convert(edited, rules = rules, previous = first)
+    with p2s.collect_diagnostics():
+        expected = p2s.convert(edited, rules = rules)
+    assert second.output == expected.output
+    assert second.diagnostics == expected.diagnostics == diags
+    # shebang, both -q lines, -l, the first and last body regions
+    assert second.reused == 6
+    # a different shell invalidates the previous result
+    with p2s.collect_diagnostics():
+        third = p2s.convert(edited, "/bin/zsh", rules, previous = second)
+    assert third.reused == 0
+
+def test_job_description():
+    input = """#! /bin/bash
+#PBS -N hybrid
+#PBS -l select=2:ncpus=8:mem=4gb+1:ncpus=1,walltime=1:00:01
+#PBS -m abe
+#PBS -v FOO,BAR=2
+cd $PBS_O_WORKDIR
+"""
+    with p2s.collect_diagnostics():
+        script, desc = p2s.convert_batch_script(input, describe = True,
+                rules = p2s.load_rules())
+    assert script == desc["script"] == p2s.convert_batch_script(input)
+    first, second = desc["jobs"]
+    assert first["name"] == "hybrid"
+    assert (first["nodes"], first["tasks_per_node"], first["cpus_per_task"],
+            first["memory_per_node"]) == ("2", 1, 8, 4096)
+    # the job-wide options of later header lines belong to the first
+    # component; the second one only has its own resources
+    assert (first["time_limit"], first["mail_type"]) == (61, ["BEGIN", "END", "FAIL"])
+    assert second == {"nodes": "1", "tasks_per_node": 1, "cpus_per_task": 1,
+            "environment": second["environment"],
+            "current_working_directory": second["current_working_directory"]}
+    assert script.index("--mail-type") < script.index("#SBATCH hetjob")
+    with p2s.collect_diagnostics():
+        conv = p2s.convert(input)
+    desc = p2s.job_description(conv, {"FOO": "1", "HOME": "/home/x"}, "/data")
+    assert desc["jobs"][0]["environment"] == ["FOO=1", "BAR=2"]
+    assert desc["jobs"][1]["current_working_directory"] == "/data"
+
+    # options without their own field: the checkpoint signal, requeueing and
+    # exports of no variables
+    input = """#! /bin/bash
+#PBS -c c=10
+#PBS -r y
+#PBS -V
+#PBS -l place=excl
+sleep 100
+"""
+    rules = p2s.with_policy(p2s.load_rules(), ["minimal_export=true", "export_always="])
+    with p2s.collect_diagnostics() as diags:
+        job = p2s.job_description(p2s.convert(input, rules = rules),
+                {"HOME": "/home/x", "SLURM_CONF": "/etc/slurm.conf"}, "/data")["job"]
+    assert (job["kill_warning_signal"], job["kill_warning_delay"],
+            job["kill_warning_flags"], job["requeue"]) == ("USR1", 300, ["BATCH_JOB"], True)
+    assert job["environment"] == ["SLURM_CONF=/etc/slurm.conf", "SLURM_EXPORT_ENV=NIL"]
+    assert not [d for d in diags if "slurmrestd" in d.message]
+
+    # submission to a stub slurmrestd
+    received = []
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            received.append((self.path, self.headers["X-SLURM-USER-TOKEN"],
+                    json.loads(body)))
+            reply = json.dumps({"job_id": 42, "errors": [], "warnings": []})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(reply.encode())
+        def log_message(self, *args):
+            pass
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        status, response = pbs2slurm_rest.submit(desc, url, "x", "secret")
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert (status, response["job_id"]) == (200, 42)
+    assert received == [("/slurm/v0.0.40/job/submit", "secret", desc)]
+
+def test_follow_includes():
+    with tempfile.TemporaryDirectory() as lab:
+        os.makedirs(os.path.join(lab, "lib"))
+        files = {"common.sh": "cd $PBS_O_WORKDIR\n. lib/env.sh\n",
+                "lib/env.sh": 'echo $PBS_JOBID\nsource "$PBS_O_WORKDIR/common.sh"\n'}
+        for name, text in files.items():
+            with open(os.path.join(lab, name), "w") as fh:
+                fh.write(text)
+        script = """#PBS -N job
+source common.sh
+. $(dirname $0)/lib/env.sh
+source $HOME/private.sh
+# source common.sh
+cat <<EOF
+source common.sh
+EOF
+"""
+        rules = p2s.load_rules()
+        written = {}
+        graph = pbs2slurm_includes.IncludeGraph(rules,
+                write = lambda path, text, mode: written.setdefault(path, []).append(text))
+        for job in ("a.pbs", "b.pbs"):
+            path = os.path.join(lab, job)
+            output, includes = pbs2slurm_includes.rewrite_includes(
+                    p2s.convert_batch_script(script, rules = rules), lab)
+            assert includes == [os.path.join(lab, "common.sh"),
+                    os.path.join(lab, "lib", "env.sh")]
+            graph.add(path, includes)
+        assert output.split("\n")[2:7] == ["source common.sh.slurm",
+                ". $(dirname $0)/lib/env.sh.slurm", "source $HOME/private.sh",
+                "# source common.sh", "cat <<EOF"]
+        # every include is converted once, even though they source each other
+        assert graph.conversions == 2
+        assert sorted(len(texts) for texts in written.values()) == [1, 1]
+        assert written[os.path.join(lab, "lib", "env.sh.slurm")][0] == \
+                'echo $SLURM_JOB_ID\nsource "$SLURM_SUBMIT_DIR/common.sh.slurm"\n'
+        assert graph.included_by[os.path.join(lab, "common.sh")] == {
+                os.path.join(lab, "a.pbs"), os.path.join(lab, "b.pbs"),
+                os.path.join(lab, "lib", "env.sh")}
+        out = io.StringIO()
+        graph.report(out)
+        assert out.getvalue().startswith("includes: 2 converted, 4 reused\n")
+        # $PBS_O_WORKDIR in an include is the directory of the script
+        # sourcing it
+        with open(os.path.join(lab, "setup.sh"), "w") as fh:
+            fh.write("source $PBS_O_WORKDIR/local.sh\n")
+        for sub in ("x", "y"):
+            os.makedirs(os.path.join(lab, sub))
+            with open(os.path.join(lab, sub, "local.sh"), "w") as fh:
+                fh.write(f"echo {sub}\n")
+            graph.add(os.path.join(lab, sub, "job.pbs"), [os.path.join(lab, "setup.sh")])
+        assert [p for p in written if p.endswith("local.sh.slurm")] == [
+                os.path.join(lab, "x", "local.sh.slurm"),
+                os.path.join(lab, "y", "local.sh.slurm")]
+        assert len(written[os.path.join(lab, "setup.sh.slurm")]) == 1
+
+    # bulk runs write converted includes like the scripts, and includes that
+    # are scripts of the run are converted once
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "in")
+        os.makedirs(os.path.join(src, "lib"))
+        shared = os.path.join(tmp, "shared.sh")
+        files = {"job.pbs": "#PBS -N job\nsource lib/env.sh\nsource %s\n" % shared,
+                "lib/env.sh": "echo $PBS_JOBID\n"}
+        for name, text in files.items():
+            with open(os.path.join(src, name), "w") as fh:
+                fh.write(text)
+        with open(shared, "w") as fh:
+            fh.write("echo $PBS_ARRAY_INDEX\n")
+        dest = os.path.join(tmp, "out")
+        with p2s.collect_diagnostics():
+            summary = pbs2slurm_bulk.run([src], dest, jobs = 1,
+                    follow_includes = True, out = io.StringIO())
+        assert summary["includes"].conversions == 1
+        assert sorted(os.listdir(dest)) == ["job.pbs", "lib"]
+        assert os.listdir(os.path.join(dest, "lib")) == ["env.sh"]
+        with open(os.path.join(dest, "job.pbs")) as fh:
+            assert fh.read().split("\n")[2:4] == ["source lib/env.sh",
+                    f"source {shared}.slurm"]
+        with open(shared + ".slurm") as fh:
+            assert fh.read() == "echo $SLURM_ARRAY_TASK_ID\n"
+
+def test_bulk_pipeline():
+    script = "#! /bin/bash\n#PBS -N job{}\ncd $PBS_O_WORKDIR\n"
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "in")
+        os.makedirs(os.path.join(src, "lab"))
+        for i in range(40):
+            with open(os.path.join(src, "lab", f"job{i}.pbs"), "w") as fh:
+                fh.write(script.format(i))
+        with open(os.path.join(src, "empty.pbs"), "w") as fh:
+            fh.write("#PBS -N nothing\n")
+        dest = os.path.join(tmp, "out")
+        out = io.StringIO()
+        with p2s.collect_diagnostics() as diags:
+            summary = pbs2slurm_bulk.run([src], dest, jobs = 2, readers = 3,
+                    queue_size = 4, batch_size = 3, out = out)
+        assert summary["files"] == 41
+        assert summary["failed"] == [os.path.join(src, "empty.pbs")]
+        assert [d.level for d in diags] == ["ERROR"]
+        assert diags[0].message.startswith(os.path.join(src, "empty.pbs") + ": ")
+        with open(os.path.join(dest, "lab", "job7.pbs")) as fh:
+            assert fh.read() == p2s.convert_batch_script(script.format(7)) + "\n"
+        assert sorted(os.listdir(os.path.join(dest, "lab"))) == \
+                sorted(f"job{i}.pbs" for i in range(40))
+        stages = [line.split()[0] for line in out.getvalue().splitlines()]
+        assert stages[1:4] == ["read", "convert", "write"]
+        assert summary["memo"] == (0, 40)
+    # a second in-place run doesn't convert the output of the first one or
+    # temporary files left by an interrupted write
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "job.sh"), "w") as fh:
+            fh.write(script.format(1))
+        with open(os.path.join(tmp, ".pbs2slurm-x1y2"), "w") as fh:
+            fh.write(script.format(2))
+        for _ in range(2):
+            with p2s.collect_diagnostics():
+                summary = pbs2slurm_bulk.run([tmp], jobs = 1, out = io.StringIO())
+            assert summary["files"] == 1
+        assert sorted(os.listdir(tmp)) == [".pbs2slurm-x1y2", "job.sh", "job.sh.slurm"]
+
+def _die_in_worker(*args):
+    os._exit(1)
+
+def test_bulk_worker_death():
+    # a worker process that dies ends the run with an error instead of
+    # leaving the readers blocked on full queues
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(50):
+            with open(os.path.join(tmp, f"job{i}.pbs"), "w") as fh:
+                fh.write(f"#PBS -N job{i}\necho\n")
+        convert_batch = pbs2slurm_bulk._convert_batch
+        pbs2slurm_bulk._convert_batch = _die_in_worker
+        try:
+            with p2s.collect_diagnostics():
+                pbs2slurm_bulk.run([tmp], os.path.join(tmp, "out"), jobs = 1,
+                        readers = 2, queue_size = 2, batch_size = 1, out = io.StringIO())
+        except concurrent.futures.process.BrokenProcessPool:
+            pass
+        else:
+            assert False, "expected BrokenProcessPool"
+        finally:
+            pbs2slurm_bulk._convert_batch = convert_batch
+
+def test_bulk_journal():
+    script = "#! /bin/bash\n#PBS -N job{}\necho\n"
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "in")
+        os.makedirs(src)
+        for i in range(10):
+            with open(os.path.join(src, f"job{i}.pbs"), "w") as fh:
+                fh.write(script.format(i))
+        with open(os.path.join(src, "bad.pbs"), "w") as fh:
+            fh.write("#PBS -N nothing\n")
+        dest = os.path.join(tmp, "out")
+        journal = os.path.join(tmp, "journal")
+        def bulk(resume):
+            with p2s.collect_diagnostics():
+                return pbs2slurm_bulk.run([src], dest, jobs = 2, readers = 2,
+                        batch_size = 3, journal = journal, resume = resume,
+                        out = io.StringIO())
+        assert bulk(False)["skipped"] == 0
+        with open(journal) as fh:
+            entries = sorted(line.split()[0] for line in fh)
+        assert entries == ["c"] * 10 + ["f"]
+        # an interrupted write leaves a partial line behind
+        with open(journal, "a") as fh:
+            fh.write("c 0123")
+        with open(os.path.join(src, "job3.pbs"), "a") as fh:
+            fh.write("echo again\n")
+        os.unlink(os.path.join(dest, "job5.pbs"))
+        summary = bulk(True)
+        assert summary["skipped"] == 8 and summary["failed"] == [os.path.join(src, "bad.pbs")]
+        with open(os.path.join(dest, "job3.pbs")) as fh:
+            assert fh.read().endswith("echo again\n\n")
+        assert os.path.exists(os.path.join(dest, "job5.pbs"))
+        assert bulk(True)["skipped"] == 10
+    # long journals are sorted in runs that are merged
+    keys = [(i * 0x9E3779B97F4A7C15) % 2 ** 64 for i in range(1000)]
+    for n in (0, 64, 1000):
+        assert pbs2slurm_bulk.sort_keys(array.array("Q", keys[:n]), 64).tolist() == \
+                sorted(keys[:n])
+    # transient errors are retried, others are not
+    calls = []
+    def flaky(code, fail):
+        calls.append(code)
+        if len(calls) <= fail:
+            raise OSError(code, os.strerror(code))
+        return "ok"
+    assert pbs2slurm_bulk.with_retries(lambda: flaky(errno.ESTALE, 2), 3, 0) == "ok"
+    assert len(calls) == 3
+    try:
+        pbs2slurm_bulk.with_retries(lambda: flaky(errno.ENOENT, 9), 3, 0)
+        assert False
+    except FileNotFoundError:
+        assert len(calls) == 4
+
+def test_bulk_shards():
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "in")
+        for lab in ("a", "b"):
+            os.makedirs(os.path.join(src, lab))
+            for i in range(15):
+                with open(os.path.join(src, lab, f"job{i}.pbs"), "w") as fh:
+                    fh.write(f"#! /bin/bash\n#PBS -N {lab}{i}\necho\n")
+        with open(os.path.join(src, "a", "bad.pbs"), "w") as fh:
+            fh.write("#PBS -N nothing\n")
+        def tree(top):
+            found = {}
+            for dirpath, _, filenames in os.walk(top):
+                for fn in filenames:
+                    with open(os.path.join(dirpath, fn)) as fh:
+                        found[os.path.relpath(os.path.join(dirpath, fn), top)] = fh.read()
+            return found
+        with p2s.collect_diagnostics():
+            whole = pbs2slurm_bulk.run([src], os.path.join(tmp, "whole"), jobs = 1,
+                    out = io.StringIO())
+            summaries = []
+            for k in range(3):
+                summary = pbs2slurm_bulk.run([src], os.path.join(tmp, "sharded"),
+                        jobs = 1, shard = pbs2slurm_bulk.parse_shard(f"{k}/3"),
+                        out = io.StringIO())
+                assert 0 < summary["files"] < 31
+                summaries.append(os.path.join(tmp, f"shard-{k}.json"))
+                pbs2slurm_bulk.write_summary(summary, summaries[-1])
+        assert tree(os.path.join(tmp, "whole")) == tree(os.path.join(tmp, "sharded"))
+        out = io.StringIO()
+        merged = pbs2slurm_bulk.merge_summaries(summaries, out)
+        assert merged["files"] == whole["files"] == 31
+        assert merged["failed"] == whole["failed"] and merged["missing"] == []
+        assert "shards: 3, files: 31, failed: 1" in out.getvalue()
+        assert pbs2slurm_bulk.merge_summaries(summaries[1:], io.StringIO())["missing"] == [0]
+    script = pbs2slurm_bulk.shard_script(8, ["-o", "/data/slurm", "/data/pbs"])
+    assert "#SBATCH --array=0-7" in script
+    assert '-o /data/slurm /data/pbs --shard "$SLURM_ARRAY_TASK_ID/8"' in script
+    script = pbs2slurm_bulk.shard_script(2, ["/data/pbs"], "/data/my shards")
+    assert script.endswith(""" --summary '/data/my shards'/"shard-$SLURM_ARRAY_TASK_ID.json"\n""")
+
+    # the includes of a sharded run are converted once, by the merge
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "in")
+        os.makedirs(src)
+        shared = os.path.join(tmp, "shared.sh")
+        with open(shared, "w") as fh:
+            fh.write("echo $PBS_JOBID\n")
+        for i in range(12):
+            with open(os.path.join(src, f"job{i}.pbs"), "w") as fh:
+                fh.write(f"#! /bin/bash\n#PBS -N job{i}\nsource {shared}\n")
+        written = []
+        write_atomic = p2s.write_atomic
+        p2s.write_atomic = lambda path, *args: (written.append(path),
+                write_atomic(path, *args))
+        try:
+            summaries = []
+            with p2s.collect_diagnostics():
+                for k in range(3):
+                    summary = pbs2slurm_bulk.run([src], os.path.join(tmp, "out"),
+                            jobs = 1, follow_includes = True, out = io.StringIO(),
+                            shard = pbs2slurm_bulk.parse_shard(f"{k}/3"))
+                    assert summary["includes"] is None
+                    summaries.append(os.path.join(tmp, f"shard-{k}.json"))
+                    pbs2slurm_bulk.write_summary(summary, summaries[-1])
+            assert shared + ".slurm" not in written
+            merged = pbs2slurm_bulk.merge_summaries(summaries, io.StringIO())
+        finally:
+            p2s.write_atomic = write_atomic
+        assert written.count(shared + ".slurm") == 1
+        assert merged["includes"].conversions == 1
+        with open(shared + ".slurm") as fh:
+            assert fh.read() == "echo $SLURM_JOB_ID\n"
+
+def adversarial_header(n):
+    """a header of long and malformed directive lines of about n
+    characters each, in the shapes that make backtracking regular
+    expressions slow"""
+    lines = ["#PBS -l " + " ," * (n // 2),
+            "#PBS -l walltime=1:00:00" + " " * n + "#",
+            "#PBS -l " + ",".join(f"k{i}=v" for i in range(n // 5)),
+            "#PBS -v " + ",".join(f"V{i}=x" for i in range(n // 5)),
+            "#PBS -v " + "= " * (n // 2) + "#",
+            "#PBS -M " + "a." * (n // 2) + "#",
+            "#PBS -M " + "a@" + "b." * (n // 2) + "1",
+            "#PBS -m " + "ab" * (n // 2),
+            "#PBS" + " \t" * (n // 2),
+            "#PBS -J " + "1-" * (n // 2),
+            "#PBS -N " + "x" * n]
+    return "#! /bin/bash\n" + "\n".join(lines) + "\necho\n"
+
+def test_adversarial_directives():
+    rules = p2s.load_rules()
+    def runtime(n, repeat = 7):
+        # the best of several timings of a conversion, which is the least
+        # affected by the load of the machine. Time spent in the re engine
+        # is included, which a count of python steps would not see
+        script = adversarial_header(n)
+        best = None
+        for _ in range(repeat):
+            with p2s.collect_diagnostics():
+                start = time.perf_counter()
+                p2s.convert(script, rules = rules, memo = None)
+                elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+    # at the line length limit every line is translated, and the work grows
+    # about linearly with the line length (4 times the length, about 4 times
+    # the time; quadratic work would be 16 times, backtracking far more).
+    # Beyond the limit lines are not translated at all
+    n = p2s.DIRECTIVE_MAX_LINE // 4
+    limit = runtime(4 * n - 100)
+    ratio = limit / runtime(n)
+    assert ratio < 10, f"conversion time grows {ratio:.1f} times for 4 times longer lines"
+    ratio = runtime(8 * p2s.DIRECTIVE_MAX_LINE) / limit
+    assert ratio < 4, f"overlong lines take {ratio:.1f} times as long as translated lines"
+    with p2s.collect_diagnostics() as diags:
+        line = "#PBS -N " + "x" * p2s.DIRECTIVE_MAX_LINE
+        assert p2s.translate_directive(line, rules, set()) == line
+    assert diags[0].level == "WARNING"
+    assert p2s.tokenize_directive("#PBS \t-l  walltime=1:00:00 ") == ("l", "walltime=1:00:00")
+    assert p2s.tokenize_directive("#PBS") is None
+
+def test_bulk_report():
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "in")
+        os.makedirs(src)
+        for i in range(25):
+            with open(os.path.join(src, f"job{i:02d}.pbs"), "w") as fh:
+                fh.write(f"#! /bin/bash\n#PBS -N <job{i}>\n#PBS -q batch\n"
+                        "#PBS -l nodes=1:ppn=4,walltime=1:00:00\n#PBS -W x=y\necho\n")
+        with open(os.path.join(src, "bad.pbs"), "w") as fh:
+            fh.write("#PBS -N nothing\n")
+        report = os.path.join(tmp, "report")
+        with p2s.collect_diagnostics():
+            pbs2slurm_bulk.run([src], os.path.join(tmp, "out"), jobs = 1,
+                    report = report, out = io.StringIO())
+        pages = sorted(fn for fn in os.listdir(report) if fn.startswith("page-"))
+        assert len(pages) == 2 * 1 and sorted(os.listdir(report)) == sorted(
+                pages + ["index.html", "summary.html", "summary.json"])
+        with open(os.path.join(report, "page-00001.json")) as fh:
+            page = json.load(fh)
+        assert len(page["scripts"]) == 26
+        assert page["scripts"][0]["status"] == "failed"
+        assert page["scripts"][1]["slurm"].startswith("#! /bin/bash\n#SBATCH --job-name=")
+        with open(os.path.join(report, "summary.json")) as fh:
+            summary = json.load(fh)
+        assert summary["status"] == {"converted": 25, "failed": 1}
+        dropped = {(d["status"], d["directive"]): d["count"] for d in summary["dropped"]}
+        assert dropped == {("dropped", "-q"): 25, ("dropped", "-l nodes"): 25,
+                ("unknown", "-W"): 25}
+        assert {"level": "INFO", "rule": "-q", "count": 25} in summary["by_rule"]
+        with open(os.path.join(report, "page-00001.html")) as fh:
+            assert "&lt;job3&gt;" in fh.read()
+    # pages are written as they fill up
+    with tempfile.TemporaryDirectory() as tmp:
+        report = pbs2slurm_report.Report(tmp, page_size = 10)
+        for i in range(35):
+            report.add(f"job{i}", "skipped")
+        assert len(report._page) == 5 and len(report._full) == 10
+        assert report.close()["pages"] == 4
+        with open(os.path.join(tmp, "page-00004.html")) as fh:
+            assert ">next<" not in fh.read()
+        with open(os.path.join(tmp, "page-00003.html")) as fh:
+            assert ">next<" in fh.read()
+
+def test_header_memo():
+    memo = p2s.LRUMemo(2)
+    rules = p2s.load_rules()
+    template = "#PBS -N {}\n#PBS -q batch\n#PBS -j oe\necho {}\n"
+    outputs = []
+    with p2s.collect_diagnostics() as diags:
+        for name in ("a", "b", "a", "a", "c", "b"):
+            outputs.append(p2s.convert(template.format(name, name), rules = rules,
+                    memo = memo).output)
+    assert (memo.hits, memo.misses, len(memo)) == (2, 4, 2)
+    assert memo.hit_rate == 2 / 6
+    # memoized headers give the same output and diagnostics
+    with p2s.collect_diagnostics() as plain:
+        for name in ("a", "b", "a", "a", "c", "b"):
+            assert outputs.pop(0) == p2s.convert(template.format(name, name),
+                    rules = rules, memo = None).output
+    assert diags == plain
+
+def test_array_mail_policy():
+    script = "#! /bin/bash\n#PBS -t 1-500%10\n#PBS -m abe\necho\n"
+    rules = p2s.load_rules()
+    def mail(rules, text = script):
+        with p2s.collect_diagnostics() as diags:
+            conv = p2s.convert(text, rules = rules, memo = None)
+        return conv.output.split("\n")[2], [d.level for d in diags]
+    assert p2s.array_size("1-99:2,200%5") == 51
+    assert p2s.array_size("1-x") is None
+    assert mail(rules) == ("#SBATCH --mail-type=BEGIN,END,FAIL", ["INFO"])
+    opt_in = p2s.with_policy(rules, ["array_task_mail=true"])
+    assert opt_in["digest"] != rules["digest"]
+    assert mail(opt_in) == ("#SBATCH --mail-type=BEGIN,END,FAIL", ["WARNING"])
+    assert mail(p2s.with_policy(opt_in, ["array_task_mail_limit=500"])) == \
+            ("#SBATCH --mail-type=BEGIN,END,FAIL,ARRAY_TASKS", ["INFO"])
+    # other jobs are not affected
+    assert mail(opt_in, script.replace("-t 1-500%10", "-N job")) == \
+            ("#SBATCH --mail-type=BEGIN,END,FAIL", [])
+    # an edit of the array spec translates -m again
+    with p2s.collect_diagnostics():
+        first = p2s.convert(script, rules = opt_in, incremental = True)
+        second = p2s.convert(script.replace("1-500", "1-50"), rules = opt_in,
+                previous = first)
+    assert "ARRAY_TASKS" in second.output and second.reused == 2
+
+def test_array_packing():
+    script = """#! /bin/bash
+#PBS -J 1-1000%50
+#PBS -l walltime=00:00:20
+./task $PBS_ARRAY_INDEX
+"""
+    rules = p2s.with_policy(p2s.load_rules(), ["array_packing=true"])
+    with p2s.collect_diagnostics() as diags:
+        conv = p2s.convert(script, rules = rules)
+        plain = p2s.convert(script).output
+    assert "#SBATCH --array=1-1000\n" in plain
+    out = conv.output.split("\n")
+    assert out[1:3] == ["#SBATCH --array=0-11%50", "#SBATCH --time=0:30:00"]
+    assert diags[0].message.endswith("packed 90 tasks per array task -> 12 tasks of 0:30:00")
+    assert out[conv.output_line(4) - 1] == "./task $SLURM_ARRAY_TASK_ID"
+    assert "for SLURM_ARRAY_TASK_ID in $(seq $pbs2slurm_first 1 $pbs2slurm_last); do" in out
+    assert out[-2:] == ["exit $pbs2slurm_status", ""]
+    # incremental conversions and memoized headers give the same script
+    with p2s.collect_diagnostics():
+        assert p2s.convert(script, rules = rules, incremental = True).output == conv.output
+        assert p2s.convert(script, rules = rules).output == conv.output
+        # tasks that are long enough or scripts in other shells aren't packed
+        assert p2s.convert(script.replace("00:00:20", "00:20:00"), rules = rules).output == \
+                plain.replace("00:00:20", "00:20:00")
+        assert p2s.convert(script.replace("bash", "tcsh"), rules = rules).output == \
+                plain.replace("bash", "tcsh")
+
+def test_minimal_export():
+    script = """#! /bin/bash
+#PBS -V
+source $HOME/.labrc
+for f in $INPUT_DIR/*.fq; do
+    out=${f%.fq}.bam
+    aligner --ref ${GENOME:-hg38} $f > $out
+done
+cd $PBS_O_WORKDIR
+"""
+    rules = p2s.with_policy(p2s.load_rules(), ["minimal_export=true",
+            "export_always=PATH"])
+    assert p2s.body_variables(script, rules["variables"]) == \
+            (("GENOME", "HOME", "INPUT_DIR"), ("$HOME/.labrc",), False)
+    with p2s.collect_diagnostics() as diags:
+        conv = p2s.convert(script, rules = rules, incremental = True)
+    assert conv.output.split("\n")[1] == "#SBATCH --export=GENOME,HOME,INPUT_DIR,PATH"
+    assert [d.level for d in diags] == ["WARNING", "INFO"]
+    # the export follows edits of the body
+    with p2s.collect_diagnostics():
+        edited = p2s.convert(script.replace("GENOME", "REF"), rules = rules,
+                previous = conv)
+        assert edited.output.split("\n")[1] == "#SBATCH --export=HOME,INPUT_DIR,PATH,REF"
+        assert p2s.convert(script).output.split("\n")[1] == "#SBATCH --export=ALL"
+    # scripts that load modules need the module environment
+    rules = p2s.with_policy(rules, ["export_modules=MODULEPATH,BASH_FUNC_module%%"])
+    with p2s.collect_diagnostics():
+        loaded = p2s.convert(script.replace("source $HOME/.labrc", "module load bwa"),
+                rules = rules)
+    assert loaded.output.split("\n")[1] == \
+            "#SBATCH --export=BASH_FUNC_module%%,GENOME,INPUT_DIR,MODULEPATH,PATH"
+
+def test_checkpoint():
+    desc = "#PBS -c becomes a warning signal and --requeue, with a trap that checkpoints"
+    input = """#! /bin/bash
+#PBS -c periodic,interval=60
+#PBS -l walltime=4:00:00
+solver --resume state.chk
+"""
+    expected = """#! /bin/bash
+#SBATCH --signal=B:USR1@600
+#SBATCH --requeue
+#SBATCH --time=4:00:00
+# the USR1 trap runs when the current command ends: start long running programs with 'app & wait'
+trap 'solver --checkpoint state.chk; scontrol requeue $SLURM_JOB_ID' USR1
+solver --resume state.chk
+"""
+    rules = p2s.with_policy(p2s.load_rules(), ["checkpoint_lead=600",
+            "checkpoint_command=solver --checkpoint state.chk"])
+    with p2s.collect_diagnostics() as diags:
+        check(input, expected, p2s.convert_batch_script(input, rules = rules), desc)
+    assert [(d.level, d.rule) for d in diags] == [("INFO", "-c"), ("INFO", "-c")]
+    # without a command the script is only signaled; the lead time has to
+    # fit into the walltime and -r n keeps the job from being requeued
+    with p2s.collect_diagnostics() as diags:
+        out = p2s.convert_batch_script("#PBS -c c=10\n#PBS -r n\n"
+                "#PBS -l walltime=0:05:00\nrun\n").split("\n")
+    assert out[1:4] == ["#SBATCH --signal=B:USR1@150", "#SBATCH --no-requeue",
+            "#SBATCH --time=0:05:00"]
+    assert [d.level for d in diags] == ["INFO", "INFO", "WARNING", "WARNING"]
+    with p2s.collect_diagnostics():
+        assert p2s.convert_batch_script("#PBS -c n\nrun\n") == "#! /bin/bash\n\nrun\n"
+    # the shell is part of the memoized header: a csh script gets no trap,
+    # a bash script with the same header does
+    memo = p2s.LRUMemo(4)
+    header = "#PBS -c enabled\n#PBS -l walltime=10:00:00\nrun\n"
+    with p2s.collect_diagnostics():
+        csh = p2s.convert("#! /bin/csh\n" + header, rules = rules, memo = memo).output
+        bash = p2s.convert("#! /bin/bash\n" + header, rules = rules, memo = memo).output
+    assert "trap" not in csh and "trap 'solver" in bash
+
+def test_thread_counts():
+    desc = "thread counts in the body that don't match the cpus per task are rewritten"
+    input = """#! /bin/bash
+#PBS -l select=1:ncpus=8:mem=32gb
+export OMP_NUM_THREADS=24
+bwa mem -t 16 ref.fa r1.fq | samtools sort -@8 -o out.bam -
+STAR --genomeDir idx \\
+     --runThreadN 32   # STAR --runThreadN 4
+echo "bwa -t 3"
+"""
+    expected = """#! /bin/bash
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task=8
+#SBATCH --mem=32G
+export OMP_NUM_THREADS=$SLURM_CPUS_PER_TASK
+bwa mem -t $SLURM_CPUS_PER_TASK ref.fa r1.fq | samtools sort -@8 -o out.bam -
+STAR --genomeDir idx \\
+     --runThreadN $SLURM_CPUS_PER_TASK   # STAR --runThreadN 4
+echo "bwa -t 3"
+"""
+    rules = p2s.with_policy(p2s.load_rules(), ["thread_check=true", "thread_rewrite=true"])
+    with p2s.collect_diagnostics() as diags:
+        check(input, expected, p2s.convert_batch_script(input, rules = rules), desc)
+    assert [(d.level, d.line, d.rule) for d in diags[1:]] == [
+            ("INFO", 3, "OMP_NUM_THREADS"), ("INFO", 4, "bwa"), ("INFO", 6, "STAR")]
+    assert p2s.select_cpus_per_task("2:ncpus=8:mpiprocs=2") == 4
+    assert p2s.select_cpus_per_task("1:ncpus=8+2:ncpus=4") is None
+    # without rewrite, or without cpus per task, counts are only reported
+    check_only = p2s.with_policy(p2s.load_rules(), ["thread_check=true"])
+    with p2s.collect_diagnostics() as diags:
+        assert p2s.convert_batch_script(input, rules = check_only).endswith(input.split("\n", 2)[2])
+        p2s.convert_batch_script(input.replace("select=1:ncpus=8:mem=32gb", "nodes=1:ppn=8"),
+                rules = rules)
+    assert [(d.level, d.rule) for d in diags if d.rule in ("bwa", "samtools")] == [
+            ("WARNING", "bwa"), ("WARNING", "bwa"), ("WARNING", "samtools")]
+    # a changed header checks the unchanged body again
+    with p2s.collect_diagnostics():
+        first = p2s.convert(input, rules = rules, incremental = True)
+        second = p2s.convert(input.replace("ncpus=8", "ncpus=16"), rules = rules,
+                previous = first)
+    assert "-t 16 " in second.output and "$SLURM_CPUS_PER_TASK" in second.output
+
+def test_archive_conversion():
+    script = b"#PBS -N job\ncd $PBS_O_WORKDIR\n"
+    expected = (p2s.convert_batch_script(script.decode()) + "\n").encode()
+    members = {"jobs/run.pbs": script, "jobs/data.bin": b"\x00\xff#PBS",
+            "jobs/notes.txt": b"see run.pbs\n"}
+    buf = io.BytesIO()
+    with tarfile.open(fileobj = buf, mode = "w:gz") as tar:
+        for name, data in members.items():
+            ti = tarfile.TarInfo(name)
+            ti.size, ti.mode, ti.mtime, ti.uname = len(data), 0o750, 1234567890, "lab"
+            tar.addfile(ti, io.BytesIO(data))
+    out = io.BytesIO()
+    with p2s.collect_diagnostics():
+        assert pbs2slurm_archive.convert_archive(io.BytesIO(buf.getvalue()), out) == (3, 1)
+    assert out.getvalue()[:2] == b"\x1f\x8b"
+    with tarfile.open(fileobj = io.BytesIO(out.getvalue()), mode = "r:gz") as tar:
+        result = {ti.name: (ti, tar.extractfile(ti).read()) for ti in tar}
+    assert result["jobs/run.pbs"][1] == expected
+    for name in members:
+        ti = result[name][0]
+        assert (ti.mode, ti.mtime, ti.uname) == (0o750, 1234567890, "lab")
+        if name != "jobs/run.pbs":
+            assert result[name][1] == members[name]
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for name, data in members.items():
+            zf.writestr(zipfile.ZipInfo(name, (2020, 1, 2, 3, 4, 6)), data)
+    out = io.BytesIO()
+    with p2s.collect_diagnostics():
+        assert pbs2slurm_archive.convert_archive(io.BytesIO(buf.getvalue()), out,
+                max_script_size = 12) == (3, 0)
+        out = io.BytesIO()
+        assert pbs2slurm_archive.convert_archive(io.BytesIO(buf.getvalue()), out) == (3, 1)
+    with zipfile.ZipFile(io.BytesIO(out.getvalue())) as zf:
+        assert zf.read("jobs/run.pbs") == expected
+        assert zf.read("jobs/data.bin") == members["jobs/data.bin"]
+        assert zf.getinfo("jobs/notes.txt").date_time == (2020, 1, 2, 3, 4, 6)
+
 if __name__ == '__main__':
     # this is a pretty stupid way of doing this - should have used a testing
     # framework
@@ -1001,7 +2258,16 @@ if __name__ == '__main__':
         test_pbs_o_workdir,
         test_pbs_jobid,
         test_pbs_arrayid,
+        test_heredocs_and_data,
         test_missing_shebang,
+        test_script_spans,
+        test_incremental_conversion,
+        test_header_memo,
+        test_array_mail_policy,
+        test_array_packing,
+        test_minimal_export,
+        test_checkpoint,
+        test_thread_counts,
         test_header_identification,
         test_jobname,
         test_jobname_empty,
@@ -1034,11 +2300,32 @@ if __name__ == '__main__':
         test_fix_job_array,
         test_drop_empty_job_array,
         test_resources,
+        test_select,
+        test_scratch,
+        test_placement,
         test_drop_queue,
         test_script1,
         test_script2,
         test_script3,
         test_script4,
+        test_site_rules,
+        test_rules_cache,
+        test_builtin_rules,
+        test_differential_runner,
+        test_job_description,
+        test_follow_includes,
+        test_bulk_pipeline,
+        test_bulk_worker_death,
+        test_bulk_journal,
+        test_bulk_shards,
+        test_bulk_report,
+        test_archive_conversion,
+        test_check_header,
+        test_adversarial_directives,
+        test_driver_loop_to_array,
+        test_driver_fallback,
+        test_driver_dependencies,
+        test_job_control,
     )
     sys.stderr = sys.stdout
     html = open("testcases.html", "w")